@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+# Batch rendering: runs a directory of plotting scripts, or a JSONL file of
+# {"id": ..., "code": ...} snippets, through the sandbox on all cores and
+# writes the images to an output directory.
+#
+#   python batch.py archive/ --output rendered/
+#   python batch.py snippets.jsonl --output rendered/ --format jpeg --dpi 150
+#
+# Figures still open when a snippet ends are rendered as if it called show().
+# Every result is appended to manifest.jsonl in the output directory as soon
+# as it is done, with its timing, output and error. A later run skips the
+# snippets whose code and render settings are unchanged since they last
+# rendered successfully, so an interrupted run resumes where it stopped.
+
+import argparse
+import asyncio
+import glob
+import json
+import logging
+import os
+import re
+import sys
+import tempfile
+import time
+from typing import Dict, List, Tuple
+
+from cache import cache_key
+from compiler import compile_plot_code
+from render import build_profile, parse_directives, validate_overrides
+from worker_pool import JobLimits, WorkerPool
+
+logger = logging.getLogger(__name__)
+
+# Name of the manifest in the output directory
+MANIFEST = "manifest.jsonl"
+
+# Appended to every snippet to render the figures it leaves open, such as
+# those a script only saves with savefig() into the scratch directory
+SHOW_OPEN_FIGURES = "\n\nimport matplotlib.pyplot\nmatplotlib.pyplot.show()\n"
+
+# Error recorded for a snippet that ran without producing an image
+NO_IMAGES_ERROR = "No plots were generated"
+
+def load_snippets(source) -> List[Tuple[str, str]]:
+    """Return (name, code) for every .py file under a directory or every line of a JSONL file."""
+    if os.path.isdir(source):
+        paths = sorted(glob.glob(os.path.join(source, "**", "*.py"), recursive=True))
+        snippets = []
+        for path in paths:
+            with open(path, encoding="utf-8") as f:
+                snippets.append((os.path.relpath(path, source)[:-len(".py")], f.read()))
+        return snippets
+
+    snippets = []
+    with open(source, encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            if line.strip():
+                entry = json.loads(line)
+                snippets.append((str(entry.get("id", number)), entry["code"]))
+    return snippets
+
+def file_stem(name) -> str:
+    """Filesystem-safe form of a snippet name, e.g. "figures/fig 1" -> "figures__fig_1"."""
+    return re.sub(r"[^\w.-]+", "_", name.replace(os.sep, "__").replace("/", "__"))
+
+def read_manifest(path) -> Dict[str, dict]:
+    """Latest manifest entry of each snippet (empty when there is no manifest yet)."""
+    entries = {}
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A line cut short by an interrupted run
+                    continue
+                entries[entry["name"]] = entry
+    return entries
+
+def is_current(entry, digest, output) -> bool:
+    """Whether a manifest entry is a successful render of the same code and settings."""
+    return (entry is not None and entry["hash"] == digest and not entry["error"] and entry["images"]
+            and all(os.path.exists(os.path.join(output, image)) for image in entry["images"]))
+
+async def render_all(snippets, output, workers=None, overrides=None, limits=None, force=False) -> dict:
+    """Render snippets in parallel, recording each result in the manifest as it finishes.
+
+    Args:
+        snippets: List of (name, code)
+        output: Directory the images and the manifest are written to
+        workers: Number of worker processes (all cores when None)
+        overrides: Render profile settings, e.g. {"format": "jpeg"}
+        limits: JobLimits of each snippet
+        force: Render every snippet, even the unchanged ones
+
+    Returns:
+        Counts of rendered, skipped and failed snippets and the elapsed seconds
+    """
+    os.makedirs(output, exist_ok=True)
+    manifest_path = os.path.join(output, MANIFEST)
+    manifest = read_manifest(manifest_path)
+    counts = {"rendered": 0, "skipped": 0, "failed": 0}
+
+    pool = WorkerPool(workers=workers or os.cpu_count(), limits=limits)
+    pool.start()
+    slots = asyncio.Semaphore(pool.workers)
+
+    # Full-quality files, unless the command line or the snippet says otherwise
+    settings = {"as_document": True, **(overrides or {})}
+
+    async def render(name, code, log):
+        error = None
+        try:
+            profile = build_profile(settings, parse_directives(code))
+        except ValueError as e:
+            profile, error = build_profile(settings), f"Invalid plot options: {e}"
+        digest = cache_key(code, profile)
+        previous = manifest.get(name)
+        if not force and is_current(previous, digest, output):
+            counts["skipped"] += 1
+            return
+
+        images, text, seconds = [], "", 0.0
+        if not error:
+            compiled = compile_plot_code(code + SHOW_OPEN_FIGURES)
+            error = compiled.error
+        if not error:
+            async with slots:
+                started = time.perf_counter()
+                images, text, error = await pool.submit(compiled.code, profile, cost=compiled.cost)
+                seconds = time.perf_counter() - started
+            if not error and not images:
+                error = NO_IMAGES_ERROR
+
+        # Replace the images of the previous render of this snippet
+        for stale in (previous or {}).get("images", []):
+            try:
+                os.remove(os.path.join(output, stale))
+            except OSError:
+                pass
+        filenames = [f"{file_stem(name)}-{index}.{profile.extension}" for index in range(1, len(images) + 1)]
+        for filename, image in zip(filenames, images):
+            with open(os.path.join(output, filename), "wb") as f:
+                f.write(image)
+
+        entry = {"name": name, "hash": digest, "images": filenames, "seconds": round(seconds, 3),
+                 "output": text, "error": error}
+        manifest[name] = entry
+        log.write(json.dumps(entry) + "\n")
+        log.flush()
+        counts["failed" if error else "rendered"] += 1
+        logger.info(f"{name}: {'failed' if error else f'{len(images)} image(s)'} in {seconds:.2f}s")
+
+    started = time.perf_counter()
+    try:
+        with open(manifest_path, "a", encoding="utf-8") as log:
+            await asyncio.gather(*(render(name, code, log) for name, code in snippets))
+    finally:
+        pool.shutdown()
+    counts["seconds"] = time.perf_counter() - started
+
+    # Leave one entry per snippet behind
+    with open(manifest_path + ".tmp", "w", encoding="utf-8") as f:
+        for entry in manifest.values():
+            f.write(json.dumps(entry) + "\n")
+    os.replace(manifest_path + ".tmp", manifest_path)
+    return counts
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render a directory or JSONL file of plotting snippets")
+    parser.add_argument("source", help="directory of .py files or JSONL file with id and code per line")
+    parser.add_argument("--output", required=True, help="directory for the images and manifest.jsonl")
+    parser.add_argument("--workers", type=int, help="worker processes (defaults to the CPU count)")
+    parser.add_argument("--format", help="png, jpeg or webp (defaults to png)")
+    parser.add_argument("--dpi", type=int, help="render DPI (defaults to 300)")
+    parser.add_argument("--timeout", type=int, help="seconds each snippet may run")
+    parser.add_argument("--force", action="store_true", help="render unchanged snippets again")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO)
+    try:
+        overrides = validate_overrides({name: value for name, value in (("format", args.format), ("dpi", args.dpi))
+                                        if value})
+    except ValueError as e:
+        parser.error(str(e))
+    limits = JobLimits(wall_time=args.timeout, cpu_time=args.timeout) if args.timeout else None
+    snippets = load_snippets(args.source)
+    output = os.path.abspath(args.output)
+
+    # Scripts that save files of their own write them into a scratch directory;
+    # the figures they saved are rendered into the output all the same
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as scratch:
+        os.chdir(scratch)
+        try:
+            counts = asyncio.run(render_all(snippets, output, args.workers, overrides, limits, args.force))
+        finally:
+            os.chdir(cwd)
+
+    print(f"{counts['rendered']} rendered, {counts['skipped']} unchanged, {counts['failed']} failed "
+          f"in {counts['seconds']:.1f}s; manifest in {os.path.join(output, MANIFEST)}")
+    return 1 if counts["failed"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+
+# Benchmark harness: runs a corpus of representative snippets through the
+# bot and reports throughput, latency percentiles and peak memory.
+#
+#   python benchmark.py snippets --concurrency 4 --repeat 3 --output before.json
+#   python benchmark.py bot --chats 8 --repeat 2 --latency 0.05 --compare before.json
+#   python benchmark.py bot --chats 8 --webhook --compare polling.json
+#   python benchmark.py startup --repeat 5 --cold-fonts
+#
+# "snippets" calls run_plot_code on a worker pool directly; "bot" drives
+# process_code end to end through a local fake Telegram API server, with
+# each chat sending its next snippet once the previous one is answered;
+# "startup" starts the bot in a new process and times its first replies.
+
+import argparse
+import ast
+import asyncio
+import glob
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Tuple
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+CORPUS_DIR = os.path.join(ROOT, "benchmark_corpus")
+
+# Existing ad-hoc scripts that are part of the corpus as they are
+SCRIPT_FILES = ["test_plot.py", "test_evaluation_code.py"]
+
+# Scripts whose embedded code snippets are part of the corpus
+SNIPPET_FILES = ["test_security_fix.py"]
+
+# Started in a new process by the startup benchmark: the bot as bot.py runs
+# it, but against the fake Telegram API given on the command line
+STARTUP_SCRIPT = """
+import asyncio, sys
+import bot
+asyncio.run(bot.run_bot(bot.build_application("0:startup", sys.argv[1], sys.argv[2])))
+"""
+
+# Plot the startup benchmark asks for right after /help
+STARTUP_PLOT = "import matplotlib.pyplot as plt\nplt.plot([1, 3, 2])\nplt.show()"
+
+def load_corpus() -> List[Tuple[str, str]]:
+    """Return (name, code) for every snippet in the corpus."""
+    corpus = []
+    for filename in SCRIPT_FILES:
+        with open(os.path.join(ROOT, filename)) as f:
+            corpus.append((filename, f.read()))
+    for filename in SNIPPET_FILES:
+        with open(os.path.join(ROOT, filename)) as f:
+            tree = ast.parse(f.read())
+        strings = [node.value for node in ast.walk(tree)
+                   if isinstance(node, ast.Constant) and isinstance(node.value, str) and "plt." in node.value]
+        corpus += [(f"{filename}[{index}]", code) for index, code in enumerate(strings)]
+    for path in sorted(glob.glob(os.path.join(CORPUS_DIR, "*.py"))):
+        with open(path) as f:
+            corpus.append((os.path.basename(path), f.read()))
+    return corpus
+
+def percentile(values, q) -> float:
+    """Nearest-rank percentile of a list of numbers."""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))]
+
+def process_tree_rss(pid) -> int:
+    """Resident memory in bytes of a process and all of its descendants."""
+    children: Dict[int, List[int]] = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+
+    total, todo = 0, [pid]
+    while todo:
+        current = todo.pop()
+        todo += children.get(current, [])
+        try:
+            with open(f"/proc/{current}/statm") as f:
+                total += int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, IndexError, ValueError):
+            pass
+    return total
+
+class PeakMemory:
+    """Samples the RSS of this process tree in the background and keeps the peak."""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self._task = None
+
+    async def _sample(self):
+        while True:
+            self.peak = max(self.peak, process_tree_rss(os.getpid()))
+            await asyncio.sleep(self.interval)
+
+    def __enter__(self):
+        if os.path.isdir("/proc"):
+            self._task = asyncio.get_running_loop().create_task(self._sample())
+        return self
+
+    def __exit__(self, *exc):
+        if self._task:
+            self._task.cancel()
+
+def latency_summary(seconds) -> dict:
+    return {
+        "p50": percentile(seconds, 50) * 1000,
+        "p95": percentile(seconds, 95) * 1000,
+        "p99": percentile(seconds, 99) * 1000,
+        "max": max(seconds) * 1000,
+    }
+
+def summarize(mode, args, latencies, errors, elapsed, peak_rss, first_replies=None, first_images=None) -> dict:
+    """Aggregate the timings of a run into the result that is printed and saved."""
+    everything = [seconds for samples in latencies.values() for seconds in samples]
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "mode": mode,
+        "commit": commit,
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "settings": {name: value for name, value in vars(args).items() if name not in ("output", "compare")},
+        "jobs": len(everything),
+        "errors": sum(errors.values()),
+        "throughput_per_s": len(everything) / elapsed,
+        "latency_ms": latency_summary(everything),
+        # Update to the bot's first reply, without the plotting itself (bot mode)
+        "first_reply_ms": latency_summary(first_replies) if first_replies else {},
+        "first_image_ms": latency_summary(first_images) if first_images else {},
+        "peak_rss_mb": peak_rss / 1024 / 1024,
+        "snippets": {
+            name: {"p50_ms": percentile(samples, 50) * 1000, "errors": errors.get(name, 0)}
+            for name, samples in latencies.items()
+        },
+    }
+
+async def bench_snippets(args, corpus):
+    """Run the corpus through run_plot_code with a fixed number of jobs in flight."""
+    from bot import run_plot_code
+    from cache import ResultCache
+    from worker_pool import WorkerPool
+
+    pool = WorkerPool()
+    pool.start()
+    cache = ResultCache(directory="") if args.cache else None
+    latencies, errors = {}, {}
+    slots = asyncio.Semaphore(args.concurrency)
+
+    async def run(name, code):
+        async with slots:
+            start = time.perf_counter()
+            images, error = await run_plot_code(code, pool, cache)
+            latencies.setdefault(name, []).append(time.perf_counter() - start)
+            if error:
+                errors[name] = errors.get(name, 0) + 1
+
+    try:
+        # One untimed pass over the corpus so every worker is warm
+        await asyncio.gather(*(run_plot_code(code, pool) for _, code in corpus))
+        with PeakMemory() as memory:
+            start = time.perf_counter()
+            await asyncio.gather(*(run(name, code) for _ in range(args.repeat) for name, code in corpus))
+            elapsed = time.perf_counter() - start
+    finally:
+        pool.shutdown()
+    return latencies, errors, elapsed, memory.peak, [], []
+
+async def bench_bot(args, corpus):
+    """Drive process_code end to end from many chats through the fake Telegram API."""
+    from bot import build_application
+    from cache import ResultCache
+    from fake_telegram import FakeTelegramServer
+    from webhook import start_webhook
+
+    server = FakeTelegramServer(latency=args.latency)
+    await server.start()
+    application = build_application("0:benchmark", server.base_url, server.file_url)
+    if not args.cache:
+        application.bot_data["result_cache"] = ResultCache(max_bytes=0, directory="")
+    latencies, errors = {}, {}
+
+    async def chat(chat_id):
+        # Each chat starts at a different point in the corpus
+        for index in range(args.repeat * len(corpus)):
+            name, code = corpus[(chat_id + index) % len(corpus)]
+            start = time.perf_counter()
+            done = await server.send_message(chat_id, f"```python\n{code}\n```")
+            latencies.setdefault(name, []).append(done - start)
+
+    try:
+        async with application:
+            await application.start()
+            if args.webhook:
+                receiver = await start_webhook(application, listen="127.0.0.1", port=0)
+            else:
+                await application.updater.start_polling(poll_interval=0, timeout=1)
+            with PeakMemory() as memory:
+                start = time.perf_counter()
+                await asyncio.gather(*(chat(chat_id) for chat_id in range(1, args.chats + 1)))
+                elapsed = time.perf_counter() - start
+            if args.webhook:
+                await receiver.stop()
+            else:
+                await application.updater.stop()
+            await application.stop()
+    finally:
+        application.bot_data["worker_pool"].shutdown()
+        await server.stop()
+    print(f"Telegram requests: {dict(server.requests)}, {server.bytes_received / 1024 / 1024:.1f} MB uploaded")
+    return latencies, errors, elapsed, memory.peak, server.first_replies, server.first_images
+
+async def bench_startup(args, corpus):
+    """Start the bot from scratch, with /help and a plot already waiting, and time the replies.
+
+    Latencies are measured from starting the process: "help" to the reply
+    to /help, "plot" to the plot. With --cold-fonts, matplotlib's font cache
+    is rebuilt on every start, as in a container without a prebuilt one.
+    """
+    from fake_telegram import FakeTelegramServer
+
+    server = FakeTelegramServer(latency=args.latency)
+    await server.start()
+    latencies = {"help": [], "plot": []}
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    try:
+        with PeakMemory() as memory:
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                with tempfile.TemporaryDirectory() as fonts:
+                    if args.cold_fonts:
+                        env["MPLCONFIGDIR"] = fonts
+                    launched = time.perf_counter()
+                    server.send_message(1, "/help")
+                    plotted = server.send_message(2, f"```python\n{STARTUP_PLOT}\n```")
+                    helped = server.replied[1]
+                    process = await asyncio.create_subprocess_exec(
+                        sys.executable, "-c", STARTUP_SCRIPT, server.base_url, server.file_url, env=env)
+                    try:
+                        latencies["help"].append(await helped - launched)
+                        latencies["plot"].append(await plotted - launched)
+                    finally:
+                        process.terminate()
+                        await process.wait()
+            elapsed = time.perf_counter() - start
+    finally:
+        await server.stop()
+    return latencies, {}, elapsed, memory.peak, latencies["help"], []
+
+def print_report(result, baseline=None):
+    def row(label, value, old=None, unit=""):
+        line = f"{label:<32} {value:>10.1f}{unit}"
+        if old is not None:
+            change = (value - old) / old * 100 if old else 0.0
+            line += f"   (was {old:.1f}{unit}, {change:+.1f}%)"
+        print(line)
+
+    base = baseline or {}
+    print(f"\n{result['mode']} benchmark at {result['commit'] or 'working tree'}: "
+          f"{result['jobs']} jobs, {result['errors']} errors")
+    row("throughput (jobs/s)", result["throughput_per_s"], base.get("throughput_per_s"))
+    for name, value in result["latency_ms"].items():
+        row(f"latency {name}", value, base.get("latency_ms", {}).get(name), " ms")
+    for name, value in result.get("first_reply_ms", {}).items():
+        row(f"first reply {name}", value, base.get("first_reply_ms", {}).get(name), " ms")
+    for name, value in result.get("first_image_ms", {}).items():
+        row(f"first image {name}", value, base.get("first_image_ms", {}).get(name), " ms")
+    row("peak RSS", result["peak_rss_mb"], base.get("peak_rss_mb"), " MB")
+    print()
+    for name, snippet in result["snippets"].items():
+        old = base.get("snippets", {}).get(name, {}).get("p50_ms")
+        row(f"  {name[:30]}", snippet["p50_ms"], old, " ms")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the plotting bot on a corpus of snippets")
+    parser.add_argument("mode", choices=["snippets", "bot", "startup"])
+    parser.add_argument("--repeat", type=int, default=3, help="passes over the corpus")
+    parser.add_argument("--concurrency", type=int, default=4, help="jobs in flight (snippets mode)")
+    parser.add_argument("--chats", type=int, default=8, help="concurrent chats (bot mode)")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to each Telegram request (bot mode)")
+    parser.add_argument("--webhook", action="store_true", help="receive updates on a webhook instead of polling (bot mode)")
+    parser.add_argument("--cold-fonts", action="store_true", help="rebuild the font cache on each start (startup mode)")
+    parser.add_argument("--cache", action="store_true", help="keep the result cache enabled")
+    parser.add_argument("--output", help="save the results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    sys.path.insert(0, ROOT)
+    # One log line per Telegram request would drown out the report
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    corpus = load_corpus()
+    # Scripts in the corpus that save files write them into a scratch directory
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as scratch:
+        os.chdir(scratch)
+        bench = {"snippets": bench_snippets, "bot": bench_bot, "startup": bench_startup}[args.mode]
+        try:
+            latencies, errors, elapsed, peak_rss, first_replies, first_images = asyncio.run(bench(args, corpus))
+        finally:
+            os.chdir(cwd)
+
+    result = summarize(args.mode, args, latencies, errors, elapsed, peak_rss, first_replies, first_images)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+if __name__ == "__main__":
+    main()
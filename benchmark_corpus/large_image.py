@@ -0,0 +1,8 @@
+import numpy as np
+import matplotlib.pyplot as plt
+
+# 2000x2000 heat map
+xx, yy = np.meshgrid(np.linspace(-3, 3, 2000), np.linspace(-3, 3, 2000))
+plt.imshow(np.sin(xx ** 2 + yy ** 2), cmap='magma')
+plt.colorbar()
+plt.show()
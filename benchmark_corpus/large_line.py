@@ -0,0 +1,10 @@
+import numpy as np
+import matplotlib.pyplot as plt
+
+# One million points in a single line
+x = np.linspace(0, 100, 1_000_000)
+y = np.sin(x) + np.random.normal(0, 0.1, x.size)
+plt.figure(figsize=(10, 4))
+plt.plot(x, y, linewidth=0.5)
+plt.title('1M-point line')
+plt.show()
@@ -0,0 +1,11 @@
+import numpy as np
+import matplotlib.pyplot as plt
+
+# 200k scattered points with a colour per point
+rng = np.random.default_rng(0)
+x = rng.normal(size=200_000)
+y = x * 0.5 + rng.normal(size=200_000)
+plt.figure(figsize=(6, 6))
+plt.scatter(x, y, c=np.hypot(x, y), s=2, cmap='viridis')
+plt.colorbar()
+plt.show()
@@ -0,0 +1,10 @@
+import numpy as np
+import matplotlib.pyplot as plt
+
+# Twelve separate figures, more than fit in one album
+x = np.linspace(0, 2 * np.pi, 200)
+for i in range(12):
+    plt.figure(figsize=(5, 3))
+    plt.plot(x, np.sin((i + 1) * x))
+    plt.title(f'Harmonic {i + 1}')
+    plt.show()
@@ -0,0 +1,13 @@
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+
+# A year of minute data, resampled and smoothed
+index = pd.date_range('2024-01-01', periods=525_600, freq='min')
+series = pd.Series(np.random.randn(len(index)).cumsum(), index=index)
+daily = series.resample('D').agg(['mean', 'min', 'max'])
+ax = daily['mean'].plot(figsize=(12, 4), label='daily mean')
+ax.fill_between(daily.index, daily['min'], daily['max'], alpha=0.3)
+daily['mean'].rolling(30).mean().plot(ax=ax, label='30-day average')
+ax.legend()
+plt.show()
@@ -0,0 +1,16 @@
+import numpy as np
+import pandas as pd
+import seaborn as sns
+import matplotlib.pyplot as plt
+
+# Violin and KDE plots of grouped data
+rng = np.random.default_rng(2)
+df = pd.DataFrame({
+    'group': np.repeat(['A', 'B', 'C', 'D'], 2500),
+    'value': np.concatenate([rng.normal(loc, 1, 2500) for loc in range(4)]),
+})
+fig, axes = plt.subplots(1, 2, figsize=(12, 5))
+sns.violinplot(data=df, x='group', y='value', ax=axes[0])
+sns.kdeplot(data=df, x='value', hue='group', fill=True, ax=axes[1])
+plt.tight_layout()
+plt.show()
@@ -0,0 +1,11 @@
+import numpy as np
+import pandas as pd
+import seaborn as sns
+import matplotlib.pyplot as plt
+
+# Annotated correlation heat map
+rng = np.random.default_rng(1)
+df = pd.DataFrame(rng.normal(size=(500, 12)), columns=[f'f{i}' for i in range(12)])
+plt.figure(figsize=(9, 7))
+sns.heatmap(df.corr(), annot=True, fmt='.2f', cmap='coolwarm')
+plt.show()
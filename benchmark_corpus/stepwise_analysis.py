@@ -0,0 +1,18 @@
+import numpy as np
+import matplotlib.pyplot as plt
+
+# A script that computes and shows one result after another
+rng = np.random.default_rng(1)
+samples = rng.standard_t(df=3, size=(400, 2000))
+
+for step in range(5):
+    window = 2 ** (step + 3)
+    kernel = np.ones(window) / window
+    smoothed = np.array([np.convolve(row, kernel, mode='valid') for row in samples])
+    spectrum = np.abs(np.fft.rfft(smoothed, axis=1)).mean(axis=0)
+    fig, (left, right) = plt.subplots(1, 2, figsize=(10, 4))
+    left.plot(smoothed[:5].T, linewidth=0.8)
+    left.set_title(f'Moving average, window {window}')
+    right.semilogy(spectrum)
+    right.set_title('Mean spectrum')
+    plt.show()
@@ -0,0 +1,11 @@
+import numpy as np
+import matplotlib.pyplot as plt
+
+# 4x4 grid of small histograms in one figure
+rng = np.random.default_rng(3)
+fig, axes = plt.subplots(4, 4, figsize=(12, 12))
+for i, ax in enumerate(axes.flat):
+    ax.hist(rng.gamma(i + 1, size=5000), bins=50)
+    ax.set_title(f'shape {i + 1}')
+plt.tight_layout()
+plt.show()
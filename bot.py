@@ -1,68 +1,346 @@
 import os
 import logging
 import asyncio
-import matplotlib
-import matplotlib.pyplot as plt
-import matplotlib.font_manager as fm
-from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from sandbox import execute_plot_code, check_code_safety
-from utils import extract_code, format_error_message, get_help_message, get_welcome_message
-
-# Configure logging
-import logging.config
-import os.path
-
-if os.path.exists('logging.conf'):
-    # Create logs directory if it doesn't exist
-    os.makedirs('logs', exist_ok=True)
-    logging.config.fileConfig('logging.conf')
-else:
-    logging.basicConfig(
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        level=logging.INFO
-    )
+import signal
+import time
+from collections import OrderedDict
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto, Update
+from telegram.error import BadRequest, RetryAfter
+from telegram.ext import Application, CallbackQueryHandler, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram.request import HTTPXRequest
+import httpx
+import config
+import metrics
+import profiling
+from cache import FileIdCache, ResultCache, cache_key
+from render import DEFAULT_PROFILE, build_profile, parse_directives, preview_profile, validate_overrides
+from compiler import SKIPPED_BLOCK_ERROR, compile_plot_code, group_dependent_blocks
+from worker_pool import WorkerPool, PoolBusyError
+from utils import extract_code_blocks, format_error_message, get_help_message, get_welcome_message
+from journal import JobJournal
+from logging_setup import setup_logging
+import webhook
 
 logger = logging.getLogger(__name__)
 
-def setup_font():
-    """Configure matplotlib to use Times New Roman font (with Liberation Serif fallback)"""
-    try:
-        # Set font preferences with fallback chain
-        plt.rcParams['font.family'] = 'serif'
-        plt.rcParams['font.serif'] = ['Times New Roman', 'Liberation Serif', 'DejaVu Serif', 'serif']
-        
-        # Test if any serif font is available
-        fig, ax = plt.subplots(figsize=(1, 1))
-        ax.text(0.5, 0.5, 'Test', fontfamily='serif')
-        plt.close(fig)
-        
-        logger.info("Font configuration completed successfully")
-    except Exception as e:
-        logger.warning(f"Could not configure fonts: {e}")
-        # Fallback to matplotlib defaults
-        plt.rcParams['font.family'] = 'sans-serif'
+# Telegram rejects photos above this size; larger images are sent as documents
+MAX_PHOTO_BYTES = 10 * 1024 * 1024
+
+# Maximum number of photos Telegram accepts in one media group
+MEDIA_GROUP_SIZE = 10
+
+# Telegram's limit on the length of a text message
+MAX_MESSAGE_LENGTH = 4096
+
+# How many previews keep their "Full resolution" button working
+MAX_PENDING_FULL_RESOLUTION = 1000
+
+# Seconds between checks for sessions that have been idle for too long
+SESSION_SWEEP_INTERVAL = 60
+
+# Minimum seconds between edits of the "Processing..." message, to stay
+# clear of Telegram's flood limits
+PROGRESS_EDIT_INTERVAL = 1.0
+
+PROCESSING_TEXT = "Processing your plotting code..."
 
 # Execute the plotting code safely and return the generated images
-async def run_plot_code(code):
-    # First check if the code is safe to execute
-    is_safe, safety_error = check_code_safety(code)
-    if not is_safe:
-        error_type, formatted_error = format_error_message(safety_error)
+async def run_plot_code(code, pool, cache=None, profile=DEFAULT_PROFILE, chat_id=None, profiled=False,
+                        session=False, on_images=None, batch=None):
+    # Parse, safety-check and compile the code once, in this process
+    with metrics.timed("check"):
+        compiled = compile_plot_code(code)
+    if compiled.error:
+        error_type, formatted_error = format_error_message(compiled.error)
+        metrics.ERRORS.inc(label=error_type)
         return [], formatted_error
 
-    # Execute the code in the sandbox
-    plot_files, output, error = execute_plot_code(code)
+    # Identical code rendered with the same settings gives the same images,
+    # but a profiled job has to actually run, and in a session the result
+    # also depends on what earlier snippets left behind
+    cache = None if session else cache
+    key = cache_key(code, profile, normalized=compiled.normalized)
+    cached = cache.get(key) if cache and not profiled else None
+    if cached:
+        logger.info(f"Result cache hit ({cache.hit_ratio:.0%} hit ratio)", extra={"sampled": True, "chat_id": chat_id})
+        return cached[0], None
+
+    # Execute the code in the sandbox on one of the pool's worker processes
+    try:
+        images, output, error = await pool.submit(compiled.code, profile, chat_id, compiled.cost, profiled,
+                                                  session, on_images, batch)
+    except PoolBusyError as e:
+        logger.warning(str(e))
+        metrics.REJECTED.inc()
+        return [], f"The bot is busy right now. Please try again in {e.retry_after} seconds."
     
+    # The pool logs the job's output and error with the rest of its record
     if error:
-        logger.error(error)
         error_type, formatted_error = format_error_message(error)
+        metrics.ERRORS.inc(label=error_type)
         return [], formatted_error
     
-    if output:
-        logger.info(f"Code execution output: {output}")
+    if cache and images:
+        cache.put(key, images, output)
     
-    return plot_files, None
+    return images, None
+
+async def run_plot_blocks(blocks, pool, cache=None, profile=DEFAULT_PROFILE, chat_id=None, profiled=False,
+                          session=False):
+    """Run the code blocks of one message and return the (images, error) of each block.
+
+    Blocks that do not share any names run as jobs of their own, at the same
+    time on as many free workers as there are. The jobs are submitted as
+    one batch, which counts once against the chat's share of the workers.
+    Blocks that use what earlier blocks define run together as one job, in
+    order and in one namespace, and so do all blocks of a chat in session
+    mode.
+    """
+    groups = [list(range(len(blocks)))] if session else group_dependent_blocks(blocks)
+    results = [None] * len(blocks)
+    # Identifies the batch to the pool; more groups at once than workers
+    # would only wait in the queue
+    batch = object()
+    slots = asyncio.Semaphore(pool.workers)
+
+    def failed(error):
+        error_type, formatted_error = format_error_message(error)
+        metrics.ERRORS.inc(label=error_type)
+        return [], formatted_error
+
+    async def run_group(group):
+        if len(group) == 1 and not session:
+            async with slots:
+                results[group[0]] = await run_plot_code(blocks[group[0]], pool, cache, profile, chat_id, profiled,
+                                                        batch=batch)
+            return
+
+        with metrics.timed("check"):
+            compiled = [compile_plot_code(blocks[index]) for index in group]
+        if any(plot.error for plot in compiled):
+            # A group only runs if all of its blocks pass the safety check
+            for index, plot in zip(group, compiled):
+                results[index] = failed(plot.error) if plot.error else ([], SKIPPED_BLOCK_ERROR)
+            return
+
+        try:
+            async with slots:
+                group_results = await pool.submit([plot.code for plot in compiled], profile, chat_id,
+                                                  sum(plot.cost for plot in compiled), profiled, session,
+                                                  batch=batch)
+        except PoolBusyError as e:
+            logger.warning(str(e))
+            metrics.REJECTED.inc()
+            for index in group:
+                results[index] = [], f"The bot is busy right now. Please try again in {e.retry_after} seconds."
+            return
+
+        for index, (images, output, error) in zip(group, group_results):
+            if error == SKIPPED_BLOCK_ERROR:
+                results[index] = [], error
+            elif error:
+                results[index] = failed(error)
+            else:
+                results[index] = images, None
+
+    await asyncio.gather(*(run_group(group) for group in groups))
+    return results
+
+async def run_for_chat(message, context, code, profile, on_images=None):
+    """run_plot_code for a chat, in its session if it has one and profiled
+    when an admin asked for it.
+
+    ``code`` may also be the list of code blocks of a message, which are
+    run with run_plot_blocks instead; its results are returned then.
+    """
+    settings = context.bot_data["profiling"]
+    pool = context.bot_data["worker_pool"]
+    chat_id = message.chat_id
+    if isinstance(code, list):
+        result = await run_plot_blocks(
+            code, pool, context.bot_data["result_cache"], profile,
+            chat_id, settings.should_profile(chat_id), chat_id in pool.sessions.chats
+        )
+    else:
+        result = await run_plot_code(
+            code, pool, context.bot_data["result_cache"], profile,
+            chat_id, settings.should_profile(chat_id), chat_id in pool.sessions.chats, on_images
+        )
+    notice = pool.sessions.take_notice(chat_id)
+    if notice:
+        await message.reply_text(f"Your session was restarted because {notice}, "
+                                 "so variables from earlier messages are gone.")
+    # Reports of sampled jobs are only logged
+    report = profiling.take_report(chat_id)
+    if report and chat_id in settings.chats:
+        await message.reply_text(report[:MAX_MESSAGE_LENGTH])
+    return result
+
+async def with_retry(send, **kwargs):
+    """Call a Telegram send method, waiting out one flood-control (429) reply."""
+    with metrics.timed("reply"):
+        try:
+            return await send(**kwargs)
+        except RetryAfter as e:
+            logger.warning(f"Rate limited by Telegram, retrying in {e.retry_after}s")
+            await asyncio.sleep(e.retry_after)
+            return await send(**kwargs)
+
+async def send_image(message, image, filename, file_ids=None, as_document=False):
+    """Reply with an image, by file_id when the same bytes were sent before."""
+    as_document = as_document or len(image) > MAX_PHOTO_BYTES
+    kind = "document" if as_document else "photo"
+    file_id = file_ids.get(image, kind) if file_ids is not None else None
+    if file_id:
+        try:
+            if as_document:
+                return await with_retry(message.reply_document, document=file_id)
+            return await with_retry(message.reply_photo, photo=file_id)
+        except BadRequest as e:
+            logger.warning(f"Cached file_id rejected, uploading again: {e}")
+            file_ids.discard(image, kind)
+
+    metrics.BYTES_UPLOADED.inc(len(image))
+    if as_document:
+        sent = await with_retry(message.reply_document, document=image, filename=filename)
+        file_id = sent.document.file_id
+    else:
+        sent = await with_retry(message.reply_photo, photo=image)
+        file_id = sent.photo[-1].file_id
+    if file_ids is not None:
+        file_ids.put(image, file_id, kind)
+    return sent
+
+async def send_album(message, images, file_ids=None):
+    """Reply with several photos as one media group."""
+    media = [InputMediaPhoto(media=(file_ids.get(image) if file_ids is not None else None) or image) for image in images]
+    metrics.BYTES_UPLOADED.inc(sum(len(item.media) for item in media if isinstance(item.media, bytes)))
+    try:
+        sent = await with_retry(message.reply_media_group, media=media)
+    except BadRequest as e:
+        if not any(isinstance(item.media, str) for item in media):
+            raise
+        logger.warning(f"Cached file_id rejected in media group, uploading again: {e}")
+        for image in images:
+            file_ids.discard(image)
+        metrics.BYTES_UPLOADED.inc(sum(len(image) for image in images))
+        sent = await with_retry(message.reply_media_group, media=[InputMediaPhoto(media=image) for image in images])
+    if file_ids is not None:
+        for image, photo_message in zip(images, sent):
+            file_ids.put(image, photo_message.photo[-1].file_id)
+
+async def send_images(message, images, file_ids=None, profile=DEFAULT_PROFILE):
+    """Reply with all images of a result, in order, using as few requests as possible.
+
+    Consecutive photos go out as media-group albums of up to MEDIA_GROUP_SIZE;
+    images too large for a photo, or all of them in document mode, go out as
+    individual documents between them.
+    """
+    async def send_photos(photos):
+        for start in range(0, len(photos), MEDIA_GROUP_SIZE):
+            chunk = photos[start:start + MEDIA_GROUP_SIZE]
+            if len(chunk) == 1:
+                await send_image(message, chunk[0], f"plot.{profile.extension}", file_ids)
+            else:
+                await send_album(message, chunk, file_ids)
+
+    photos = []
+    for index, image in enumerate(images, 1):
+        if profile.as_document or len(image) > MAX_PHOTO_BYTES:
+            # The photos shown before this document go first
+            await send_photos(photos)
+            photos = []
+            await send_image(message, image, f"plot_{index}.{profile.extension}", file_ids, as_document=True)
+        else:
+            photos.append(image)
+    await send_photos(photos)
+
+class StreamedReply:
+    """Sends the images of each plt.show() while the rest of the script runs.
+
+    Pass it as on_images; batches are uploaded one after the other in the
+    order they were shown, and the status message counts the plots sent.
+    Batches that could not be sent are kept in ``failed``, to go out with
+    the final reply.
+    """
+
+    def __init__(self, message, status, file_ids=None, profile=DEFAULT_PROFILE):
+        self.message = message
+        self.status = status
+        self.file_ids = file_ids
+        self.profile = profile
+        self.received = 0
+        self.sent = 0
+        self.failed = []
+        self._started = time.perf_counter()
+        self._last_edit = 0.0
+        self._last = None
+
+    def __call__(self, images):
+        self.received += len(images)
+        self._last = asyncio.ensure_future(self._send(images, self._last))
+
+    async def _send(self, images, previous):
+        if previous:
+            await previous
+        try:
+            await send_images(self.message, images, self.file_ids, self.profile)
+        except Exception as e:
+            logger.error(f"Could not send streamed plots, sending them with the rest: {e}")
+            self.failed.extend(images)
+            return
+        if not self.sent:
+            metrics.PHASE_SECONDS.observe(time.perf_counter() - self._started, "first_image")
+        self.sent += len(images)
+        if time.perf_counter() - self._last_edit >= PROGRESS_EDIT_INTERVAL:
+            self._last_edit = time.perf_counter()
+            try:
+                await self.status.edit_text(f"{PROCESSING_TEXT} {self.sent} plot(s) sent so far")
+            except Exception as e:
+                logger.warning(f"Could not update the status message: {e}")
+
+    async def finish(self):
+        """Wait until every image received so far has been sent."""
+        if self._last:
+            await self._last
+
+async def send_full_resolution(message, context, code, profile):
+    """Render code with the user's own profile and reply with the result."""
+    images, error = await run_for_chat(message, context, code, profile)
+    if error:
+        await message.reply_text(f"Error: {error}")
+    elif images:
+        await send_images(message, images, context.bot_data["file_ids"], profile)
+
+async def offer_full_resolution(message, context, code, profile):
+    """Follow a preview with the full-resolution render, now or on request."""
+    if config.PREVIEW_MODE == "auto":
+        context.application.create_task(send_full_resolution(message, context, code, profile))
+        return
+
+    # Remember the code so the button can re-render it later
+    pending = context.bot_data.setdefault("full_resolution", OrderedDict())
+    token = cache_key(code, profile)[:32]
+    pending[token] = (code, profile)
+    pending.move_to_end(token)
+    while len(pending) > MAX_PENDING_FULL_RESOLUTION:
+        pending.popitem(last=False)
+
+    keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("Full resolution", callback_data=f"full:{token}")]])
+    await message.reply_text("This is a quick preview.", reply_markup=keyboard)
+
+async def full_resolution_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    token = query.data.partition(":")[2]
+    entry = context.bot_data.get("full_resolution", {}).get(token)
+    if entry is None:
+        await query.answer("This preview has expired, please send the code again.")
+        return
+
+    # Editing the text also removes the button, so it cannot be pressed twice
+    await query.answer("Rendering full resolution...")
+    await query.edit_message_text("Full resolution:")
+    await send_full_resolution(query.message, context, *entry)
 
 # Command handlers
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -71,11 +349,116 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(get_help_message())
 
+async def set_render_option(update, context, name, value):
+    """Store (or clear, when value is None) one of the user's render overrides."""
+    overrides = context.user_data.setdefault("render", {})
+    if value is None:
+        overrides.pop(name, None)
+    else:
+        try:
+            overrides.update(validate_overrides({name: value}))
+        except ValueError as e:
+            await update.message.reply_text(f"Error: {e}")
+            return
+    profile = build_profile(overrides)
+    mode = "document" if profile.as_document else "photo"
+    await update.message.reply_text(f"Plots will be sent as {profile.format.upper()} {mode}s at up to {profile.dpi} DPI.")
+
+async def dpi_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await set_render_option(update, context, "dpi", context.args[0] if context.args else None)
+
+async def format_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await set_render_option(update, context, "format", context.args[0] if context.args else None)
+
+async def document_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Toggles full-quality document mode
+    enabled = context.user_data.get("render", {}).get("as_document")
+    await set_render_option(update, context, "as_document", None if enabled else True)
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin-only summary of load, caches and where request time goes."""
+    if update.effective_user.id not in config.ADMIN_IDS:
+        return
+    pool = context.bot_data["worker_pool"]
+    cache_stats = context.bot_data["result_cache"].stats()
+    errors = ", ".join(f"{name}: {count}" for name, count in sorted(metrics.ERRORS.values.items())) or "none"
+    lines = [
+        f"Requests: {metrics.REQUESTS.values.get('', 0)}, turned away: {metrics.REJECTED.values.get('', 0)}",
+        f"Errors: {errors}",
+        f"Workers busy: {pool.busy_workers}/{pool.workers}, jobs waiting: {pool.queue_depth}",
+        f"Result cache: {cache_stats['hit_ratio']:.0%} hit ratio, {cache_stats['entries']} entries, "
+        f"{cache_stats['bytes'] / 1024 / 1024:.1f} MB",
+        f"Uploaded: {metrics.BYTES_UPLOADED.values.get('', 0) / 1024 / 1024:.1f} MB",
+        "",
+        "Phases:",
+        *metrics.phase_summary(),
+    ]
+    await update.message.reply_text("\n".join(lines))
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin switch for job profiling.
+
+    /profile toggles profiling of every job in this chat, with the report
+    sent here; /profile 5 profiles and logs 5% of all jobs (0 turns it off).
+    """
+    if update.effective_user.id not in config.ADMIN_IDS:
+        return
+    settings = context.bot_data["profiling"]
+    if context.args:
+        try:
+            percent = float(context.args[0].rstrip("%"))
+        except ValueError:
+            percent = -1
+        if not 0 <= percent <= 100:
+            await update.message.reply_text("Error: the sample rate must be a percentage between 0 and 100")
+            return
+        settings.sample_percent = percent
+        await update.message.reply_text(f"Profiling {percent:g}% of all jobs.")
+        return
+
+    chat_id = update.effective_chat.id
+    if chat_id in settings.chats:
+        settings.chats.discard(chat_id)
+        await update.message.reply_text("Profiling is off for this chat.")
+    else:
+        settings.chats.add(chat_id)
+        await update.message.reply_text("Profiling is on for this chat; each plot is followed by its profile.")
+
+async def session_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Toggle session mode, in which variables survive from one message to the next."""
+    sessions = context.bot_data["worker_pool"].sessions
+    chat_id = update.effective_chat.id
+    if chat_id in sessions.chats:
+        sessions.chats.discard(chat_id)
+        sessions.close(chat_id)
+        await update.message.reply_text("Session mode is off; each snippet runs on its own again.")
+    else:
+        sessions.chats.add(chat_id)
+        await update.message.reply_text(
+            "Session mode is on: variables and imports from your snippets are kept, so you can load "
+            "data once and then only send the plotting code. /reset clears them, /session turns this off."
+        )
+
+async def reset_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Clear the chat's session, keeping session mode on."""
+    sessions = context.bot_data["worker_pool"].sessions
+    if update.effective_chat.id not in sessions.chats:
+        await update.message.reply_text("Session mode is off, there is nothing to reset. Send /session to turn it on.")
+        return
+    sessions.close(update.effective_chat.id)
+    await update.message.reply_text("Your session was cleared.")
+
 async def process_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle a message with plotting code once per update, keeping it in the job journal meanwhile."""
+    await context.bot_data["journal"].run(update, handle_code(update, context))
+
+async def handle_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message_text = update.message.text
-    code = extract_code(message_text)
+    metrics.REQUESTS.inc()
+    with metrics.timed("extract_code"):
+        blocks = extract_code_blocks(message_text)
     
-    if not code:
+    if not blocks:
         await update.message.reply_text(
             "I couldn't find any Python plotting code in your message. "
             "Please send code enclosed in triple backticks (```). "
@@ -83,34 +466,58 @@ async def process_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
+    if len(blocks) > 1:
+        await process_blocks(update, context, blocks)
+        return
+    code = blocks[0]
+    
+    # Per-message "# plot:" options take precedence over the user's settings
+    try:
+        message_overrides = parse_directives(code)
+    except ValueError as e:
+        await update.message.reply_text(f"Error: {e}")
+        return
+    profile = build_profile(context.user_data.get("render"), message_overrides)
+    
+    # Send a quick low-resolution preview of the user's format first unless
+    # full quality was asked for; the full render then follows in the user's
+    # own settings. In a session the code cannot be run a second time.
+    in_session = update.message.chat_id in context.bot_data["worker_pool"].sessions.chats
+    preview = None
+    if config.PREVIEW_MODE != "off" and not profile.as_document and not in_session:
+        preview = preview_profile(profile)
+    if preview:
+        full_profile, profile = profile, preview
+    
     # Send a processing message
-    processing_message = await update.message.reply_text("Processing your plotting code...")
+    processing_message = await update.message.reply_text(PROCESSING_TEXT)
     
     try:
-        # Execute the code and get the plot files
-        plot_files, error = await run_plot_code(code)
+        # Execute the code; the plots of each plt.show() are sent as soon as
+        # they are rendered, while the rest of the script is still running
+        stream = StreamedReply(update.message, processing_message, context.bot_data["file_ids"], profile)
+        images, error = await run_for_chat(update.message, context, code, profile, stream)
+        await stream.finish()
         
         if error:
             await update.message.reply_text(f"Error: {error}")
             return
         
-        if not plot_files:
+        if not images:
             await update.message.reply_text(
                 "No plots were generated. Make sure your code creates plots and includes plt.show()."
             )
             return
         
-        # Send each plot as a photo
-        for plot_file in plot_files:
-            with open(plot_file, 'rb') as f:
-                await update.message.reply_photo(photo=f)
+        # Send the plots that were not streamed (all of them on a cache hit),
+        # after those whose streamed send failed, straight from memory,
+        # grouped into albums
+        unsent = stream.failed + images[stream.received:]
+        if unsent:
+            await send_images(update.message, unsent, context.bot_data["file_ids"], profile)
         
-        # Cleanup temporary files
-        for plot_file in plot_files:
-            try:
-                os.remove(plot_file)
-            except Exception as e:
-                logger.error(f"Error removing temporary file {plot_file}: {e}")
+        if preview:
+            await offer_full_resolution(update.message, context, code, full_profile)
     
     except Exception as e:
         await update.message.reply_text(f"An unexpected error occurred: {str(e)}")
@@ -123,26 +530,197 @@ async def process_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except Exception:
             pass
 
-def main():
-    # Setup font configuration
-    setup_font()
-    
-    # Get the token from environment variable
-    token = os.getenv("TELEGRAM_BOT_TOKEN")
-    if not token:
-        logger.error("No TELEGRAM_BOT_TOKEN environment variable found")
+async def process_blocks(update: Update, context: ContextTypes.DEFAULT_TYPE, blocks):
+    """Run all code blocks of a message as one batch and reply with the results in order.
+
+    There is no preview and no streaming here: every block is rendered with
+    the chat's settings and the replies follow once all blocks are done.
+    """
+    # A "# plot:" option in any block applies to the whole message
+    try:
+        profile = build_profile(context.user_data.get("render"), parse_directives("\n".join(blocks)))
+    except ValueError as e:
+        await update.message.reply_text(f"Error: {e}")
         return
     
-    # Create the Application
-    application = Application.builder().token(token).build()
+    processing_message = await update.message.reply_text(f"Processing your {len(blocks)} code blocks...")
+    
+    try:
+        results = await run_for_chat(update.message, context, blocks, profile)
+        for number, (images, error) in enumerate(results, 1):
+            if error:
+                await update.message.reply_text(f"Error in block {number}: {error}")
+            elif images:
+                await send_images(update.message, images, context.bot_data["file_ids"], profile)
+        
+        if not any(images or error for images, error in results):
+            await update.message.reply_text(
+                "No plots were generated. Make sure your code creates plots and includes plt.show()."
+            )
+    
+    except Exception as e:
+        await update.message.reply_text(f"An unexpected error occurred: {str(e)}")
+        logger.error(f"Unexpected error in process_blocks: {str(e)}")
+    
+    finally:
+        try:
+            await processing_message.delete()
+        except Exception:
+            pass
+
+def register_gauges(pool, result_cache, file_ids):
+    """Expose the state of the worker pool and caches on /metrics."""
+    metrics.Gauge("plotbot_queue_depth", "Jobs waiting for a free worker", lambda: pool.queue_depth)
+    metrics.Gauge("plotbot_busy_workers", "Workers executing a job", lambda: pool.busy_workers)
+    metrics.Gauge("plotbot_worker_utilization", "Fraction of workers executing a job",
+                  lambda: pool.busy_workers / pool.workers)
+    metrics.Gauge("plotbot_result_cache_hits_total", "Result cache hits", lambda: result_cache.hits, "counter")
+    metrics.Gauge("plotbot_result_cache_misses_total", "Result cache misses", lambda: result_cache.misses, "counter")
+    metrics.Gauge("plotbot_result_cache_hit_ratio", "Result cache hit ratio", lambda: result_cache.hit_ratio)
+    metrics.Gauge("plotbot_result_cache_bytes", "Image bytes in the memory cache", lambda: result_cache.stats()["bytes"])
+    metrics.Gauge("plotbot_file_ids", "Images remembered by Telegram file_id", lambda: len(file_ids))
+    metrics.Gauge("plotbot_sessions", "Resident session processes", lambda: len(pool.sessions))
+    metrics.Gauge("plotbot_session_memory_bytes", "Resident memory of all sessions", lambda: pool.sessions.memory)
+
+class KeepAliveRequest(HTTPXRequest):
+    """Bot API client that keeps idle connections open for TELEGRAM_KEEPALIVE seconds.
+
+    httpx closes them after 5 seconds by default, so a bot that is quiet
+    for a moment pays for a new TLS handshake on its next reply.
+    """
+
+    def _build_client(self) -> httpx.AsyncClient:
+        pool_size = self._client_kwargs["limits"].max_connections
+        self._client_kwargs["limits"] = httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=pool_size,
+            keepalive_expiry=config.TELEGRAM_KEEPALIVE,
+        )
+        return super()._build_client()
+
+def build_application(token, base_url=None, base_file_url=None):
+    """Start the worker pool and create the Application with all handlers.
+
+    ``base_url`` and ``base_file_url`` point the bot at another Bot API
+    server, such as the benchmark's fake_telegram server.
+    """
+    # Start the worker processes that execute plotting code
+    pool = WorkerPool()
+    pool.start()
+
+    file_ids = FileIdCache()
+    result_cache = ResultCache()
+    journal = JobJournal()
+    register_gauges(pool, result_cache, file_ids)
+
+    async def expire_sessions():
+        while True:
+            await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+            pool.sessions.expire_idle()
+
+    async def post_init(application):
+        application.bot_data["metrics_server"] = await metrics.start_server()
+        application.bot_data["session_sweeper"] = asyncio.get_running_loop().create_task(expire_sessions())
+        # Run the messages that the last stop interrupted again
+        for update in journal.pending_updates(application.bot):
+            logger.info(f"Replaying update {update.update_id} interrupted by the last stop")
+            await application.update_queue.put(update)
+
+    async def shutdown(application):
+        server = application.bot_data.get("metrics_server")
+        if server:
+            server.close()
+        sweeper = application.bot_data.get("session_sweeper")
+        if sweeper:
+            sweeper.cancel()
+        pool.shutdown()
+        file_ids.save()
+        result_cache.close()
+        journal.close()
+
+    # Create the Application; updates are handled concurrently so that one
+    # chat waiting for its plot does not hold up the others
+    request = KeepAliveRequest(
+        connection_pool_size=config.TELEGRAM_CONNECTION_POOL,
+        pool_timeout=config.TELEGRAM_POOL_TIMEOUT,
+    )
+    builder = Application.builder().token(token).request(request)
+    if base_url:
+        builder = builder.base_url(base_url).base_file_url(base_file_url)
+    application = (
+        builder
+        .concurrent_updates(config.UPDATE_CONCURRENCY)
+        .post_init(post_init)
+        .post_shutdown(shutdown)
+        .build()
+    )
+    application.bot_data["worker_pool"] = pool
+    application.bot_data["result_cache"] = result_cache
+    application.bot_data["file_ids"] = file_ids
+    application.bot_data["journal"] = journal
+    application.bot_data["profiling"] = profiling.ProfilingSettings()
     
     # Add handlers
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("dpi", dpi_command))
+    application.add_handler(CommandHandler("format", format_command))
+    application.add_handler(CommandHandler("document", document_command))
+    application.add_handler(CommandHandler("session", session_command))
+    application.add_handler(CommandHandler("reset", reset_command))
+    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("profile", profile_command))
+    application.add_handler(CallbackQueryHandler(full_resolution_button, pattern="^full:"))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, process_code))
+    return application
+
+async def run_bot(application):
+    """Run the bot until SIGINT or SIGTERM, on a webhook when a public URL is configured.
+
+    On the way down, updates stop coming in first, then the jobs in flight
+    get DRAIN_TIMEOUT seconds to finish; the rest are interrupted, to be
+    replayed from the journal after the restart.
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        if config.WEBHOOK_URL:
+            receiver = await webhook.start_webhook(application)
+        else:
+            receiver = None
+            await application.updater.start_polling()
+        await application.start()
+        try:
+            await stop.wait()
+        finally:
+            logger.info("Stopping: no new updates are taken")
+            if receiver:
+                await receiver.stop()
+            else:
+                await application.updater.stop()
+            await application.bot_data["journal"].drain(config.DRAIN_TIMEOUT)
+            await application.stop()
+    finally:
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+def main():
+    setup_logging()
+
+    # Get the token from environment variable
+    token = os.getenv("TELEGRAM_BOT_TOKEN")
+    if not token:
+        logger.error("No TELEGRAM_BOT_TOKEN environment variable found")
+        return
     
-    # Run the bot
-    application.run_polling()
+    asyncio.run(run_bot(build_application(token)))
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,244 @@
+import ast
+import hashlib
+import json
+import logging
+import os
+import pickle
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+def normalize_code(code: str) -> str:
+    """Normalize code so formatting-only differences map to the same text.
+
+    Comments, blank lines, indentation width and quoting style are dropped by
+    round-tripping through the AST. Code that does not parse is only stripped
+    of trailing whitespace and blank lines.
+    """
+    try:
+        return ast.unparse(ast.parse(code))
+    except (SyntaxError, ValueError):
+        lines = (line.rstrip() for line in code.strip().splitlines())
+        return "\n".join(line for line in lines if line)
+
+def cache_key(code: str, settings=(), normalized: Optional[str] = None) -> str:
+    """Content hash of normalized code together with the render settings.
+
+    Pass ``normalized`` when the normalized code is already known, to skip
+    parsing it again.
+    """
+    if normalized is None:
+        normalized = normalize_code(code)
+    digest = hashlib.sha256(normalized.encode("utf-8"))
+    digest.update(repr(settings).encode("utf-8"))
+    return digest.hexdigest()
+
+class ResultCache:
+    """Cache of rendered plot images keyed by cache_key().
+
+    Entries live in an in-memory LRU tier bounded by total image bytes and,
+    when a directory is given, in an on-disk tier that survives restarts.
+    Both tiers expire entries after ``ttl`` seconds. Entries are written to
+    disk, and the disk tier trimmed, by a background thread, so ``put`` never
+    waits for the disk; ``close`` waits for the writes still pending.
+    """
+
+    def __init__(self, max_bytes=None, ttl=None, directory=None, max_disk_bytes=None):
+        self.max_bytes = config.RESULT_CACHE_MB * 1024 * 1024 if max_bytes is None else max_bytes
+        self.ttl = config.RESULT_CACHE_TTL if ttl is None else ttl
+        self.directory = config.RESULT_CACHE_DIR if directory is None else directory
+        self.max_disk_bytes = config.RESULT_CACHE_DISK_MB * 1024 * 1024 if max_disk_bytes is None else max_disk_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (created_at, images, output, size)
+        self._size = 0
+        self._writer = None
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            # One thread, so writes and trims never race each other
+            self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cache-writer")
+
+    @property
+    def hit_ratio(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self) -> dict:
+        """Hit/miss counters and current size of the memory tier."""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hit_ratio,
+            "entries": len(self._entries),
+            "bytes": self._size,
+        }
+
+    def get(self, key: str) -> Optional[Tuple[List[bytes], str]]:
+        """Return the cached (images, output) for key, or None on a miss."""
+        entry = self._entries.get(key)
+        if entry and self._expired(entry[0]):
+            self._evict(key)
+            entry = None
+        if entry:
+            self._entries.move_to_end(key)
+        elif self.directory:
+            with metrics.timed("cache_read"):
+                entry = self._load(key)
+            if entry:
+                self._remember(key, *entry)
+
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[1], entry[2]
+
+    def put(self, key: str, images: List[bytes], output: str = ""):
+        """Store the result of a successful run."""
+        created_at = time.time()
+        self._remember(key, created_at, images, output)
+        if self._writer:
+            self._writer.submit(self._store, key, created_at, images, output)
+
+    def close(self):
+        """Finish the pending disk writes."""
+        if self._writer:
+            self._writer.shutdown(wait=True)
+
+    def _expired(self, created_at):
+        return self.ttl and time.time() - created_at > self.ttl
+
+    def _remember(self, key, created_at, images, output):
+        size = sum(len(image) for image in images)
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._evict(key)
+        self._entries[key] = (created_at, images, output, size)
+        self._size += size
+        while self._size > self.max_bytes:
+            self._evict(next(iter(self._entries)))
+
+    def _evict(self, key):
+        self._size -= self._entries.pop(key)[3]
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.pkl")
+
+    def _load(self, key):
+        path = self._path(key)
+        try:
+            if self._expired(os.path.getmtime(path)):
+                os.remove(path)
+                return None
+            with open(path, "rb") as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"Discarding unreadable cache entry {path}: {e}")
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+
+    def _store(self, key, created_at, images, output):
+        path = self._path(key)
+        try:
+            with metrics.timed("cache_write"):
+                # Write to a temporary name first so readers never see a partial entry
+                with open(f"{path}.tmp", "wb") as f:
+                    pickle.dump((created_at, images, output), f)
+                os.replace(f"{path}.tmp", path)
+                self._trim_disk()
+        except OSError as e:
+            logger.warning(f"Could not write cache entry {path}: {e}")
+
+    def _trim_disk(self):
+        """Delete the oldest on-disk entries until the tier fits its budget."""
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".pkl"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+class FileIdCache:
+    """Map from image content hash to the Telegram file_id it was uploaded as.
+
+    Sending a known image by file_id avoids uploading its bytes again. The map
+    is an LRU bounded to ``max_entries`` and is saved to a JSON file, when
+    one is configured, every ``save_every`` new entries and on shutdown.
+    """
+
+    def __init__(self, path=None, max_entries=None, save_every=50):
+        self.path = config.FILE_ID_CACHE_FILE if path is None else path
+        self.max_entries = config.FILE_ID_CACHE_SIZE if max_entries is None else max_entries
+        self.save_every = save_every
+        self._ids = OrderedDict()
+        self._unsaved = 0
+        if self.path:
+            self._load()
+
+    def __len__(self):
+        return len(self._ids)
+
+    @staticmethod
+    def image_key(image: bytes, kind: str) -> str:
+        # Photo and document file_ids are not interchangeable, so keep them apart
+        return f"{kind}:{hashlib.sha256(image).hexdigest()}"
+
+    def get(self, image: bytes, kind: str = "photo") -> Optional[str]:
+        """Return the file_id of an identical image previously sent as ``kind``."""
+        key = self.image_key(image, kind)
+        file_id = self._ids.get(key)
+        if file_id:
+            self._ids.move_to_end(key)
+        return file_id
+
+    def put(self, image: bytes, file_id: str, kind: str = "photo"):
+        self._ids[self.image_key(image, kind)] = file_id
+        while len(self._ids) > self.max_entries:
+            self._ids.popitem(last=False)
+        self._unsaved += 1
+        if self._unsaved >= self.save_every:
+            self.save()
+
+    def discard(self, image: bytes, kind: str = "photo"):
+        """Forget an image whose file_id Telegram no longer accepts."""
+        self._ids.pop(self.image_key(image, kind), None)
+
+    def save(self):
+        if not self.path:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(f"{self.path}.tmp", "w") as f:
+                json.dump(list(self._ids.items()), f)
+            os.replace(f"{self.path}.tmp", self.path)
+            self._unsaved = 0
+        except OSError as e:
+            logger.warning(f"Could not save file_id cache to {self.path}: {e}")
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                items = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable file_id cache {self.path}: {e}")
+            return
+        self._ids.update(items[-self.max_entries:])
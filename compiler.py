@@ -0,0 +1,207 @@
+import ast
+import hashlib
+import math
+from collections import OrderedDict
+from dataclasses import dataclass
+from types import CodeType
+from typing import List, Optional, Set, Tuple
+
+import config
+from safety import check_tree_safety, parse_code
+
+# File name shown in tracebacks of user code
+PLOT_FILENAME = '<plot>'
+
+# Name of the sandbox function that show() calls are rewritten to
+SHOW_HELPER = '__show__'
+
+# Error of a block that was not run because a block it depends on failed
+SKIPPED_BLOCK_ERROR = 'Not run because a block it depends on failed'
+
+# Static cost model: a plain plot costs 1 and these add to it
+MODULE_COSTS = {'pandas': 1, 'scipy': 2, 'seaborn': 2}
+LOOP_COST = 2
+FIGURE_COST = 0.5
+THREE_D_COST = 2
+# Numeric literals from this size on are taken as data sizes
+LARGE_NUMBER = 10_000
+
+@dataclass(frozen=True)
+class CompiledPlot:
+    """User code after the safety check, ready to run in the sandbox.
+
+    ``code`` is None when the code was rejected; ``error`` then says why.
+    ``normalized`` is the formatting-independent source used for cache keys
+    and ``cost`` the estimate used to schedule the job.
+    """
+    digest: str
+    normalized: str
+    code: Optional[CodeType] = None
+    error: Optional[str] = None
+    cost: float = 1.0
+
+def estimate_cost(tree: ast.Module) -> float:
+    """Rough relative cost of running a snippet, from its code alone.
+
+    Loops, heavy libraries, extra figures, 3D axes and large literal data
+    sizes each add to the cost of a single plain plot.
+    """
+    cost = 1.0
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.For, ast.While, ast.comprehension)):
+            cost += LOOP_COST
+        elif isinstance(node, ast.Import):
+            cost += sum(MODULE_COSTS.get(alias.name.split('.')[0], 0) for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module:
+            cost += MODULE_COSTS.get(node.module.split('.')[0], 0)
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute):
+            if node.func.attr in ('figure', 'subplots'):
+                cost += FIGURE_COST
+        elif isinstance(node, ast.Constant):
+            if node.value == '3d':
+                cost += THREE_D_COST
+            elif type(node.value) in (int, float) and node.value >= LARGE_NUMBER:
+                # 10k adds 1, each further factor of ten adds another
+                cost += math.log10(node.value / LARGE_NUMBER) + 1
+    return cost
+
+def _statement_names(statement: ast.stmt) -> Tuple[Set[str], Set[str]]:
+    """Names a top-level statement reads and names it binds.
+
+    Names bound inside functions and classes are their own; only the name
+    of the function or class itself is bound at the top level.
+    """
+    reads, binds = set(), set()
+    for node in ast.walk(statement):
+        if isinstance(node, ast.Name):
+            (reads if isinstance(node.ctx, ast.Load) else binds).add(node.id)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            binds.update((alias.asname or alias.name).split('.')[0] for alias in node.names)
+    if isinstance(statement, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+        binds = {statement.name}
+    return reads, binds
+
+def group_dependent_blocks(blocks: List[str]) -> List[List[int]]:
+    """Split the code blocks of one message into groups that can run independently.
+
+    A block depends on an earlier block when it reads a name before binding
+    it itself and the earlier block binds that name. Dependent blocks end up
+    in the same group, to be run in order in one namespace; blocks that do
+    not parse form groups of their own.
+
+    Returns:
+        Groups of block indices, each in order, ordered by their first block
+    """
+    groups: List[List[int]] = []
+    binders = {}
+    for index, block in enumerate(blocks):
+        try:
+            statements = ast.parse(block).body
+        except (SyntaxError, ValueError):
+            statements = []
+
+        free, bound = set(), set()
+        for statement in statements:
+            reads, binds = _statement_names(statement)
+            free |= reads - bound
+            bound |= binds
+
+        # Merge the groups of every earlier block this one needs
+        needed = [group for group in groups if any(binders.get(name) in group for name in free)]
+        group = sorted({i for earlier in needed for i in earlier} | {index})
+        groups = [earlier for earlier in groups if earlier not in needed] + [group]
+        for name in bound:
+            binders[name] = index
+    return sorted(groups)
+
+def _show_call_names(tree):
+    """Local names bound to matplotlib.pyplot.show by ``from ... import`` statements."""
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.ImportFrom) and node.module == 'matplotlib.pyplot':
+            names.update(alias.asname or alias.name for alias in node.names if alias.name == 'show')
+    return names
+
+def rewrite_show_calls(tree: ast.Module) -> ast.Module:
+    """Route every ``show()`` call through the sandbox's show helper, in place.
+
+    ``target.show(*args)`` becomes ``__show__(target, *args)`` and a bare
+    ``show()`` imported from pyplot becomes ``__show__()``. The helper decides
+    at run time what the target is, so ``plt.show()`` inside loops and
+    functions, aliased pyplot modules and ``fig.show()`` all render, while
+    unrelated objects with a show() method keep their own.
+    """
+    show_names = _show_call_names(tree)
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call):
+            continue
+        func = node.func
+        if isinstance(func, ast.Attribute) and func.attr == 'show':
+            node.args = [func.value, *node.args]
+        elif not (isinstance(func, ast.Name) and func.id in show_names):
+            continue
+        node.func = ast.copy_location(ast.Name(id=SHOW_HELPER, ctx=ast.Load()), func)
+    return tree
+
+def compile_tree(tree: ast.Module) -> CodeType:
+    """Rewrite show() calls and compile a parsed module."""
+    return compile(rewrite_show_calls(tree), PLOT_FILENAME, 'exec')
+
+def compile_source(code_string: str) -> CodeType:
+    """Parse and compile code without the safety check.
+
+    Raises:
+        SyntaxError: If the code does not parse
+    """
+    return compile_tree(ast.parse(code_string))
+
+# Compiled plots by hash of the exact text and by hash of the normalized text
+_compiled: 'OrderedDict[str, CompiledPlot]' = OrderedDict()
+
+def _remember(key, compiled):
+    _compiled[key] = compiled
+    _compiled.move_to_end(key)
+    # Each plot can be stored under two keys
+    while len(_compiled) > 2 * config.CODE_CACHE_SIZE:
+        _compiled.popitem(last=False)
+
+def _lookup(key):
+    compiled = _compiled.get(key)
+    if compiled:
+        _compiled.move_to_end(key)
+    return compiled
+
+def compile_plot_code(code_string: str) -> CompiledPlot:
+    """Safety-check and compile user code, parsing it only once.
+
+    The same tree is used for the safety analysis, the normalized cache key,
+    the show() rewrite and compilation. Results are kept in an LRU, so
+    resubmitting the same text skips all of that, and resubmitting it with
+    only formatting changes skips everything but the parse.
+    """
+    text_key = 'text:' + hashlib.sha256(code_string.encode('utf-8')).hexdigest()
+    compiled = _lookup(text_key)
+    if compiled:
+        return compiled
+
+    tree, error = parse_code(code_string)
+    if tree is None:
+        normalized = code_string.strip()
+        digest = hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+        compiled = CompiledPlot(digest, normalized, error=error)
+        _remember(text_key, compiled)
+        return compiled
+
+    normalized = ast.unparse(tree)
+    digest = hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+    compiled = _lookup(digest)
+    if compiled is None:
+        is_safe, error = check_tree_safety(tree)
+        if is_safe:
+            cost = estimate_cost(tree)
+            compiled = CompiledPlot(digest, normalized, code=compile_tree(tree), cost=cost)
+        else:
+            compiled = CompiledPlot(digest, normalized, error=error)
+        _remember(digest, compiled)
+    _remember(text_key, compiled)
+    return compiled
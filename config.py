@@ -0,0 +1,118 @@
+import os
+
+# Runtime settings for the bot, read from environment variables so they can
+# be tuned from the .env file without touching the code.
+
+def _env_int(name: str, default: int) -> int:
+    """Read an integer setting, falling back to the default when unset."""
+    value = os.getenv(name)
+    return int(value) if value else default
+
+def _env_ids(name: str) -> frozenset:
+    """Read a comma-separated list of Telegram user IDs."""
+    return frozenset(int(value) for value in os.getenv(name, "").split(",") if value.strip())
+
+# Number of worker processes that execute plotting code
+PLOT_WORKERS = _env_int("PLOT_WORKERS", os.cpu_count() or 1)
+
+# Maximum number of jobs waiting for a free worker before new ones are rejected
+PLOT_QUEUE_SIZE = _env_int("PLOT_QUEUE_SIZE", 4 * PLOT_WORKERS)
+
+# Jobs one chat may have running at once, and waiting on top of those
+PLOT_CHAT_CONCURRENCY = _env_int("PLOT_CHAT_CONCURRENCY", 1)
+PLOT_CHAT_QUEUE = _env_int("PLOT_CHAT_QUEUE", 3)
+
+# Snippets whose estimated cost is at most this take the fast lane
+FAST_LANE_MAX_COST = _env_int("FAST_LANE_MAX_COST", 3)
+
+# Wall-clock seconds a single plot job may take before it is killed
+PLOT_TIMEOUT = _env_int("PLOT_TIMEOUT", 30)
+
+# CPU seconds a single plot job may use before it is killed
+PLOT_CPU_LIMIT = _env_int("PLOT_CPU_LIMIT", 30)
+
+# Memory (MB) a single plot job may allocate on top of the warm worker's own
+PLOT_MEMORY_LIMIT_MB = _env_int("PLOT_MEMORY_LIMIT_MB", 1024)
+
+# In-memory result cache size (MB) and how long cached plots stay valid (seconds)
+RESULT_CACHE_MB = _env_int("RESULT_CACHE_MB", 64)
+RESULT_CACHE_TTL = _env_int("RESULT_CACHE_TTL", 24 * 3600)
+
+# Optional directory for a result cache that survives restarts, and its size (MB)
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", "")
+RESULT_CACHE_DISK_MB = _env_int("RESULT_CACHE_DISK_MB", 512)
+
+# Number of uploaded images remembered by Telegram file_id, and the JSON file
+# they are persisted to (not persisted when unset)
+FILE_ID_CACHE_SIZE = _env_int("FILE_ID_CACHE_SIZE", 10000)
+FILE_ID_CACHE_FILE = os.getenv("FILE_ID_CACHE_FILE", "")
+
+# Progressive delivery: "button" sends a quick low-DPI preview with a button
+# for the render in the user's settings, "auto" sends that render right after
+# the preview, and "off" (the default) sends only the render in the user's settings
+PREVIEW_MODE = os.getenv("PREVIEW_MODE", "off")
+
+# Number of processes a single job may use to render its figures in parallel.
+# Each of them gets the job's full CPU and memory limits, so more than one
+# lets a job use that many times its budget
+RENDER_PROCESSES = _env_int("RENDER_PROCESSES", 1)
+
+# Number of compiled user snippets kept so resubmitted code skips parsing and compiling
+CODE_CACHE_SIZE = _env_int("CODE_CACHE_SIZE", 256)
+
+# Local HTTP endpoint serving Prometheus metrics at /metrics (off when the port is 0)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = _env_int("METRICS_PORT", 0)
+
+# Telegram user IDs allowed to use admin commands such as /stats
+ADMIN_IDS = _env_ids("ADMIN_IDS")
+
+# Percentage of plot jobs profiled with cProfile and logged, and how many
+# hotspots each report lists
+PROFILE_SAMPLE_PERCENT = float(os.getenv("PROFILE_SAMPLE_PERCENT") or 0)
+PROFILE_TOP = _env_int("PROFILE_TOP", 15)
+
+# Webhook mode: when WEBHOOK_URL (the public HTTPS address Telegram posts
+# updates to) is set, the bot listens on WEBHOOK_LISTEN:WEBHOOK_PORT instead
+# of polling. Updates must carry WEBHOOK_SECRET (random per start when unset)
+# and Telegram opens at most WEBHOOK_MAX_CONNECTIONS connections at once
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = _env_int("WEBHOOK_PORT", 8443)
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_MAX_CONNECTIONS = _env_int("WEBHOOK_MAX_CONNECTIONS", 40)
+
+# Updates handled at the same time
+UPDATE_CONCURRENCY = _env_int("UPDATE_CONCURRENCY", 256)
+
+# Bot API client: connections kept to Telegram, seconds an idle one stays
+# open for reuse, and seconds a request waits for a free connection
+TELEGRAM_CONNECTION_POOL = _env_int("TELEGRAM_CONNECTION_POOL", 64)
+TELEGRAM_KEEPALIVE = _env_int("TELEGRAM_KEEPALIVE", 30)
+TELEGRAM_POOL_TIMEOUT = _env_int("TELEGRAM_POOL_TIMEOUT", 10)
+
+# Lines and scatters with more points than this are thinned out to what the
+# image can show before rendering (0 renders every point)
+DOWNSAMPLE_POINTS = _env_int("DOWNSAMPLE_POINTS", 50000)
+
+# Sessions (/session): most chats with a resident session process, seconds
+# an idle session is kept, and memory (MB) all sessions may use together
+SESSION_MAX = _env_int("SESSION_MAX", 4)
+SESSION_IDLE_TTL = _env_int("SESSION_IDLE_TTL", 15 * 60)
+SESSION_MEMORY_MB = _env_int("SESSION_MEMORY_MB", 2048)
+
+# JSONL file recording the code messages in flight, so that those interrupted
+# by a restart are run again afterwards (not recorded when unset), and seconds
+# a stopping bot waits for running jobs before interrupting them
+JOB_JOURNAL_FILE = os.getenv("JOB_JOURNAL_FILE", "")
+DRAIN_TIMEOUT = _env_int("DRAIN_TIMEOUT", 20)
+
+# Logging: level, file (besides stdout; none when empty), "json" lines or
+# "text", characters kept of each message and field such as a job's output,
+# and the percentage of high-volume INFO records (per-job records of
+# successful jobs, Telegram requests) that are written
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FILE = os.getenv("LOG_FILE", "logs/bot.log")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_FIELD_CHARS = _env_int("LOG_FIELD_CHARS", 2000)
+LOG_SAMPLE_PERCENT = float(os.getenv("LOG_SAMPLE_PERCENT") or 100)
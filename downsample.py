@@ -0,0 +1,133 @@
+import contextlib
+
+import numpy as np
+from matplotlib.collections import PathCollection
+from matplotlib.lines import Line2D
+
+import config
+import metrics
+
+# Line columns per output pixel; more than one leaves room for layout
+# engines that resize the axes while the figure is drawn
+COLUMNS_PER_PIXEL = 2
+
+# Dense markers closer than this fraction of their diameter are treated as
+# overlapping, and only the one drawn last (on top) is kept
+MARKER_CELL = 0.25
+
+_NO_STYLE = ('None', 'none', '', ' ', None)
+
+def column_extremes(columns: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """Indices of the points a polyline needs to look the same at pixel resolution.
+
+    For every run of consecutive points in the same column this keeps the
+    first, last, lowest and highest point (the M4 aggregation), so the
+    reduced line covers exactly the same pixels.
+    """
+    n = len(columns)
+    starts = np.flatnonzero(np.r_[True, columns[1:] != columns[:-1]])
+    lengths = np.diff(np.r_[starts, n])
+    index = np.arange(n)
+    lows = np.where(y == np.repeat(np.minimum.reduceat(y, starts), lengths), index, n)
+    highs = np.where(y == np.repeat(np.maximum.reduceat(y, starts), lengths), index, n)
+    keep = [starts, starts + lengths - 1, np.minimum.reduceat(lows, starts), np.minimum.reduceat(highs, starts)]
+    return np.unique(np.concatenate(keep))
+
+def topmost_per_cell(pixels: np.ndarray, cell: float) -> np.ndarray:
+    """Indices of the last point drawn in each cell of a grid, in drawing order."""
+    finite = np.flatnonzero(np.isfinite(pixels).all(axis=1))
+    if not len(finite):
+        return finite
+    cells = np.floor(pixels[finite] / cell).astype(np.int64)
+    cells -= cells.min(axis=0)
+    keys = cells[:, 0] * (cells[:, 1].max() + 1) + cells[:, 1]
+    _, last = np.unique(keys[::-1], return_index=True)
+    return np.sort(finite[len(finite) - 1 - last])
+
+def _reduce_line(line: Line2D, dpi: float):
+    """Reduce a long line in place. Returns a callable undoing it, or None."""
+    if line.get_drawstyle() != 'default':
+        return None
+    pixels = line.get_transform().transform(line.get_xydata()) * dpi / line.figure.dpi
+    has_line = line.get_linestyle() not in _NO_STYLE
+    has_markers = line.get_marker() not in _NO_STYLE
+    if has_line and not has_markers:
+        if not np.isfinite(pixels).all():
+            # NaNs break a line into pieces, which the aggregation would join
+            return None
+        keep = column_extremes(np.floor(pixels[:, 0] * COLUMNS_PER_PIXEL), pixels[:, 1])
+    elif has_markers and not has_line:
+        diameter = line.get_markersize() * dpi / 72
+        keep = topmost_per_cell(pixels, max(1.0, diameter * MARKER_CELL))
+    else:
+        return None
+
+    x, y = line.get_xdata(orig=True), line.get_ydata(orig=True)
+    line.set_data(np.asarray(x)[keep], np.asarray(y)[keep])
+    return lambda: line.set_data(x, y)
+
+def _reduce_scatter(collection: PathCollection, dpi: float):
+    """Drop scatter markers hidden under others. Returns a callable undoing it, or None."""
+    offsets = collection.get_offsets()
+    sizes = collection.get_sizes()
+    if len(sizes) > 1 or len(collection.get_linewidths()) > 1:
+        return None
+    # Translucent markers add up where they overlap, so none may be dropped
+    if collection.get_alpha() not in (None, 1) or any(
+            len(colors) and (np.asarray(colors)[:, 3] < 1).any()
+            for colors in (collection.get_facecolor(), collection.get_edgecolor())):
+        return None
+
+    pixels = collection.get_offset_transform().transform(offsets) * dpi / collection.figure.dpi
+    diameter = np.sqrt(sizes[0] if len(sizes) else 36) * dpi / 72
+    keep = topmost_per_cell(pixels, max(1.0, diameter * MARKER_CELL))
+
+    values = collection.get_array()
+    facecolors, edgecolors = collection.get_facecolor(), collection.get_edgecolor()
+    collection.set_offsets(offsets[keep])
+    if values is not None:
+        # Fix the colour scale to the full data before dropping any of it
+        collection.autoscale_None()
+        collection.set_array(values[keep])
+    elif len(facecolors) == len(offsets):
+        collection.set_facecolor(facecolors[keep])
+    if values is None and len(edgecolors) == len(offsets):
+        collection.set_edgecolor(edgecolors[keep])
+
+    def restore():
+        collection.set_offsets(offsets)
+        if values is not None:
+            collection.set_array(values)
+        elif len(facecolors) == len(offsets):
+            collection.set_facecolor(facecolors)
+        if values is None and len(edgecolors) == len(offsets):
+            collection.set_edgecolor(edgecolors)
+    return restore
+
+@contextlib.contextmanager
+def downsampled(fig, dpi, enabled=True):
+    """Temporarily thin out lines and scatters with more points than can be seen.
+
+    Lines and marker series longer than DOWNSAMPLE_POINTS are reduced to the
+    points that still make a visible difference when the figure is drawn at
+    ``dpi``; everything is restored on exit.
+    """
+    threshold = config.DOWNSAMPLE_POINTS
+    undo = []
+    if enabled and threshold:
+        with metrics.timed('downsample'):
+            for ax in fig.axes:
+                # Apply pending autoscaling so the data-to-pixel transform is final
+                ax.viewLim
+                for line in ax.lines:
+                    if len(line.get_xdata(orig=True)) > threshold:
+                        undo.append(_reduce_line(line, dpi))
+                for collection in ax.collections:
+                    if isinstance(collection, PathCollection) and len(collection.get_offsets()) > threshold:
+                        undo.append(_reduce_scatter(collection, dpi))
+    try:
+        yield
+    finally:
+        for restore in reversed(undo):
+            if restore:
+                restore()
@@ -0,0 +1,262 @@
+import asyncio
+import email.parser
+import email.policy
+import itertools
+import json
+import logging
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# Identity the fake server reports for the bot
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "PlotBot", "username": "plot_bot"}
+
+class FakeTelegramServer:
+    """Local stand-in for the Telegram Bot API, for offline load tests.
+
+    Point the bot at ``base_url`` and ``file_url`` and it polls this server
+    for updates and sends its replies here. Incoming messages are injected
+    with send_message(), which resolves once the bot has finished handling
+    the message, i.e. when it deletes its "Processing..." reply, as
+    process_code always does last. Every send request and every delivery
+    of updates can be delayed by ``latency`` seconds to mimic the network.
+
+    Once the bot calls setWebhook, updates are posted to the webhook
+    instead of being returned by getUpdates. Requests can be made to fail
+    by adding the number of failures to ``failures`` per method.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.requests = Counter()
+        # Methods called, in order
+        self.calls: List[str] = []
+        self.bytes_received = 0
+        self.photos_sent = Counter()
+        self.failures = Counter()
+        # Seconds from each message being sent to the bot's first reply to it,
+        # and to the first image in reply to it
+        self.first_replies: List[float] = []
+        self.first_images: List[float] = []
+        self._server = None
+        self._updates: List[dict] = []
+        self._new_update = asyncio.Event()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+        self._done: Dict[int, asyncio.Future] = {}
+        # Futures resolving at the bot's first reply to each chat's last message
+        self.replied: Dict[int, asyncio.Future] = {}
+        self._sent_at: Dict[int, float] = {}
+        self._awaiting_image: Dict[int, float] = {}
+        self._webhook: Optional[dict] = None
+        self._client: Optional[httpx.AsyncClient] = None
+        self._deliveries = set()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}/bot"
+
+    @property
+    def file_url(self) -> str:
+        return f"http://{self.host}:{self.port}/file/bot"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"Fake Telegram API listening on {self.base_url}")
+
+    async def stop(self):
+        # Release long polls that are still waiting for updates
+        self._new_update.set()
+        if self._client:
+            await self._client.aclose()
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+
+    def send_message(self, chat_id: int, text: str) -> asyncio.Future:
+        """Deliver a user message to the bot.
+
+        Returns:
+            Future resolving when the bot has finished handling the message
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._done[chat_id] = future
+        self.replied[chat_id] = asyncio.get_running_loop().create_future()
+        self._sent_at[chat_id] = self._awaiting_image[chat_id] = time.perf_counter()
+        update = {
+            "update_id": next(self._update_ids),
+            "message": {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private", "first_name": f"User {chat_id}"},
+                "from": {"id": chat_id, "is_bot": False, "first_name": f"User {chat_id}"},
+                "text": text,
+            },
+        }
+        if self._webhook:
+            delivery = asyncio.get_running_loop().create_task(self._post_update(update))
+            self._deliveries.add(delivery)
+            delivery.add_done_callback(self._deliveries.discard)
+        else:
+            self._updates.append(update)
+            self._new_update.set()
+        return future
+
+    async def _post_update(self, update):
+        if self._client is None:
+            self._client = httpx.AsyncClient(limits=httpx.Limits(
+                max_connections=self._webhook["max_connections"]))
+        await asyncio.sleep(self.latency)
+        response = await self._client.post(
+            self._webhook["url"], json=update,
+            headers={"X-Telegram-Bot-Api-Secret-Token": self._webhook["secret_token"]})
+        if response.status_code != 200:
+            logger.error(f"Webhook answered update {update['update_id']} with {response.status_code}")
+
+    # HTTP plumbing
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = (await reader.readline()).decode("latin-1").strip()
+                    if not line:
+                        break
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await self._read_body(reader, headers)
+                method = request_line.split()[1].decode().rsplit("/", 1)[-1]
+                if self.failures[method]:
+                    self.failures[method] -= 1
+                    status = b"400 Bad Request"
+                    response = {"ok": False, "error_code": 400, "description": "Bad Request: injected failure"}
+                else:
+                    status = b"200 OK"
+                    response = {"ok": True, "result": await self._dispatch(method, headers.get("content-type", ""), body)}
+                payload = json.dumps(response).encode()
+                writer.write(
+                    b"HTTP/1.1 " + status + b"\r\nContent-Type: application/json\r\n"
+                    + f"Content-Length: {len(payload)}\r\n\r\n".encode() + payload
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_body(self, reader, headers):
+        if "content-length" in headers:
+            return await reader.readexactly(int(headers["content-length"]))
+        if headers.get("transfer-encoding") == "chunked":
+            body = b""
+            while True:
+                size = int((await reader.readline()).strip(), 16)
+                chunk = await reader.readexactly(size + 2)
+                if not size:
+                    return body
+                body += chunk[:-2]
+        return b""
+
+    def _parse(self, content_type, body):
+        """Request parameters, with uploaded files as bytes."""
+        self.bytes_received += len(body)
+        if content_type.startswith("multipart/form-data"):
+            message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+                f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+            params = {}
+            for part in message.iter_parts():
+                name = part.get_param("name", header="content-disposition")
+                content = part.get_payload(decode=True)
+                params[name] = content if part.get_filename() else content.decode()
+            return params
+        if content_type.startswith("application/json"):
+            return json.loads(body or b"{}")
+        return {name: values[0] for name, values in parse_qs(body.decode()).items()}
+
+    # Bot API methods
+    def _message(self, chat_id, **fields):
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            "from": BOT_USER,
+            **fields,
+        }
+
+    def _photo(self):
+        file_id = f"photo-{next(self._file_ids)}"
+        return [{"file_id": file_id, "file_unique_id": file_id, "width": 1280, "height": 960}]
+
+    async def _dispatch(self, method, content_type, body):
+        params = self._parse(content_type, body)
+        self.requests[method] += 1
+        self.calls.append(method)
+        if method == "getUpdates":
+            return await self._get_updates(int(params.get("offset") or 0), float(params.get("timeout") or 0))
+        if method == "getMe":
+            return BOT_USER
+        if method == "setWebhook":
+            self._webhook = {
+                "url": params["url"],
+                "secret_token": params.get("secret_token", ""),
+                "max_connections": int(params.get("max_connections") or 40),
+            }
+            return True
+        if method == "deleteWebhook":
+            self._webhook = None
+            return True
+        if method.startswith("send") or method in ("editMessageText", "deleteMessage"):
+            await asyncio.sleep(self.latency)
+
+        chat_id = params.get("chat_id", 0)
+        sent_at = self._sent_at.pop(int(chat_id), None)
+        if sent_at is not None:
+            self.first_replies.append(time.perf_counter() - sent_at)
+            self.replied[int(chat_id)].set_result(time.perf_counter())
+        if method in ("sendPhoto", "sendDocument", "sendMediaGroup"):
+            sent_at = self._awaiting_image.pop(int(chat_id), None)
+            if sent_at is not None:
+                self.first_images.append(time.perf_counter() - sent_at)
+        if method == "sendMessage":
+            return self._message(chat_id, text=params.get("text", ""))
+        if method == "editMessageText":
+            return self._message(chat_id, text=params.get("text", ""))
+        if method == "sendPhoto":
+            self.photos_sent[int(chat_id)] += 1
+            return self._message(chat_id, photo=self._photo())
+        if method == "sendDocument":
+            file_id = f"document-{next(self._file_ids)}"
+            return self._message(chat_id, document={"file_id": file_id, "file_unique_id": file_id})
+        if method == "sendMediaGroup":
+            media = json.loads(params["media"])
+            self.photos_sent[int(chat_id)] += len(media)
+            return [self._message(chat_id, photo=self._photo()) for _ in media]
+        if method == "deleteMessage":
+            future = self._done.pop(int(chat_id), None)
+            if future and not future.done():
+                future.set_result(time.perf_counter())
+        return True
+
+    async def _get_updates(self, offset, timeout) -> Optional[list]:
+        self._updates = [update for update in self._updates if update["update_id"] >= offset]
+        if not self._updates and timeout:
+            self._new_update.clear()
+            try:
+                await asyncio.wait_for(self._new_update.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        if self._updates:
+            await asyncio.sleep(self.latency)
+        return self._updates[:100]
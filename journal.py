@@ -0,0 +1,179 @@
+import asyncio
+import json
+import logging
+import os
+from collections import OrderedDict
+from typing import Awaitable, Dict, List, Optional
+
+from telegram import Update
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Finished update ids remembered to recognize updates delivered again, e.g.
+# the ones Telegram resends after a restart because their offset was never
+# confirmed
+REMEMBERED_UPDATES = 10000
+
+# Runs a job gets before it is given up on, so a message that takes the
+# whole bot down is not replayed after every restart
+MAX_ATTEMPTS = 3
+
+class JobJournal:
+    """Record of the code messages the bot has accepted and finished, by update id.
+
+    Handlers run their work through run(), which records the update before
+    and after. Updates seen before are turned away, so a redelivered update
+    is not rendered twice, and drain() can interrupt the work still running
+    when the bot stops. With a ``path``, the journal is also appended to a
+    JSONL file: updates that were begun but not finished when the bot
+    stopped are returned by pending_updates() on the next start, to be run
+    again.
+    """
+
+    def __init__(self, path=None):
+        self.path = config.JOB_JOURNAL_FILE if path is None else path
+        # Accepted, unfinished updates by id, with the number of runs so far
+        self._records: Dict[int, dict] = {}
+        self._running: Dict[int, Optional[asyncio.Task]] = {}
+        self._done: 'OrderedDict[int, None]' = OrderedDict()
+        self._file = None
+        self._lines = 0
+        if self.path:
+            self._load()
+            self._compact()
+
+    def begin(self, update: Update) -> bool:
+        """Take on an update, unless it was handled before or is being handled.
+
+        Returns:
+            Whether the caller should handle the update
+        """
+        update_id = update.update_id
+        if update_id in self._done or update_id in self._running:
+            logger.info(f"Skipping update {update_id}, which was delivered before")
+            return False
+        attempts = self._records.get(update_id, {}).get("attempts", 0) + 1
+        if attempts > MAX_ATTEMPTS:
+            logger.warning(f"Giving up on update {update_id} after {MAX_ATTEMPTS} interrupted runs")
+            self.finish(update_id)
+            return False
+
+        self._records[update_id] = {"id": update_id, "attempts": attempts, "update": update.to_dict()}
+        self._running[update_id] = None
+        self._write(self._records[update_id])
+        return True
+
+    async def run(self, update: Update, job: Awaitable):
+        """Await ``job``, the handling of ``update``, unless the update was handled before.
+
+        The job runs as a task of its own, so drain() can interrupt it without
+        cancelling the handler that called run(). An interrupted job is left
+        unfinished in the journal.
+        """
+        if not self.begin(update):
+            job.close()
+            return
+        task = asyncio.ensure_future(job)
+        self._running[update.update_id] = task
+        try:
+            await asyncio.wait({task})
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        if task.cancelled():
+            self._running.pop(update.update_id, None)
+            return
+        self.finish(update.update_id)
+        task.result()
+
+    def finish(self, update_id: int):
+        """Mark an update as handled, so it is neither replayed nor handled again."""
+        self._records.pop(update_id, None)
+        self._running.pop(update_id, None)
+        self._done[update_id] = None
+        while len(self._done) > REMEMBERED_UPDATES:
+            self._done.popitem(last=False)
+        self._write({"id": update_id, "done": True})
+
+    def pending_updates(self, bot) -> List[Update]:
+        """Updates that were begun before the last stop but never finished, oldest first."""
+        return [Update.de_json(record["update"], bot) for update_id, record in sorted(self._records.items())
+                if update_id not in self._running]
+
+    async def drain(self, timeout):
+        """Wait up to ``timeout`` seconds for the updates in flight, then cancel the rest.
+
+        Cancelled updates stay in the journal and are replayed after the restart.
+        """
+        tasks = {task for task in self._running.values() if task}
+        if not tasks:
+            return
+        logger.info(f"Waiting up to {timeout}s for {len(tasks)} jobs in flight")
+        _, unfinished = await asyncio.wait(tasks, timeout=timeout)
+        if unfinished:
+            logger.warning(f"Interrupting {len(unfinished)} jobs; they run again after the restart")
+            for task in unfinished:
+                task.cancel()
+            await asyncio.wait(unfinished)
+
+    def close(self):
+        if self._file:
+            self._compact()
+            self._file.close()
+            self._file = None
+
+    def _write(self, entry):
+        if not self._file:
+            return
+        try:
+            self._file.write(json.dumps(entry) + "\n")
+            self._file.flush()
+            self._lines += 1
+        except OSError as e:
+            logger.warning(f"Could not write to the job journal {self.path}: {e}")
+        # Every job adds two lines; only the unfinished ones need to stay
+        if self._lines > 2 * REMEMBERED_UPDATES:
+            self._compact()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A line cut short when the bot was killed
+                        continue
+                    if entry.get("done"):
+                        self._records.pop(entry["id"], None)
+                        self._done[entry["id"]] = None
+                    else:
+                        self._records[entry["id"]] = entry
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Ignoring unreadable job journal {self.path}: {e}")
+        while len(self._done) > REMEMBERED_UPDATES:
+            self._done.popitem(last=False)
+        if self._records:
+            logger.info(f"{len(self._records)} jobs were interrupted by the last stop")
+
+    def _compact(self):
+        """Rewrite the journal with only the unfinished updates and the remembered ids."""
+        if self._file:
+            self._file.close()
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(f"{self.path}.tmp", "w") as f:
+                for update_id in self._done:
+                    f.write(json.dumps({"id": update_id, "done": True}) + "\n")
+                for record in self._records.values():
+                    f.write(json.dumps(record) + "\n")
+            os.replace(f"{self.path}.tmp", self.path)
+            self._lines = len(self._done) + len(self._records)
+            self._file = open(self.path, "a")
+        except OSError as e:
+            logger.warning(f"Could not write the job journal {self.path}, jobs are not journaled: {e}")
+            self._file = None
@@ -0,0 +1,144 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+
+import config
+
+# Rotation of the log file: bytes per file and number of old files kept
+LOG_FILE_BYTES = 10 * 1024 * 1024
+LOG_FILE_BACKUPS = 5
+
+# Records waiting for the writer thread; further records are dropped rather
+# than making the event loop wait for a slow disk
+LOG_QUEUE_SIZE = 10000
+
+# Attributes of a record, passed with ``extra``, that are written as fields
+FIELDS = ("job_id", "chat_id", "update_id", "seconds", "timings", "images", "error_type", "output", "error")
+
+# Loggers that log every request at INFO, whose INFO records are sampled
+SAMPLED_LOGGERS = ("httpx",)
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+def truncate(text: str, limit: int) -> str:
+    """Shorten text to ``limit`` characters, saying how much was cut."""
+    if limit and len(text) > limit:
+        return f"{text[:limit]}... [{len(text) - limit} more characters]"
+    return text
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with the FIELDS a record carries and long values cut short."""
+
+    def __init__(self, field_chars=None):
+        super().__init__()
+        self.field_chars = config.LOG_FIELD_CHARS if field_chars is None else field_chars
+
+    def format(self, record) -> str:
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)) + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": truncate(record.getMessage(), self.field_chars),
+        }
+        for field in FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = truncate(value, self.field_chars) if isinstance(value, str) else value
+        if record.exc_info:
+            entry["exception"] = truncate(self.formatException(record.exc_info), self.field_chars)
+        return json.dumps(entry, default=str)
+
+class TruncatingFormatter(logging.Formatter):
+    """The plain text format, with long messages cut short."""
+
+    def __init__(self, field_chars=None):
+        super().__init__(TEXT_FORMAT)
+        self.field_chars = config.LOG_FIELD_CHARS if field_chars is None else field_chars
+
+    def format(self, record) -> str:
+        return truncate(super().format(record), 4 * self.field_chars)
+
+class SamplingFilter(logging.Filter):
+    """Keeps ``percent`` of the high-volume INFO records and all others.
+
+    High-volume records are those logged with ``extra={"sampled": True}``
+    and the INFO records of SAMPLED_LOGGERS.
+    """
+
+    def __init__(self, percent=None):
+        super().__init__()
+        self.percent = config.LOG_SAMPLE_PERCENT if percent is None else percent
+
+    def filter(self, record) -> bool:
+        if record.levelno > logging.INFO or self.percent >= 100:
+            return True
+        if getattr(record, "sampled", False) or record.name.split(".")[0] in SAMPLED_LOGGERS:
+            return random.random() * 100 < self.percent
+        return True
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the writer thread without formatting or ever blocking.
+
+    Formatting, tracebacks included, is left to the writer thread; when its
+    queue is full, records are dropped and counted in ``dropped``.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # The record stays in this process, so it does not need to be made picklable
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def setup_logging(level=None, log_file=None, log_format=None) -> logging.handlers.QueueListener:
+    """Route all logging through a queue to a background thread that writes it.
+
+    Records go to stdout and, when ``log_file`` is set, to a rotating file,
+    as JSON lines or as text depending on ``log_format``. The writer thread
+    is stopped, after writing what is queued, when the process exits.
+
+    Returns:
+        The listener running the writer thread
+    """
+    level = level or config.LOG_LEVEL
+    log_file = config.LOG_FILE if log_file is None else log_file
+    log_format = log_format or config.LOG_FORMAT
+    formatter = JsonFormatter() if log_format == "json" else TruncatingFormatter()
+
+    handlers = [logging.StreamHandler(sys.stdout)]
+    if log_file:
+        os.makedirs(os.path.dirname(log_file) or ".", exist_ok=True)
+        handlers.append(logging.handlers.RotatingFileHandler(
+            log_file, maxBytes=LOG_FILE_BYTES, backupCount=LOG_FILE_BACKUPS))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    queue_handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    queue_handler.addFilter(SamplingFilter())
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(level)
+
+    listener = logging.handlers.QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+
+    def stop():
+        # Stopping twice fails, and the caller may have stopped it already
+        if listener._thread:
+            listener.stop()
+
+    atexit.register(stop)
+    return listener
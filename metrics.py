@@ -0,0 +1,177 @@
+import asyncio
+import bisect
+import contextlib
+import logging
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class _Metric:
+    """Base of the metric types; values are kept per label value."""
+    kind = ''
+
+    def __init__(self, name: str, help: str, label: Optional[str] = None):
+        self.name = name
+        self.help = help
+        self.label = label
+        _registry.append(self)
+
+    def _labels(self, value):
+        return f'{{{self.label}="{value}"}}' if self.label else ''
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+class Counter(_Metric):
+    """Monotonically increasing count, e.g. of bytes or errors."""
+    kind = 'counter'
+
+    def __init__(self, name, help, label=None):
+        super().__init__(name, help, label)
+        self.values: Dict[str, float] = {}
+
+    def inc(self, amount=1, label=''):
+        self.values[label] = self.values.get(label, 0) + amount
+
+    def lines(self) -> List[str]:
+        return [f"{self.name}{self._labels(label)} {value}" for label, value in sorted(self.values.items())]
+
+class Gauge(_Metric):
+    """Value read from a callback each time the metrics are collected."""
+    kind = 'gauge'
+
+    def __init__(self, name, help, callback: Callable[[], float], kind='gauge'):
+        super().__init__(name, help)
+        self.callback = callback
+        self.kind = kind
+
+    def lines(self) -> List[str]:
+        try:
+            return [f"{self.name} {self.callback()}"]
+        except Exception as e:
+            logger.warning(f"Could not collect {self.name}: {e}")
+            return []
+
+class Histogram(_Metric):
+    """Cumulative-bucket histogram of observed values, per label value."""
+    kind = 'histogram'
+
+    def __init__(self, name, help, label=None, buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, label)
+        self.buckets = tuple(buckets)
+        self.values: Dict[str, Tuple[List[int], float]] = {}  # label -> (bucket counts, sum)
+
+    def observe(self, value, label=''):
+        counts, total = self.values.get(label) or ([0] * (len(self.buckets) + 1), 0.0)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.values[label] = (counts, total + value)
+
+    def quantile(self, q, label='') -> float:
+        """Upper bound of the bucket holding the q-quantile (inf past the last bucket)."""
+        counts = self.values[label][0]
+        rank = q * sum(counts)
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def lines(self) -> List[str]:
+        lines = []
+        for label, (counts, total) in sorted(self.values.items()):
+            prefix = f'{self.label}="{label}",' if self.label else ''
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{self._labels(label)} {total}")
+            lines.append(f"{self.name}_count{self._labels(label)} {cumulative}")
+        return lines
+
+_registry: List[_Metric] = []
+
+PHASE_SECONDS = Histogram('plotbot_phase_seconds', 'Time spent in each phase of handling a request', 'phase')
+BYTES_UPLOADED = Counter('plotbot_uploaded_bytes_total', 'Image bytes uploaded to Telegram')
+ERRORS = Counter('plotbot_errors_total', 'Plot requests that failed, by error type', 'type')
+REQUESTS = Counter('plotbot_requests_total', 'Plot requests received')
+REJECTED = Counter('plotbot_rejected_total', 'Plot requests turned away because the queue was full')
+
+@contextlib.contextmanager
+def timed(phase: str):
+    """Record how long the block takes as one observation of a phase."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        PHASE_SECONDS.observe(time.perf_counter() - start, phase)
+
+# Sandbox processes time their phases locally and send the observations back
+def reset():
+    """Forget phase timings, e.g. in a forked child before it runs a job."""
+    PHASE_SECONDS.values.clear()
+
+def snapshot() -> dict:
+    """Phase timings recorded in this process, for merge() in another."""
+    return PHASE_SECONDS.values
+
+def merge(values: dict):
+    """Add phase timings sent back by a sandbox process."""
+    for label, (counts, total) in values.items():
+        mine, my_total = PHASE_SECONDS.values.get(label) or ([0] * len(counts), 0.0)
+        PHASE_SECONDS.values[label] = ([a + b for a, b in zip(mine, counts)], my_total + total)
+
+def phase_summary() -> List[str]:
+    """One line per phase with its count, mean and approximate 95th percentile."""
+    lines = []
+    for phase, (counts, total) in sorted(PHASE_SECONDS.values.items()):
+        count = sum(counts)
+        p95 = PHASE_SECONDS.quantile(0.95, phase)
+        lines.append(f"{phase}: {count}x, mean {total / count * 1000:.0f} ms, p95 <= {p95 * 1000:.0f} ms")
+    return lines
+
+def render_prometheus() -> str:
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in _registry:
+        body = metric.lines()
+        if body:
+            lines += metric.header() + body
+    return "\n".join(lines) + "\n"
+
+async def _handle_request(reader, writer):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        # Skip the headers, the request has no body we care about
+        while (await asyncio.wait_for(reader.readline(), 5)).strip():
+            pass
+        if request_line.split()[1:2] == [b"/metrics"]:
+            status, body = "200 OK", render_prometheus()
+        else:
+            status, body = "404 Not Found", "Not found\n"
+        payload = body.encode("utf-8")
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode("ascii") + payload
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError, IndexError):
+        pass
+    finally:
+        writer.close()
+
+async def start_server(host=None, port=None) -> Optional[asyncio.AbstractServer]:
+    """Serve /metrics over HTTP, unless METRICS_PORT is 0."""
+    host = config.METRICS_HOST if host is None else host
+    port = config.METRICS_PORT if port is None else port
+    if not port:
+        return None
+    server = await asyncio.start_server(_handle_request, host, port)
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,97 @@
+import cProfile
+import io
+import os
+import pstats
+import random
+import re
+import sys
+from collections import OrderedDict
+from typing import Optional
+
+import config
+from compiler import PLOT_FILENAME
+
+# How many profile reports are kept for the chats that asked for them
+MAX_REPORTS = 100
+
+# Reports for chats with profiling switched on, waiting to be sent
+_reports: 'OrderedDict[object, str]' = OrderedDict()
+
+class ProfilingSettings:
+    """Admin switch for job profiling: chats that profile every job, plus a
+    percentage of all other jobs that is profiled and logged."""
+
+    def __init__(self, sample_percent=None):
+        self.chats = set()
+        self.sample_percent = config.PROFILE_SAMPLE_PERCENT if sample_percent is None else sample_percent
+
+    def should_profile(self, chat_id) -> bool:
+        if chat_id in self.chats:
+            return True
+        return bool(self.sample_percent) and random.random() * 100 < self.sample_percent
+
+def _package(filename, function):
+    """Which library a profiled Python function belongs to (None for C functions)."""
+    if filename == PLOT_FILENAME:
+        return "user code"
+    if filename == "~":
+        # C methods of extension types name their module, e.g. "<method 'draw_path'
+        # of 'matplotlib.backends._backend_agg.RendererAgg' objects>"
+        match = re.search(r"of '(\w+)\.", function)
+        if not match:
+            return None
+        module = match.group(1)
+        return "python" if module in sys.stdlib_module_names else module.lstrip("_")
+    parts = filename.replace(os.sep, "/").split("/site-packages/")
+    if len(parts) > 1:
+        return parts[1].split("/")[0].removesuffix(".py")
+    return "python"
+
+def _time_by_package(stats: pstats.Stats):
+    """Own time per library. Other C functions count towards their main caller's library."""
+    by_package = {}
+    for (filename, _, function), (_, _, own_time, _, callers) in stats.stats.items():
+        package = _package(filename, function)
+        if package is None:
+            caller = max(callers.items(), key=lambda item: item[1][2], default=None)
+            package = (_package(caller[0][0], caller[0][2]) if caller else None) or "builtins"
+        by_package[package] = by_package.get(package, 0.0) + own_time
+    return by_package
+
+def run_profiled(func, *args):
+    """Call func under cProfile.
+
+    Returns:
+        Tuple of (func's result, text report)
+    """
+    profiler = cProfile.Profile()
+    result = profiler.runcall(func, *args)
+    return result, format_report(pstats.Stats(profiler))
+
+def format_report(stats: pstats.Stats, top=None) -> str:
+    """Time per library followed by the functions with the most own time."""
+    top = config.PROFILE_TOP if top is None else top
+    by_package = _time_by_package(stats)
+    lines = [f"Profiled {stats.total_tt:.3f} s", "Time by library:"]
+    for package, seconds in sorted(by_package.items(), key=lambda item: -item[1])[:top]:
+        if seconds < 0.0005:
+            break
+        lines.append(f"  {package:<20} {seconds:8.3f} s")
+
+    stream = io.StringIO()
+    stats.stream = stream
+    stats.strip_dirs().sort_stats("tottime").print_stats(top)
+    # Drop the pstats preamble, keep the table
+    table = stream.getvalue()
+    lines += ["", table[table.find("ncalls"):].rstrip()]
+    return "\n".join(lines)
+
+def store_report(chat_id, report: str):
+    """Keep a report for a chat until take_report() collects it."""
+    _reports[chat_id] = report
+    _reports.move_to_end(chat_id)
+    while len(_reports) > MAX_REPORTS:
+        _reports.popitem(last=False)
+
+def take_report(chat_id) -> Optional[str]:
+    return _reports.pop(chat_id, None)
@@ -0,0 +1,135 @@
+import importlib
+import io
+import re
+from dataclasses import dataclass, replace
+from typing import Dict
+
+import metrics
+
+# Image formats the bot can produce, with the file extension used for each
+FORMATS = {'png': 'png', 'jpeg': 'jpg', 'webp': 'webp'}
+
+# Accepted DPI range for user overrides
+MIN_DPI = 50
+MAX_DPI = 600
+
+@dataclass(frozen=True)
+class RenderProfile:
+    """How figures are encoded before they are sent to the user.
+
+    ``dpi`` is an upper bound: when ``max_pixels`` is set, the DPI is lowered
+    so the longest side of the figure stays within that many pixels.
+    ``downsample`` thins out series with more points than the image can show.
+    """
+    format: str = 'png'
+    dpi: int = 300
+    max_pixels: int = 0
+    quality: int = 90         # JPEG/WebP quality
+    compress_level: int = 6   # PNG zlib level, lower is faster but larger
+    as_document: bool = False
+    downsample: bool = True
+
+    @property
+    def extension(self) -> str:
+        return FORMATS[self.format]
+
+# Built-in profiles. Telegram shows photos at no more than 2560 pixels on the
+# longest side and recompresses them, so rendering photos bigger than that
+# only costs encode and upload time.
+PROFILES = {
+    'photo': RenderProfile(format='png', dpi=300, max_pixels=2560),
+    'document': RenderProfile(format='png', dpi=300, as_document=True),
+}
+
+# Resolution of the quick render sent first when progressive delivery is on
+PREVIEW_DPI = 100
+PREVIEW_MAX_PIXELS = 1280
+
+DEFAULT_PROFILE = PROFILES['photo']
+
+def figure_dpi(fig, profile: RenderProfile) -> float:
+    """DPI to render a figure at under the profile's pixel budget."""
+    if not profile.max_pixels:
+        return profile.dpi
+    longest_side = max(fig.get_size_inches())
+    return min(profile.dpi, profile.max_pixels / longest_side)
+
+def render_figure(fig, profile: RenderProfile = DEFAULT_PROFILE) -> bytes:
+    """Encode a matplotlib figure according to a render profile."""
+    if profile.format == 'png':
+        pil_kwargs = {'compress_level': profile.compress_level}
+    else:
+        pil_kwargs = {'quality': profile.quality}
+
+    # Looked up on first use, since the bot process uses the profiles but
+    # never renders; through importlib, as an import statement here would go
+    # through the sandbox's import restrictions
+    downsampled = importlib.import_module('downsample').downsampled
+
+    buffer = io.BytesIO()
+    dpi = figure_dpi(fig, profile)
+    with downsampled(fig, dpi, profile.downsample), metrics.timed('savefig'):
+        fig.savefig(buffer, format=profile.format, dpi=dpi,
+                    bbox_inches='tight', pil_kwargs=pil_kwargs)
+    return buffer.getvalue()
+
+def validate_overrides(overrides: Dict[str, object]) -> Dict[str, object]:
+    """Check user-supplied profile overrides.
+
+    Raises:
+        ValueError: If a value is out of range or unknown
+    """
+    if 'dpi' in overrides:
+        dpi = int(overrides['dpi'])
+        if not MIN_DPI <= dpi <= MAX_DPI:
+            raise ValueError(f"DPI must be between {MIN_DPI} and {MAX_DPI}")
+        overrides['dpi'] = dpi
+    if 'format' in overrides:
+        fmt = str(overrides['format']).lower().replace('jpg', 'jpeg')
+        if fmt not in FORMATS:
+            raise ValueError(f"Format must be one of: {', '.join(FORMATS)}")
+        overrides['format'] = fmt
+    return overrides
+
+def parse_directives(code: str) -> Dict[str, object]:
+    """Read per-message overrides from a ``# plot: dpi=150 format=jpeg document`` comment.
+
+    ``exact`` turns off downsampling of huge series for the message.
+
+    Raises:
+        ValueError: If the directive contains an invalid value
+    """
+    match = re.search(r'^\s*#\s*plot:(.*)$', code, re.MULTILINE)
+    if not match:
+        return {}
+
+    overrides = {}
+    for option in match.group(1).split():
+        name, _, value = option.partition('=')
+        if name == 'document':
+            overrides['as_document'] = True
+        elif name == 'photo':
+            overrides['as_document'] = False
+        elif name == 'exact':
+            overrides['downsample'] = False
+        elif name in ('dpi', 'format') and value:
+            overrides[name] = value
+        else:
+            raise ValueError(f"Unknown plot option: {option}")
+    return validate_overrides(overrides)
+
+def preview_profile(profile: RenderProfile):
+    """The user's profile at preview resolution, sent as a photo.
+
+    Returns None when the profile is no bigger than a preview anyway.
+    """
+    max_pixels = min(profile.max_pixels or PREVIEW_MAX_PIXELS, PREVIEW_MAX_PIXELS)
+    if profile.dpi <= PREVIEW_DPI and max_pixels == profile.max_pixels:
+        return None
+    return replace(profile, dpi=min(profile.dpi, PREVIEW_DPI), max_pixels=max_pixels, as_document=False)
+
+def build_profile(user_overrides=None, message_overrides=None) -> RenderProfile:
+    """Combine the default profile with per-user and per-message overrides."""
+    overrides = {**(user_overrides or {}), **(message_overrides or {})}
+    base = PROFILES['document'] if overrides.get('as_document') else DEFAULT_PROFILE
+    return replace(base, **overrides)
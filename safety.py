@@ -0,0 +1,317 @@
+import ast
+import importlib.machinery
+import importlib.util
+import os
+import re
+import string
+import sys
+from functools import lru_cache
+from typing import Dict, Optional, Set, Tuple
+
+# List of allowed modules for the sandbox
+ALLOWED_MODULES = {
+    'matplotlib', 'matplotlib.pyplot', 'matplotlib.font_manager',
+    'matplotlib.transforms', 'matplotlib.patches', 'matplotlib.lines',
+    'matplotlib.colors', 'matplotlib.cm', 'matplotlib.ticker',
+    'matplotlib.dates', 'matplotlib.gridspec', 'matplotlib.axes',
+    'matplotlib.backends', 'matplotlib.backend_bases',
+    'numpy', 'pandas', 'scipy', 'seaborn', 'math', 'random',
+    'datetime', 'collections', 'itertools', 'functools',
+    'os.path', 're', 'json', 'csv',
+    # Core Python modules needed by matplotlib
+    '_io', 'io', 'sys', 'os', 'warnings', 'weakref', 'gc',
+    'threading', 'time', 'struct', 'array', 'ctypes',
+    'pickle', 'copyreg', 'copy', 'types', 'operator'
+}
+
+# List of forbidden functions/attributes
+FORBIDDEN_ATTRIBUTES = {
+    'eval', 'exec', 'compile', 'globals', 'locals', 'open',
+    '__import__', 'import_module', 'system', 'popen', 'subprocess',
+    'os.system', 'os.popen', 'os.spawn', 'os.exec', 'subprocess.run',
+    'subprocess.call', 'subprocess.Popen', 'pty.spawn', 'importlib.import_module'
+}
+
+# Allowed modules that matplotlib needs internally but user code may not import
+INTERNAL_ONLY_MODULES = frozenset({'_io', 'gc', 'ctypes', 'pickle', 'copyreg', 'types'})
+
+# Built-in names that give user code a way around the other rules
+FORBIDDEN_NAMES = frozenset({
+    'eval', 'exec', 'compile', 'globals', 'locals', 'vars', 'open', '__import__',
+    'getattr', 'setattr', 'delattr', 'breakpoint', 'input', '__builtins__',
+})
+
+# Attribute names with no plotting use, forbidden whatever object they are on:
+# the undotted FORBIDDEN_ATTRIBUTES, except 'compile', which is also re.compile
+# (the builtin is caught by FORBIDDEN_NAMES), and more of the same kind
+FORBIDDEN_ATTRIBUTE_NAMES = frozenset(
+    {name for name in FORBIDDEN_ATTRIBUTES if '.' not in name} - {'compile'}
+) | frozenset({
+    'Popen', 'modules', 'fork', 'forkpty', 'kill', 'killpg', 'unlink', 'rmdir', 'removedirs',
+    'chmod', 'chown', 'symlink', 'putenv', 'ctypes', 'attrgetter', 'methodcaller',
+    # Frames and code objects lead to the globals of the sandbox itself
+    'f_globals', 'f_locals', 'f_back', 'f_builtins', 'gi_frame', 'cr_frame', 'ag_frame',
+    'tb_frame', 'tb_next', 'gi_code',
+})
+FORBIDDEN_ATTRIBUTE_PATTERN = re.compile(r'^(spawn|posix_spawn|exec[lv]|co_)')
+
+# A replacement field that looks up an attribute or item, e.g. {m.os} or {d[key]}
+_ATTRIBUTE_FIELD = re.compile(r'\.[A-Za-z_]|\[')
+
+# Dunder names user code may still use
+ALLOWED_DUNDERS = frozenset({'__init__', '__name__', '__doc__', '__version__', '__file__'})
+
+# For these modules only the listed attributes may be used
+RESTRICTED_MODULES: Dict[str, frozenset] = {
+    'os': frozenset({'path', 'sep', 'linesep', 'curdir', 'pardir', 'extsep'}),
+    'sys': frozenset({'version', 'version_info', 'platform', 'float_info', 'maxsize', 'byteorder'}),
+    'io': frozenset({'BytesIO', 'StringIO'}),
+}
+
+# Submodules of allowed packages that load native code or run programs
+FORBIDDEN_SUBMODULES = (
+    'numpy.ctypeslib', 'numpy.f2py', 'numpy.distutils', 'numpy.testing',
+    'matplotlib.testing', 'pandas.testing', 'pandas.io.clipboard', 'pandas.io.clipboards',
+    'scipy._lib',
+)
+
+# Names of the modules an attribute may turn out to be, e.g. matplotlib.os:
+# the standard library and the allowed packages
+MODULE_NAMES = frozenset(sys.stdlib_module_names) | {module.split('.')[0] for module in ALLOWED_MODULES}
+
+# Dotted forms of FORBIDDEN_ATTRIBUTES, matched against resolved names
+_FORBIDDEN_DOTTED = tuple(name for name in FORBIDDEN_ATTRIBUTES if '.' in name)
+
+def _is_forbidden_submodule(name: str) -> bool:
+    return any(name == module or name.startswith(f"{module}.") for module in FORBIDDEN_SUBMODULES)
+
+def is_allowed_module(name: str) -> bool:
+    """Whether a module may be imported, as itself or as a submodule of an allowed module."""
+    if _is_forbidden_submodule(name):
+        return False
+    return name in ALLOWED_MODULES or any(name.startswith(f"{module}.") for module in ALLOWED_MODULES)
+
+@lru_cache(maxsize=1024)
+def is_package_submodule(name: str) -> bool:
+    """Whether a dotted name is a module file or directory inside its top-level
+    package, e.g. scipy.signal, found without importing the package."""
+    root, _, rest = name.partition('.')
+    try:
+        spec = importlib.util.find_spec(root)
+    except (ImportError, ValueError):
+        return False
+    if not rest or spec is None or not spec.submodule_search_locations:
+        return False
+    for location in spec.submodule_search_locations:
+        path = os.path.join(location, *rest.split('.'))
+        if os.path.isdir(path) or any(os.path.exists(path + suffix)
+                                      for suffix in importlib.machinery.all_suffixes()):
+            return True
+    return False
+
+def _is_forbidden_dunder(name: str) -> bool:
+    return name.startswith('__') and name.endswith('__') and name not in ALLOWED_DUNDERS
+
+def _is_forbidden_module_name(name: str) -> bool:
+    """Whether an attribute name is a module user code may not reach as an attribute."""
+    return name in MODULE_NAMES and (name in INTERNAL_ONLY_MODULES or name in RESTRICTED_MODULES
+                                     or not is_allowed_module(name))
+
+def has_attribute_fields(template: str) -> bool:
+    """Whether a str.format template looks up attributes or items of its arguments."""
+    try:
+        fields = [field for _, field, _, _ in string.Formatter().parse(template) if field]
+    except ValueError:
+        return False
+    return any(_ATTRIBUTE_FIELD.search(field) for field in fields)
+
+class UnsafeCode(Exception):
+    """Raised by the analyzer at the first rule violation."""
+
+class SafetyAnalyzer:
+    """Single walk over the AST that rejects imports, names and attributes
+    user code has no business touching.
+
+    Import aliases are tracked so that attribute chains are resolved to their
+    module path: ``import os as o; o.system`` is checked as ``os.system``.
+    Attribute chains are resolved after the walk, once every import is known.
+    A module may only be used to look up its attributes, never as a value, so
+    it cannot reach code under a name the analyzer does not track.
+    """
+
+    def __init__(self):
+        self.aliases: Dict[str, str] = {}
+        # Aliases bound to modules rather than to functions or classes
+        self.modules: Set[str] = set()
+        # Name nodes that are the base of an attribute lookup
+        self.bases: Set[int] = set()
+        self.handlers = {
+            ast.Name: self.visit_Name,
+            ast.Attribute: self.visit_Attribute,
+            ast.Import: self.visit_Import,
+            ast.ImportFrom: self.visit_ImportFrom,
+            ast.Call: self.visit_Call,
+            ast.Constant: self.visit_Constant,
+        }
+
+    def analyze(self, tree):
+        """Check a parsed module, raising UnsafeCode at the first violation."""
+        handlers = self.handlers
+        attributes, names = [], []
+        for node in ast.walk(tree):
+            handler = handlers.get(type(node))
+            if handler and handler(node):
+                (attributes if isinstance(node, ast.Attribute) else names).append(node)
+
+        for node in names:
+            if node.id in self.modules and id(node) not in self.bases:
+                self.fail(node, 'suspicious pattern', f"module {node.id} used as a value")
+        for node in attributes:
+            dotted = self.resolve(node) if self.aliases else None
+            if dotted:
+                self.check_dotted(node, dotted)
+            elif isinstance(node.ctx, ast.Load) and _is_forbidden_module_name(node.attr):
+                self.fail(node, 'forbidden import', node.attr)
+
+    def fail(self, node, kind, name):
+        raise UnsafeCode(f"Code contains {kind}: {name} (line {getattr(node, 'lineno', '?')})")
+
+    def resolve(self, node) -> Optional[str]:
+        """Dotted module path of a Name/Attribute chain rooted at an import."""
+        if isinstance(node, ast.Name):
+            return self.aliases.get(node.id)
+        if isinstance(node, ast.Attribute):
+            base = self.resolve(node.value)
+            return f"{base}.{node.attr}" if base else None
+        return None
+
+    def check_module(self, node, module):
+        if module.split('.')[0] in INTERNAL_ONLY_MODULES or not is_allowed_module(module):
+            self.fail(node, 'forbidden import', module)
+
+    def check_dotted(self, node, dotted):
+        for forbidden in _FORBIDDEN_DOTTED:
+            if dotted == forbidden or dotted.startswith(forbidden):
+                self.fail(node, 'forbidden function', dotted)
+        module, _, attribute = dotted.partition('.')
+        allowed = RESTRICTED_MODULES.get(module)
+        if allowed is not None and attribute and attribute.split('.')[0] not in allowed:
+            self.fail(node, 'forbidden function', dotted)
+        self.check_reached_modules(node, dotted)
+
+    def check_reached_modules(self, node, dotted):
+        """Reject modules reached as attributes of other modules.
+
+        A package's own submodules, like scipy.signal, follow the import rules.
+        Any other module name in the chain, like the os in matplotlib.os, is a
+        module the package imported for itself and must be an allowed, plain
+        module; the restricted ones are only usable through their own import.
+        """
+        parts = dotted.split('.')
+        for index in range(1, len(parts)):
+            path = '.'.join(parts[:index + 1])
+            if _is_forbidden_submodule(path):
+                self.fail(node, 'forbidden import', path)
+            if _is_forbidden_module_name(parts[index]) and not is_package_submodule(path):
+                self.fail(node, 'forbidden import', path)
+
+    def check_attribute_name(self, node, name):
+        if name in FORBIDDEN_ATTRIBUTE_NAMES or FORBIDDEN_ATTRIBUTE_PATTERN.match(name):
+            self.fail(node, 'forbidden function', name)
+        # Private and dunder attributes are where the ways around the rules start
+        if name.startswith('_') and name not in ALLOWED_DUNDERS:
+            self.fail(node, 'suspicious pattern', name)
+
+    def check_template(self, node, template):
+        if has_attribute_fields(template):
+            self.fail(node, 'suspicious pattern', f"attribute lookup in format string {template!r}")
+
+    def visit_Import(self, node):
+        for alias in node.names:
+            self.check_module(node, alias.name)
+            if alias.asname:
+                self.aliases[alias.asname] = alias.name
+                self.modules.add(alias.asname)
+            else:
+                root = alias.name.split('.')[0]
+                self.aliases[root] = root
+                self.modules.add(root)
+
+    def visit_ImportFrom(self, node):
+        if node.level:
+            self.fail(node, 'forbidden import', '.' * node.level + (node.module or ''))
+        self.check_module(node, node.module)
+        for alias in node.names:
+            if alias.name == '*':
+                if node.module in RESTRICTED_MODULES:
+                    self.fail(node, 'forbidden import', f"{node.module}.*")
+                continue
+            dotted = f"{node.module}.{alias.name}"
+            self.check_attribute_name(node, alias.name)
+            self.check_dotted(node, dotted)
+            self.aliases[alias.asname or alias.name] = dotted
+            if dotted in ALLOWED_MODULES or is_package_submodule(dotted):
+                self.modules.add(alias.asname or alias.name)
+
+    def visit_Attribute(self, node):
+        self.check_attribute_name(node, node.attr)
+        if isinstance(node.value, ast.Name):
+            self.bases.add(id(node.value))
+        # Every attribute is resolved once all imports are known
+        return True
+
+    def visit_Name(self, node):
+        # Assigning to a name like 'input' is harmless; reading the builtin is not
+        if node.id in FORBIDDEN_NAMES and not isinstance(node.ctx, ast.Store):
+            self.fail(node, 'forbidden function', node.id)
+        if _is_forbidden_dunder(node.id):
+            self.fail(node, 'suspicious pattern', node.id)
+        # Checked against the module aliases after the walk
+        return isinstance(node.ctx, ast.Load)
+
+    def visit_Call(self, node):
+        # A format template can look up attributes of what it is given, so
+        # only literal templates, which are checked as constants, may be used
+        func = node.func
+        if isinstance(func, ast.Attribute) and func.attr in ('format', 'format_map'):
+            if not (isinstance(func.value, ast.Constant) and isinstance(func.value.value, str)):
+                self.fail(node, 'suspicious pattern', f"{func.attr}() on a template that is not a literal")
+
+    def visit_Constant(self, node):
+        # Literal templates are also handed to formatters such as StrMethodFormatter
+        if isinstance(node.value, str) and '{' in node.value:
+            self.check_template(node, node.value)
+
+def check_tree_safety(tree: ast.AST) -> Tuple[bool, Optional[str]]:
+    """Check an already parsed module. Returns (is_safe, error_message)."""
+    try:
+        SafetyAnalyzer().analyze(tree)
+    except UnsafeCode as e:
+        return False, str(e)
+    return True, None
+
+def parse_code(code_string: str) -> Tuple[Optional[ast.Module], Optional[str]]:
+    """Parse user code.
+
+    Returns:
+        Tuple of (tree, error_message); tree is None when the code does not parse
+    """
+    try:
+        return ast.parse(code_string), None
+    except SyntaxError as e:
+        return None, f"SyntaxError: {e.msg} (line {e.lineno})"
+    except ValueError as e:
+        return None, f"SyntaxError: {e}"
+
+# Function to check code for potentially harmful operations
+@lru_cache(maxsize=1024)
+def check_code_safety(code_string: str) -> Tuple[bool, Optional[str]]:
+    """Check user code before it is executed. Results are memoized per code string.
+
+    Returns:
+        Tuple of (is_safe, error_message)
+    """
+    tree, error = parse_code(code_string)
+    if tree is None:
+        return False, error
+    return check_tree_safety(tree)
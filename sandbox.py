@@ -1,67 +1,131 @@
 import os
 import sys
-import tempfile
 import traceback
 import contextlib
 import io
 import matplotlib
 import matplotlib.pyplot as plt
 import matplotlib.font_manager as fm
+import matplotlib.ticker as ticker
 import builtins
 import importlib
 import logging
+from functools import partial
+from multiprocessing.connection import Pipe
+from matplotlib.figure import Figure
+import config
+# Loaded by render_figure on first use; imported here, before any user code
+# runs under the import restrictions
+import downsample  # noqa: F401
+import metrics
+from compiler import SHOW_HELPER, SKIPPED_BLOCK_ERROR, compile_source
+from render import DEFAULT_PROFILE, render_figure
+from safety import ALLOWED_MODULES, FORBIDDEN_ATTRIBUTES, check_code_safety, has_attribute_fields, is_allowed_module
 
 logger = logging.getLogger(__name__)
 
-# List of allowed modules for the sandbox
-ALLOWED_MODULES = {
-    'matplotlib', 'matplotlib.pyplot', 'matplotlib.font_manager',
-    'matplotlib.transforms', 'matplotlib.patches', 'matplotlib.lines',
-    'matplotlib.colors', 'matplotlib.cm', 'matplotlib.ticker',
-    'matplotlib.dates', 'matplotlib.gridspec', 'matplotlib.axes',
-    'matplotlib.backends', 'matplotlib.backend_bases',
-    'numpy', 'pandas', 'scipy', 'seaborn', 'math', 'random',
-    'datetime', 'collections', 'itertools', 'functools',
-    'os.path', 're', 'json', 'csv',
-    # Core Python modules needed by matplotlib
-    '_io', 'io', 'sys', 'os', 'warnings', 'weakref', 'gc',
-    'threading', 'time', 'struct', 'array', 'ctypes',
-    'pickle', 'copyreg', 'copy', 'types', 'operator'
-}
-
-# List of forbidden functions/attributes
-FORBIDDEN_ATTRIBUTES = {
-    'eval', 'exec', 'compile', 'globals', 'locals', 'open',
-    '__import__', 'import_module', 'system', 'popen', 'subprocess',
-    'os.system', 'os.popen', 'os.spawn', 'os.exec', 'subprocess.run',
-    'subprocess.call', 'subprocess.Popen', 'pty.spawn', 'importlib.import_module'
-}
+# Heavy allowed modules that sandbox workers import once, before any job runs
+PRELOAD_MODULES = ['numpy', 'pandas', 'scipy', 'scipy.stats', 'seaborn',
+                   # Imported lazily by DataFrame.plot() through importlib.metadata and
+                   # bare __import__ calls the allow-list cannot trace back to pandas
+                   'importlib.metadata', 'pandas.plotting._matplotlib', 'matplotlib.pylab']
 
-# Restricted import function
-def restricted_import(name, globals=None, locals=None, fromlist=(), level=0):
-    # Allow relative imports within matplotlib
-    if level > 0 and globals and globals.get('__package__', '').startswith('matplotlib'):
+# Packages whose own (often lazy) internal imports bypass the allow-list
+TRUSTED_PACKAGES = {'matplotlib', 'numpy', 'pandas', 'scipy', 'seaborn'}
+
+def _imported_by_trusted_package(frame):
+    """Whether the frame runs code of a module of one of the TRUSTED_PACKAGES.
+
+    The frame's globals must be the namespace of that module itself, so
+    code cannot pass itself off as a library by setting ``__package__``.
+    """
+    module = sys.modules.get(frame.f_globals.get('__name__'))
+    return (module is not None and getattr(module, '__dict__', None) is frame.f_globals
+            and module.__name__.split('.')[0] in TRUSTED_PACKAGES)
+
+def _make_restricted_import(original_import):
+    """Wrap __import__ so that code run in the sandbox only imports allowed modules.
+
+    The original is kept in the closure rather than in a global of this
+    module, where sandboxed code might find it.
+    """
+    def restricted_import(name, globals=None, locals=None, fromlist=(), level=0):
+        # Allow imports made by the plotting libraries themselves, including relative ones
+        if _imported_by_trusted_package(sys._getframe(1)):
+            return original_import(name, globals, locals, fromlist, level)
+
+        # Check if the module is in allowed list or is a submodule of an allowed module
+        if not is_allowed_module(name):
+            # Special case for matplotlib submodules that might be imported with different paths
+            if name.startswith('matplotlib.'):
+                return original_import(name, globals, locals, fromlist, level)
+            raise ImportError(f"Import of module '{name}' is not allowed in the sandbox")
+
+        # Use the original __import__ function for allowed modules
         return original_import(name, globals, locals, fromlist, level)
+
+    return restricted_import
+
+# Restricted import function
+restricted_import = _make_restricted_import(builtins.__import__)
+
+# Serif fonts of the plots, in order of preference
+SERIF_FONTS = ['Times New Roman', 'Liberation Serif', 'DejaVu Serif', 'serif']
+
+_matplotlib_configured = False
+
+def configure_matplotlib():
+    """Select the Agg backend and the serif plot fonts, once per process."""
+    global _matplotlib_configured
+    if _matplotlib_configured:
+        return
     
-    # Check if the module is in allowed list or is a submodule of an allowed module
-    if name not in ALLOWED_MODULES and not any(name.startswith(f"{module}.") for module in ALLOWED_MODULES):
-        # Special case for matplotlib submodules that might be imported with different paths
-        if name.startswith('matplotlib.') or (globals and globals.get('__package__', '').startswith('matplotlib')):
-            return original_import(name, globals, locals, fromlist, level)
-        raise ImportError(f"Import of module '{name}' is not allowed in the sandbox")
+    # Configure matplotlib for non-interactive backend
+    matplotlib.use('Agg')
+    
+    # Configure font: serif, falling back to Liberation Serif where Times New Roman is missing
+    font_path = '/usr/share/fonts/truetype/msttcorefonts/Times_New_Roman.ttf'
+    if os.path.exists(font_path):
+        fm.fontManager.addfont(font_path)
+    plt.rcParams['font.family'] = 'serif'
+    plt.rcParams['font.serif'] = SERIF_FONTS
+
+    # Tick templates can be computed at runtime, out of reach of the static check
+    format_tick = ticker.StrMethodFormatter.__call__
+
+    def guarded_format_tick(self, x, pos=None):
+        if has_attribute_fields(self.fmt):
+            raise ValueError(f"Attribute lookup in tick format {self.fmt!r} is not allowed")
+        return format_tick(self, x, pos)
+
+    ticker.StrMethodFormatter.__call__ = guarded_format_tick
     
-    # Use the original __import__ function for allowed modules
-    return original_import(name, globals, locals, fromlist, level)
+    _matplotlib_configured = True
 
-# Capture the original __import__ function
-original_import = builtins.__import__
+def warm_up():
+    """Preload heavy modules and warm the font cache and Agg renderer.
+    
+    Called once in each sandbox worker so that the jobs forked from it start
+    with everything already imported and initialised.
+    """
+    for module in PRELOAD_MODULES:
+        try:
+            importlib.import_module(module)
+        except ImportError as e:
+            logger.warning(f"Could not preload {module}: {e}")
+    
+    configure_matplotlib()
+    
+    # Draw and rasterize a throwaway figure so the serif font lookup and Agg are initialised
+    fig, ax = plt.subplots(figsize=(1, 1))
+    ax.plot([0, 1], [0, 1])
+    ax.set_title('warm-up')
+    fig.savefig(io.BytesIO(), format='png')
+    plt.close(fig)
 
 # Context manager for the sandbox environment
 @contextlib.contextmanager
 def sandbox_environment():
-    # Create a temporary directory for plots
-    temp_dir = tempfile.mkdtemp()
-    
     # Save original settings
     original_import_func = builtins.__import__
     original_stdout = sys.stdout
@@ -79,17 +143,11 @@ def sandbox_environment():
         sys.stdout = stdout_capture
         sys.stderr = stderr_capture
         
-        # Configure matplotlib for non-interactive backend
-        matplotlib.use('Agg')
+        # Configure matplotlib (a no-op in warmed-up workers)
+        configure_matplotlib()
         
-        # Configure font
-        font_path = '/usr/share/fonts/truetype/msttcorefonts/Times_New_Roman.ttf'
-        if os.path.exists(font_path):
-            fm.fontManager.addfont(font_path)
-            plt.rcParams['font.family'] = 'Times New Roman'
-        
-        # Yield the temporary directory and capture objects
-        yield temp_dir, stdout_capture, stderr_capture
+        # Yield the capture objects
+        yield stdout_capture, stderr_capture
         
     finally:
         # Restore original settings
@@ -100,81 +158,159 @@ def sandbox_environment():
         # Close all matplotlib figures
         plt.close('all')
 
+def render_in_parallel(figures, profile, processes):
+    """Render figures concurrently in forked children, preserving their order.
+    
+    Each child inherits the figures copy-on-write, renders every
+    ``processes``-th one into its own buffers and sends the bytes back. Entries
+    are None for figures a child failed to deliver.
+    """
+    images = [None] * len(figures)
+    children = []
+    for offset in range(processes):
+        reader, writer = Pipe(duplex=False)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                reader.close()
+                metrics.reset()
+                rendered = [(index, render_figure(figures[index], profile))
+                            for index in range(offset, len(figures), processes)]
+                writer.send((rendered, metrics.snapshot()))
+            finally:
+                os._exit(0)
+        writer.close()
+        children.append((pid, reader))
+    
+    for pid, reader in children:
+        try:
+            rendered, timings = reader.recv()
+            metrics.merge(timings)
+            for index, image in rendered:
+                images[index] = image
+        except EOFError:
+            pass
+        finally:
+            reader.close()
+            os.waitpid(pid, 0)
+    return images
+
+def render_open_figures(images, profile=DEFAULT_PROFILE):
+    """Render every open figure to image bytes, append them to images and close them.
+    
+    This stands in for plt.show(): like a real show, the figures are gone
+    afterwards, so a later plt.show() only renders the figures created since.
+    Several figures are rendered in parallel when RENDER_PROCESSES allows it.
+    """
+    figures = [plt.figure(num) for num in plt.get_fignums()]
+    processes = min(len(figures), config.RENDER_PROCESSES)
+    if processes > 1 and hasattr(os, 'fork'):
+        rendered = render_in_parallel(figures, profile, processes)
+    else:
+        rendered = [None] * len(figures)
+    
+    # Anything not rendered in parallel is rendered here, which also
+    # reports a failing figure with its real error
+    for figure, image in zip(figures, rendered):
+        images.append(image if image is not None else render_figure(figure, profile))
+    plt.close('all')
+
+def show(images, profile, target=plt, *args, **kwargs):
+    """Stand-in for show() calls in user code, which are rewritten to call this.
+    
+    Showing pyplot renders every open figure and showing a single figure
+    renders just that one; any other object's show() is called as usual.
+    """
+    if target is plt:
+        render_open_figures(images, profile)
+    elif isinstance(target, Figure):
+        images.append(render_figure(target, profile))
+        plt.close(target)
+    else:
+        return target.show(*args, **kwargs)
+
+def streaming_show(on_images, profile, *args, **kwargs):
+    """show() that hands the images of each call to on_images right away."""
+    images = []
+    result = show(images, profile, *args, **kwargs)
+    if images:
+        on_images(images)
+    return result
+
 # Function to execute plotting code safely
-def execute_plot_code(code_string):
-    plot_files = []
+def execute_plot_code(code, profile=DEFAULT_PROFILE, namespace=None, on_images=None):
+    """Execute plotting code in the sandbox.
+    
+    Args:
+        code: The user's plotting code, as text or as compiled by compile_plot_code
+        profile: RenderProfile the figures are encoded with
+        namespace: Globals to run the code in, kept by sessions between jobs
+            (a fresh namespace when None)
+        on_images: Called with the images of each show() as soon as they are
+            rendered; these are then left out of the returned images
+        
+    Returns:
+        Tuple of (images, output, error) where images is a list of encoded images
+    """
+    images = []
     output = ""
     error = None
     
-    with sandbox_environment() as (temp_dir, stdout_capture, stderr_capture):
+    with sandbox_environment() as (stdout_capture, stderr_capture):
         try:
-            # Create a restricted namespace for code execution
-            namespace = {
+            # Create a restricted namespace for code execution, or add
+            # whatever is missing to a session's namespace
+            namespace = {} if namespace is None else namespace
+            for name, value in {
                 'plt': plt,
                 'matplotlib': matplotlib,
                 'np': None,  # Will be imported by user code if needed
                 'pd': None,  # Will be imported by user code if needed
-                'temp_dir': temp_dir,  # Make temp_dir available to the code
                 '__name__': '__main__',
                 '__file__': None,
-            }
+            }.items():
+                namespace.setdefault(name, value)
+            if on_images:
+                namespace[SHOW_HELPER] = partial(streaming_show, on_images, profile)
+            else:
+                namespace[SHOW_HELPER] = partial(show, images, profile)
             
-            # Modify the code to save figures instead of showing them
-            modified_code = code_string.replace(
-                "plt.show()", 
-                """\nfor i, fig in enumerate(plt.get_fignums()):\n    fig_obj = plt.figure(i+1)\n    file_path = f'{temp_dir}/plot_{i+1}.png'\n    fig_obj.savefig(file_path, dpi=300, bbox_inches='tight')\n    print(f'Saved plot to {file_path}')\n"""
-            )
+            # Compiling rewrites show() calls to render figures to memory instead
+            if isinstance(code, str):
+                code = compile_source(code)
             
             # Execute the code
-            exec(modified_code, namespace)
+            with metrics.timed("exec"):
+                exec(code, namespace)
             
             # Collect output
             output = stdout_capture.getvalue()
             
-            # Collect the generated plot files
-            for file in os.listdir(temp_dir):
-                if file.startswith('plot_') and file.endswith('.png'):
-                    plot_files.append(os.path.join(temp_dir, file))
-            
         except Exception as e:
             error = f"Error executing plot code: {str(e)}\n{traceback.format_exc()}"
             logger.error(error)
     
-    return plot_files, output, error
-
-# Function to check code for potentially harmful operations
-def check_code_safety(code_string):
-    import re
-    
-    # Check for forbidden functions using word boundaries to avoid false positives
-    # This prevents matching "eval" in words like "evaluation" or "medieval"
-    forbidden_functions = ['eval', 'exec', 'compile', 'globals', 'locals', 'open']
-    for forbidden in forbidden_functions:
-        # Use word boundaries (\b) to match complete words only
-        pattern = r'\b' + re.escape(forbidden) + r'\b'
-        if re.search(pattern, code_string):
-            return False, f"Code contains forbidden function: {forbidden}"
-    
-    # Check for forbidden attributes and modules (these can be partial matches)
-    forbidden_modules = [
-        '__import__', 'import_module', 'system', 'popen', 'subprocess',
-        'os.system', 'os.popen', 'os.spawn', 'os.exec', 'subprocess.run',
-        'subprocess.call', 'subprocess.Popen', 'pty.spawn', 'importlib.import_module'
-    ]
-    for forbidden in forbidden_modules:
-        if forbidden in code_string:
-            return False, f"Code contains forbidden function: {forbidden}"
-    
-    # Check for suspicious patterns
-    suspicious_patterns = [
-        "__builtins__", "__dict__", "__class__", "__base__", "__subclasses__",
-        "__getattribute__", "__getattr__", "getattr(", "setattr(", "delattr(",
-        "read(", "write(", "socket.", "connect(", "bind(", "listen(",
-        "requests.", "urllib", "http", "ftp", "smtp", "telnet"
-    ]
-    
-    for pattern in suspicious_patterns:
-        if pattern in code_string:
-            return False, f"Code contains suspicious pattern: {pattern}"
-    
-    return True, None
\ No newline at end of file
+    return images, output, error
+
+def execute_plot_blocks(codes, profile=DEFAULT_PROFILE, namespace=None):
+    """Execute dependent code blocks one after the other in one namespace.
+
+    Once a block fails, the blocks after it are not run, since they rely
+    on what the earlier blocks define.
+
+    Args:
+        codes: The blocks, each as accepted by execute_plot_code
+        profile: RenderProfile the figures are encoded with
+        namespace: Globals shared by the blocks (a fresh namespace when None)
+
+    Returns:
+        List with the (images, output, error) result of each block
+    """
+    namespace = {} if namespace is None else namespace
+    results = []
+    for code in codes:
+        if results and results[-1][2]:
+            results.append(([], "", SKIPPED_BLOCK_ERROR))
+        else:
+            results.append(execute_plot_code(code, profile, namespace))
+    return results
@@ -0,0 +1,148 @@
+import asyncio
+import itertools
+from dataclasses import dataclass, field
+from typing import Dict, Hashable, List, Optional
+
+import config
+
+@dataclass
+class _Waiter:
+    """A job waiting for a worker slot."""
+    chat_id: Optional[Hashable]
+    cost: float
+    fast: bool
+    finish: float          # virtual finish time, the fair-queuing order
+    seq: int               # arrival order, breaks ties
+    future: asyncio.Future = field(repr=False)
+    batch: Optional[Hashable] = None
+
+class FairScheduler:
+    """Decides which waiting job gets the next free worker.
+
+    Jobs from different chats are served in weighted fair order: each job is
+    tagged with a virtual finish time of ``max(now, chat's last finish) +
+    cost``, and the smallest tag goes first, so a chat that keeps sending
+    heavy snippets falls behind chats that send little. A chat never runs
+    more than ``chat_limit`` jobs at once. Cheap jobs, by their static cost
+    estimate, go through a fast lane ahead of the rest; after ``fast_burst``
+    fast jobs in a row a waiting regular job gets its turn. Jobs without a
+    chat_id are not subject to the per-chat limit.
+
+    The jobs of one batch, such as the independent code blocks of one
+    message, count once against the per-chat limit: while one of them runs,
+    the others may take free slots too. They are still tagged in the chat's
+    fair order, so other chats waiting with smaller tags go first.
+    """
+
+    def __init__(self, slots, chat_limit=None, fast_lane_cost=None, fast_burst=3):
+        self.slots = slots
+        self.chat_limit = config.PLOT_CHAT_CONCURRENCY if chat_limit is None else chat_limit
+        self.fast_lane_cost = config.FAST_LANE_MAX_COST if fast_lane_cost is None else fast_lane_cost
+        self.fast_burst = fast_burst
+        self._waiting: List[_Waiter] = []
+        self._running: Dict[Hashable, int] = {}
+        # Running jobs of each batch that holds one of its chat's slots
+        self._batches: Dict[Hashable, int] = {}
+        self._last_finish: Dict[Hashable, float] = {}
+        self._busy = 0
+        self._virtual_time = 0.0
+        self._fast_streak = 0
+        self._seq = itertools.count()
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiting)
+
+    async def acquire(self, chat_id=None, cost=1.0, batch=None):
+        """Wait until the job may take a worker slot.
+
+        Every successful acquire must be paired with a release() with the
+        same chat_id and batch.
+        """
+        start = max(self._virtual_time, self._last_finish.get(chat_id, 0.0))
+        waiter = _Waiter(chat_id, cost, cost <= self.fast_lane_cost, start + cost,
+                         next(self._seq), asyncio.get_running_loop().create_future(), batch)
+        if chat_id is not None:
+            self._last_finish[chat_id] = waiter.finish
+        self._waiting.append(waiter)
+        self._dispatch()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter in self._waiting:
+                self._waiting.remove(waiter)
+            elif not waiter.future.cancelled():
+                # The slot was granted just before the cancellation
+                self.release(chat_id, batch)
+            raise
+
+    def release(self, chat_id=None, batch=None):
+        """Return a worker slot and hand it to the next job in line."""
+        self._busy -= 1
+        if batch is not None and chat_id is not None:
+            self._batches[batch] -= 1
+            if self._batches[batch]:
+                # Other jobs of the batch still hold the chat's slot
+                self._dispatch()
+                return
+            del self._batches[batch]
+        if chat_id is not None:
+            self._running[chat_id] -= 1
+            if not self._running[chat_id]:
+                del self._running[chat_id]
+        self._dispatch()
+
+    def _eligible(self, waiter):
+        return (waiter.chat_id is None or waiter.batch in self._batches
+                or self._running.get(waiter.chat_id, 0) < self.chat_limit)
+
+    def _next(self) -> Optional[_Waiter]:
+        fast = regular = None
+        for waiter in self._waiting:
+            if not self._eligible(waiter):
+                continue
+            key = (waiter.finish, waiter.seq)
+            if waiter.fast:
+                if fast is None or key < (fast.finish, fast.seq):
+                    fast = waiter
+            elif regular is None or key < (regular.finish, regular.seq):
+                regular = waiter
+        if fast and (regular is None or self._fast_streak < self.fast_burst):
+            self._fast_streak += 1
+            return fast
+        self._fast_streak = 0
+        return regular
+
+    def _prune(self):
+        """Forget the tags that no longer make a difference.
+
+        A chat's next tag starts at max(virtual time, its last finish), so a
+        last finish at or behind virtual time can go. Once no job is waiting,
+        the backlog the tags ordered is over: virtual time moves up to the
+        last tag and all of them go, so chats seen once are not kept.
+        """
+        if not self._waiting and self._last_finish:
+            self._virtual_time = max(self._virtual_time, *self._last_finish.values())
+            self._last_finish.clear()
+            return
+        self._last_finish = {chat_id: finish for chat_id, finish in self._last_finish.items()
+                             if finish > self._virtual_time}
+
+    def _dispatch(self):
+        virtual_time = self._virtual_time
+        while self._busy < self.slots:
+            waiter = self._next()
+            if waiter is None:
+                break
+            self._waiting.remove(waiter)
+            self._busy += 1
+            if waiter.chat_id is not None and waiter.batch in self._batches:
+                self._batches[waiter.batch] += 1
+            elif waiter.chat_id is not None:
+                self._running[waiter.chat_id] = self._running.get(waiter.chat_id, 0) + 1
+                if waiter.batch is not None:
+                    self._batches[waiter.batch] = 1
+            self._virtual_time = max(self._virtual_time, waiter.finish - waiter.cost)
+            waiter.future.set_result(None)
+        if self._virtual_time > virtual_time or not self._waiting:
+            self._prune()
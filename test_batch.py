@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+# Tests for batch rendering of a directory of snippets
+
+import asyncio
+import json
+
+from batch import MANIFEST, NO_IMAGES_ERROR, load_snippets, read_manifest, render_all
+
+PLOT = """
+import matplotlib.pyplot as plt
+plt.plot([1, 2, 3])
+plt.show()
+"""
+
+def _render(source, output):
+    return asyncio.run(render_all(load_snippets(str(source)), str(output), workers=1))
+
+def test_batch_renders_and_skips_unchanged(tmp_path):
+    source, output = tmp_path / "archive", tmp_path / "rendered"
+    (source / "figures").mkdir(parents=True)
+    (source / "figures" / "line.py").write_text(PLOT)
+    (source / "unsafe.py").write_text("import os\nos.system('ls')\n")
+
+    counts = _render(source, output)
+    assert (counts["rendered"], counts["skipped"], counts["failed"]) == (1, 0, 1)
+    manifest = read_manifest(output / MANIFEST)
+    assert manifest["figures/line"]["images"] == ["figures__line-1.png"]
+    assert (output / "figures__line-1.png").read_bytes().startswith(b"\x89PNG")
+    assert manifest["unsafe"]["error"]
+
+    # Only the failed snippet is tried again, and the manifest keeps one line each
+    counts = _render(source, output)
+    assert (counts["rendered"], counts["skipped"], counts["failed"]) == (0, 1, 1)
+    assert len((output / MANIFEST).read_text().splitlines()) == 2
+
+    (source / "figures" / "line.py").write_text(PLOT.replace("[1, 2, 3]", "[3, 2, 1]"))
+    assert _render(source, output)["rendered"] == 1
+
+def test_saved_figures_are_rendered_and_no_images_is_a_failure(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    source, output = tmp_path / "archive", tmp_path / "rendered"
+    source.mkdir()
+    (source / "saved.py").write_text(PLOT.replace("plt.show()", "plt.savefig('line.png')"))
+    (source / "silent.py").write_text("print(1)\n")
+
+    counts = _render(source, output)
+    assert (counts["rendered"], counts["failed"]) == (1, 1)
+    manifest = read_manifest(output / MANIFEST)
+    assert manifest["saved"]["images"] == ["saved-1.png"]
+    assert manifest["silent"]["images"] == [] and manifest["silent"]["error"] == NO_IMAGES_ERROR
+
+def test_jsonl_source(tmp_path):
+    source = tmp_path / "snippets.jsonl"
+    source.write_text(json.dumps({"id": "a", "code": PLOT}) + "\n\n" + json.dumps({"code": "print(1)"}) + "\n")
+    assert load_snippets(str(source)) == [("a", PLOT), ("3", "print(1)")]
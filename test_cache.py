@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+# Tests for the rendered-result and file_id caches
+
+import os
+import threading
+import time
+
+from cache import FileIdCache, ResultCache, cache_key
+
+def test_formatting_does_not_change_key():
+    code = "import matplotlib.pyplot as plt\nplt.plot([1, 2])\nplt.show()"
+    reformatted = "import matplotlib.pyplot as plt\n\n# a comment\nplt.plot([1,2])   \nplt.show()\n"
+    assert cache_key(code) == cache_key(reformatted)
+    assert cache_key(code, ("png", 300)) != cache_key(code, ("png", 100))
+
+def test_size_and_ttl_eviction():
+    cache = ResultCache(max_bytes=10, ttl=0, directory="")
+    cache.put("a", [b"12345"])
+    cache.put("b", [b"12345"])
+    cache.put("c", [b"12345"])
+    assert cache.get("a") is None
+    assert cache.get("c") == ([b"12345"], "")
+
+    cache = ResultCache(max_bytes=100, ttl=1, directory="")
+    cache.put("a", [b"x"])
+    time.sleep(1.1)
+    assert cache.get("a") is None
+    assert cache.stats()["misses"] == 1
+
+def test_disk_tier_survives_restart(tmp_path):
+    cache = ResultCache(max_bytes=100, ttl=60, directory=str(tmp_path))
+    cache.put("a", [b"image"], "output")
+    cache.close()
+
+    restarted = ResultCache(max_bytes=100, ttl=60, directory=str(tmp_path))
+    assert restarted.get("a") == ([b"image"], "output")
+    assert restarted.hit_ratio == 1.0
+
+def test_disk_writes_leave_the_calling_thread(tmp_path, monkeypatch):
+    cache = ResultCache(max_bytes=100, ttl=60, directory=str(tmp_path))
+    threads = []
+    store = cache._store
+
+    def recording_store(*args):
+        threads.append(threading.get_ident())
+        store(*args)
+
+    monkeypatch.setattr(cache, "_store", recording_store)
+    cache.put("a", [b"image"])
+    cache.put("b", [b"image"])
+    cache.close()
+    assert len(threads) == 2 and threading.get_ident() not in threads
+    assert sorted(os.listdir(tmp_path)) == ["a.pkl", "b.pkl"]
+
+def test_file_ids_are_bounded_and_persisted(tmp_path):
+    path = str(tmp_path / "file_ids.json")
+    file_ids = FileIdCache(path=path, max_entries=2)
+    file_ids.put(b"first", "id-1")
+    file_ids.put(b"second", "id-2")
+    file_ids.put(b"third", "id-3")
+    assert file_ids.get(b"first") is None
+    file_ids.save()
+
+    restarted = FileIdCache(path=path, max_entries=2)
+    assert restarted.get(b"second") == "id-2"
+    assert restarted.get(b"third") == "id-3"
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+# Tests for compiling user code and rewriting its show() calls
+
+import matplotlib.pyplot as plt
+
+from compiler import compile_plot_code, group_dependent_blocks
+from sandbox import execute_plot_code
+
+def test_reformatted_code_reuses_compiled_plot():
+    compiled = compile_plot_code("import matplotlib.pyplot as plt\nplt.plot([1, 2])\nplt.show()")
+    reformatted = compile_plot_code("import matplotlib.pyplot as plt\n\n# comment\nplt.plot([1,2])\nplt.show()\n")
+    assert compiled.error is None
+    assert reformatted is compiled
+
+def test_unsafe_and_invalid_code_is_not_compiled():
+    unsafe = compile_plot_code("import os\nos.system('ls')")
+    assert unsafe.code is None
+    assert "system" in unsafe.error
+    assert compile_plot_code("plt.plot(").error.startswith("SyntaxError")
+
+def test_show_calls_are_rewritten_everywhere():
+    code = """
+import matplotlib.pyplot as pyplot
+from matplotlib.pyplot import show as display
+
+def draw(i):
+    pyplot.plot([0, i])
+    pyplot.show()
+
+for i in range(2):
+    draw(i)
+fig, ax = pyplot.subplots()
+ax.bar([1, 2], [3, 4])
+fig.show()
+pyplot.plot([1, 0])
+display()
+"""
+    # Figures left open by other tests would be rendered too
+    plt.close('all')
+    images, output, error = execute_plot_code(compile_plot_code(code).code)
+    assert error is None
+    assert len(images) == 4
+
+def test_blocks_sharing_names_are_grouped():
+    blocks = [
+        "import numpy as np\nx = np.arange(3)",
+        "import matplotlib.pyplot as plt\nplt.plot([1, 0])\nplt.show()",
+        "x = x * 2\nprint(x)",
+        "plt.plot(",
+        "def f():\n    return y\ny = 1",
+    ]
+    assert group_dependent_blocks(blocks) == [[0, 2], [1], [3], [4]]
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+# Tests for thinning out huge series before rendering
+
+import io
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+from PIL import Image
+
+import config
+from downsample import column_extremes, downsampled
+from render import build_profile, parse_directives, render_figure
+
+def test_column_extremes_keep_first_last_min_max():
+    columns = np.array([0, 0, 0, 0, 0, 1, 1, 2])
+    y = np.array([5, 9, 1, 4, 3, 7, 7, 2])
+    assert column_extremes(columns, y).tolist() == [0, 1, 2, 4, 5, 6, 7]
+
+def _pixels(image):
+    return np.asarray(Image.open(io.BytesIO(image)).convert('L'), dtype=int)
+
+def test_downsampled_figures_look_the_same(monkeypatch):
+    monkeypatch.setattr(config, 'DOWNSAMPLE_POINTS', 1000)
+    rng = np.random.default_rng(0)
+    x = np.linspace(0, 10, 200_000)
+    fig, (left, right) = plt.subplots(1, 2, figsize=(6, 3))
+    line, = left.plot(x, np.sin(x) + rng.normal(0, 0.1, x.size), linewidth=0.5)
+    scatter = right.scatter(rng.normal(size=50_000), rng.normal(size=50_000), c=rng.random(50_000), s=4)
+    try:
+        profile = build_profile({'dpi': 100})
+        exact = _pixels(render_figure(fig, build_profile({'dpi': 100, 'downsample': False})))
+        reduced = _pixels(render_figure(fig, profile))
+        assert exact.shape == reduced.shape
+        assert (np.abs(exact - reduced) > 64).mean() < 0.01
+
+        with downsampled(fig, 100):
+            assert len(line.get_xdata()) < 5000
+            assert len(scatter.get_offsets()) < 50_000
+        # The full data is back once the figure has been rendered
+        assert len(line.get_xdata()) == 200_000
+        assert len(scatter.get_offsets()) == 50_000
+    finally:
+        plt.close(fig)
+
+def test_exact_directive_turns_downsampling_off():
+    assert not build_profile(None, parse_directives("# plot: exact dpi=100")).downsample
+    assert build_profile().downsample
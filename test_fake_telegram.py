@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+# End-to-end tests of the bot against the fake Telegram API used by benchmark.py
+
+import asyncio
+import subprocess
+import sys
+
+import httpx
+import pytest
+
+from telegram import Bot, Message
+
+from bot import MAX_PHOTO_BYTES, build_application, send_image, send_images
+from cache import FileIdCache
+from fake_telegram import FakeTelegramServer
+from webhook import start_webhook
+
+@pytest.mark.parametrize("use_webhook", [False, True])
+def test_plot_request_round_trip(use_webhook):
+    async def run():
+        server = FakeTelegramServer()
+        await server.start()
+        application = build_application("0:test", server.base_url, server.file_url)
+        try:
+            async with application:
+                await application.start()
+                if use_webhook:
+                    receiver = await start_webhook(application, listen="127.0.0.1", port=0)
+                else:
+                    await application.updater.start_polling(poll_interval=0, timeout=1)
+                code = "import matplotlib.pyplot as plt\nplt.plot([1, 2, 3])\nplt.show()"
+                await asyncio.wait_for(server.send_message(7, f"```python\n{code}\n```"), 60)
+                if use_webhook:
+                    await receiver.stop()
+                else:
+                    await application.updater.stop()
+                await application.stop()
+        finally:
+            application.bot_data["worker_pool"].shutdown()
+            await server.stop()
+        return server
+
+    server = asyncio.run(run())
+    assert server.photos_sent[7] == 1
+    assert server.requests["deleteMessage"] == 1
+    assert server.requests["getUpdates" if not use_webhook else "setWebhook"] >= 1
+
+def test_code_blocks_of_a_message_run_as_one_batch():
+    plot = "import matplotlib.pyplot as plt\nplt.plot(values)\nplt.show()"
+    text = ("Load, plot, and an unrelated plot:\n```python\nvalues = [3, 1, 2]\n```\n"
+            f"```python\n{plot}\n```\n```python\n{plot.replace('values', '[1, 2]')}\n```\n"
+            "```python\nprint(undefined)\n```")
+
+    async def run():
+        server = FakeTelegramServer()
+        await server.start()
+        application = build_application("0:test", server.base_url, server.file_url)
+        try:
+            async with application:
+                await application.start()
+                await application.updater.start_polling(poll_interval=0, timeout=1)
+                await asyncio.wait_for(server.send_message(7, text), 60)
+                await application.updater.stop()
+                await application.stop()
+        finally:
+            application.bot_data["worker_pool"].shutdown()
+            await server.stop()
+        return server
+
+    server = asyncio.run(run())
+    assert server.photos_sent[7] == 2
+    # The processing message and the error of the last block
+    assert server.requests["sendMessage"] == 2
+
+def test_streamed_plot_that_failed_to_send_comes_with_the_rest():
+    code = "import matplotlib.pyplot as plt\nplt.plot([1, 2])\nplt.show()\nplt.plot([2, 1])\nplt.show()"
+
+    async def run():
+        server = FakeTelegramServer()
+        await server.start()
+        server.failures["sendPhoto"] = 1
+        application = build_application("0:test", server.base_url, server.file_url)
+        try:
+            async with application:
+                await application.start()
+                await application.updater.start_polling(poll_interval=0, timeout=1)
+                await asyncio.wait_for(server.send_message(7, f"```python\n{code}\n```"), 60)
+                await application.updater.stop()
+                await application.stop()
+        finally:
+            application.bot_data["worker_pool"].shutdown()
+            await server.stop()
+        return server
+
+    server = asyncio.run(run())
+    assert server.photos_sent[7] == 2
+
+def test_image_sent_again_goes_by_file_id():
+    image = b"\x89PNG" + bytes(50000)
+
+    async def run():
+        server = FakeTelegramServer()
+        await server.start()
+        file_ids = FileIdCache(path="")
+        try:
+            async with Bot("0:test", server.base_url, server.file_url) as bot:
+                message = Message.de_json({"message_id": 1, "date": 0, "chat": {"id": 7, "type": "private"}}, bot)
+                await send_image(message, image, "plot.png", file_ids)
+                uploaded = server.bytes_received
+                await send_image(message, image, "plot.png", file_ids)
+                return uploaded, server.bytes_received - uploaded, len(file_ids)
+        finally:
+            await server.stop()
+
+    uploaded, sent_again, remembered = asyncio.run(run())
+    assert uploaded > len(image) and sent_again < 1000
+    assert remembered == 1
+
+def test_mixed_photos_and_documents_keep_their_order():
+    small = b"\x89PNG" + bytes(1000)
+    large = b"\x89PNG" + bytes(MAX_PHOTO_BYTES)
+
+    async def run():
+        server = FakeTelegramServer()
+        await server.start()
+        try:
+            async with Bot("0:test", server.base_url, server.file_url) as bot:
+                message = Message.de_json({"message_id": 1, "date": 0, "chat": {"id": 7, "type": "private"}}, bot)
+                await send_images(message, [small, large, small, small + b"2"])
+        finally:
+            await server.stop()
+        return server
+
+    server = asyncio.run(run())
+    assert [method for method in server.calls if method.startswith("send")] == [
+        "sendPhoto", "sendDocument", "sendMediaGroup"]
+
+def test_webhook_requires_secret():
+    async def run():
+        server = FakeTelegramServer()
+        await server.start()
+        application = build_application("0:test", server.base_url, server.file_url)
+        application.bot_data["worker_pool"].shutdown()
+        try:
+            async with application:
+                receiver = await start_webhook(application, listen="127.0.0.1", port=0, secret="right")
+                url = f"http://127.0.0.1:{receiver.port}/webhook"
+                update = {"update_id": 1}
+                async with httpx.AsyncClient() as client:
+                    wrong = await client.post(url, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"})
+                    right = await client.post(url, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": "right"})
+                    missing = await client.post(url + "/other", json=update)
+                await receiver.stop()
+                return wrong.status_code, right.status_code, missing.status_code, application.update_queue.qsize()
+        finally:
+            await server.stop()
+
+    assert asyncio.run(run()) == (403, 200, 404, 1)
+
+def test_bot_starts_without_plotting_libraries():
+    # Only the worker processes import them, so the bot answers soon after starting
+    check = "import sys, bot; print(sorted({'matplotlib', 'numpy', 'pandas'} & set(sys.modules)))"
+    result = subprocess.run([sys.executable, "-c", check], capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == "[]"
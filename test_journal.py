@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+# Tests for the journal of jobs in flight
+
+import asyncio
+
+from telegram import Update
+
+from journal import MAX_ATTEMPTS, JobJournal
+
+def _update(update_id):
+    return Update.de_json({
+        "update_id": update_id,
+        "message": {"message_id": update_id, "date": 0, "chat": {"id": 7, "type": "private"}, "text": "code"},
+    }, None)
+
+def test_unfinished_updates_are_replayed_once(tmp_path):
+    path = str(tmp_path / "jobs.jsonl")
+
+    async def first_run():
+        journal = JobJournal(path)
+        assert journal.begin(_update(1)) and journal.begin(_update(2))
+        # Delivered again while it is still being handled
+        assert not journal.begin(_update(2))
+        journal.finish(1)
+        journal.close()
+
+    async def second_run():
+        journal = JobJournal(path)
+        pending = journal.pending_updates(None)
+        duplicate = journal.begin(_update(1))
+        replayed = journal.begin(pending[0])
+        journal.finish(2)
+        journal.close()
+        return [update.update_id for update in pending], duplicate, replayed
+
+    asyncio.run(first_run())
+    pending, duplicate, replayed = asyncio.run(second_run())
+    assert pending == [2]
+    assert not duplicate
+    assert replayed
+    assert JobJournal(path).pending_updates(None) == []
+
+def test_drain_interrupts_jobs_past_the_deadline(tmp_path):
+    path = str(tmp_path / "jobs.jsonl")
+
+    async def run():
+        journal = JobJournal(path)
+
+        # The handlers themselves end normally, as the bot's update processing expects
+        handlers = [asyncio.ensure_future(journal.run(_update(1), asyncio.sleep(0.01))),
+                    asyncio.ensure_future(journal.run(_update(2), asyncio.sleep(60)))]
+        await asyncio.sleep(0)
+        await journal.drain(0.5)
+        await asyncio.gather(*handlers)
+        journal.close()
+
+    asyncio.run(run())
+    assert [update.update_id for update in JobJournal(path).pending_updates(None)] == [2]
+
+def test_update_that_keeps_getting_interrupted_is_given_up(tmp_path):
+    path = str(tmp_path / "jobs.jsonl")
+
+    async def run():
+        journal = JobJournal(path)
+        accepted = journal.begin(_update(1))
+        journal.close()
+        return accepted
+
+    assert [asyncio.run(run()) for _ in range(MAX_ATTEMPTS + 1)] == [True] * MAX_ATTEMPTS + [False]
+    assert JobJournal(path).pending_updates(None) == []
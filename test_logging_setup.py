@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+# Tests for the queued, structured logging
+
+import asyncio
+import json
+import logging
+import queue
+
+from logging_setup import DroppingQueueHandler, JsonFormatter, SamplingFilter
+from worker_pool import WorkerPool
+
+def _record(level=logging.INFO, name="bot", **extra):
+    record = logging.LogRecord(name, level, __file__, 1, "message", None, None)
+    record.__dict__.update(extra)
+    return record
+
+def test_json_records_carry_job_fields_cut_short():
+    line = JsonFormatter(field_chars=10).format(
+        _record(job_id=3, chat_id=7, timings={"render": 0.5}, output="x" * 25))
+    entry = json.loads(line)
+    assert entry["level"] == "INFO" and entry["logger"] == "bot"
+    assert entry["job_id"] == 3 and entry["chat_id"] == 7 and entry["timings"] == {"render": 0.5}
+    assert entry["output"] == "x" * 10 + "... [15 more characters]"
+    assert "error" not in entry
+
+def test_only_high_volume_info_records_are_sampled():
+    never = SamplingFilter(percent=0)
+    assert not never.filter(_record(sampled=True))
+    assert not never.filter(_record(name="httpx"))
+    assert never.filter(_record())
+    assert never.filter(_record(logging.ERROR, sampled=True))
+    assert SamplingFilter(percent=100).filter(_record(sampled=True))
+
+def test_full_queue_drops_records_instead_of_blocking():
+    handler = DroppingQueueHandler(queue.Queue(1))
+    handler.handle(_record())
+    handler.handle(_record())
+    assert handler.queue.qsize() == 1 and handler.dropped == 1
+
+def test_pool_logs_a_record_per_job(caplog):
+    async def run():
+        pool = WorkerPool(workers=1)
+        pool.start()
+        try:
+            await pool.submit("print('hello')", chat_id=5)
+            await pool.submit("undefined_name", chat_id=5)
+        finally:
+            pool.shutdown()
+
+    with caplog.at_level(logging.INFO, logger="worker_pool"):
+        asyncio.run(run())
+    finished, failed = [record for record in caplog.records if hasattr(record, "job_id")]
+    assert (finished.job_id, finished.chat_id, finished.output) == (1, 5, "hello\n")
+    assert finished.sampled and "queue_wait" in finished.timings
+    assert failed.levelno == logging.ERROR and failed.error_type == "Name Error"
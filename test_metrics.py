@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+# Tests for phase timings and the Prometheus endpoint
+
+import asyncio
+import socket
+
+import metrics
+from worker_pool import WorkerPool
+
+def test_prometheus_format():
+    histogram = metrics.Histogram("test_seconds", "Test histogram", "phase", buckets=(0.1, 1))
+    histogram.observe(0.05, "a")
+    histogram.observe(0.5, "a")
+    try:
+        text = metrics.render_prometheus()
+    finally:
+        # Later renders of /metrics must not include the test metric
+        metrics._registry.remove(histogram)
+    assert "# TYPE test_seconds histogram" in text
+    assert 'test_seconds_bucket{phase="a",le="0.1"} 1' in text
+    assert 'test_seconds_bucket{phase="a",le="+Inf"} 2' in text
+    assert 'test_seconds_count{phase="a"} 2' in text
+    assert histogram.quantile(0.5, "a") == 0.1
+
+def test_sandbox_phases_reach_the_bot_process():
+    async def run():
+        pool = WorkerPool(workers=1)
+        pool.start()
+        try:
+            await pool.submit("import matplotlib.pyplot as plt\nplt.plot([1, 2])\nplt.show()")
+        finally:
+            pool.shutdown()
+
+    metrics.reset()
+    asyncio.run(run())
+    assert {"queue_wait", "job", "exec", "savefig"} <= set(metrics.snapshot())
+
+def test_metrics_endpoint():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+
+    async def run():
+        server = await metrics.start_server("127.0.0.1", port)
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+            response = await reader.read()
+            writer.close()
+        finally:
+            server.close()
+        return response
+
+    response = asyncio.run(run())
+    assert response.startswith(b"HTTP/1.1 200 OK")
+    assert b"text/plain; version=0.0.4" in response
+    assert b"test_seconds" not in response
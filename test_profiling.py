@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+
+# Tests for profiling individual plot jobs
+
+import asyncio
+
+import profiling
+from worker_pool import WorkerPool
+
+PLOT_CODE = """
+import matplotlib.pyplot as plt
+import numpy as np
+x = np.linspace(0, 10, 1000)
+plt.plot(x, np.sin(x))
+plt.show()
+"""
+
+def test_profiled_job_reports_hotspots():
+    async def run():
+        pool = WorkerPool(workers=1)
+        pool.start()
+        try:
+            plain = await pool.submit(PLOT_CODE, chat_id=1)
+            assert profiling.take_report(1) is None
+            profiled = await pool.submit(PLOT_CODE, chat_id=1, profiled=True)
+        finally:
+            pool.shutdown()
+        return plain, profiled
+
+    plain, profiled = asyncio.run(run())
+    assert profiled[2] is None and len(profiled[0]) == len(plain[0]) == 1
+    report = profiling.take_report(1)
+    assert "Time by library" in report
+    assert "matplotlib" in report and "tottime" in report
+
+def test_sampling_switch():
+    settings = profiling.ProfilingSettings(sample_percent=0)
+    assert not settings.should_profile(1)
+    settings.chats.add(1)
+    assert settings.should_profile(1)
+    assert profiling.ProfilingSettings(sample_percent=100).should_profile(2)
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+# Tests for render profiles and per-message render options
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import pytest
+
+from render import DEFAULT_PROFILE, build_profile, figure_dpi, parse_directives, preview_profile, render_figure
+
+def test_dpi_adapts_to_pixel_budget():
+    fig = plt.figure(figsize=(16, 4))
+    try:
+        assert figure_dpi(fig, DEFAULT_PROFILE) == DEFAULT_PROFILE.max_pixels / 16
+        assert figure_dpi(fig, build_profile({'as_document': True})) == 300
+    finally:
+        plt.close(fig)
+
+def test_message_directives_override_user_settings():
+    code = "# plot: dpi=120 format=jpg\nimport matplotlib.pyplot as plt"
+    profile = build_profile({'dpi': 200, 'format': 'webp'}, parse_directives(code))
+    assert (profile.dpi, profile.format, profile.extension) == (120, 'jpeg', 'jpg')
+    assert build_profile(None, parse_directives("# plot: document")).as_document
+
+    with pytest.raises(ValueError):
+        parse_directives("# plot: dpi=5000")
+    with pytest.raises(ValueError):
+        parse_directives("# plot: format=gif")
+
+def test_preview_keeps_the_user_format_at_lower_resolution():
+    preview = preview_profile(build_profile({'dpi': 200, 'format': 'webp'}))
+    assert (preview.format, preview.dpi, preview.max_pixels, preview.as_document) == ('webp', 100, 1280, False)
+    assert preview_profile(build_profile({'dpi': 80, 'format': 'jpeg'})).max_pixels == 1280
+    assert preview_profile(build_profile({'dpi': 80, 'max_pixels': 1000})) is None
+
+def test_render_formats():
+    fig, ax = plt.subplots()
+    ax.plot([1, 2, 3])
+    try:
+        assert render_figure(fig).startswith(b'\x89PNG')
+        assert render_figure(fig, build_profile({'format': 'jpeg'})).startswith(b'\xff\xd8')
+        assert render_figure(fig, build_profile({'format': 'webp'}))[8:12] == b'WEBP'
+    finally:
+        plt.close(fig)
+
+def test_parallel_render_preserves_order():
+    from sandbox import render_in_parallel
+
+    figures = []
+    for width in (2, 3, 4, 5, 6):
+        fig = plt.figure(figsize=(width, 2))
+        fig.gca().plot([0, width])
+        figures.append(fig)
+    try:
+        profile = build_profile({'format': 'png'})
+        assert render_in_parallel(figures, profile, 2) == [render_figure(fig, profile) for fig in figures]
+    finally:
+        plt.close('all')
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+# Tests for the AST-based safety analyzer
+
+import pytest
+
+from safety import check_code_safety
+from utils import ErrorType, format_error_message
+
+LEGITIMATE = [
+    # Strings and method names that the old substring scan rejected
+    "import matplotlib.pyplot as plt\nplt.title('Data from http://example.com')\nplt.show()",
+    "import pandas as pd\nimport io\ndf = pd.read_csv(io.StringIO('a,b\\n1,2'))",
+    "import re\npattern = re.compile(r'\\d+')",
+    "import os\npath = os.path.join('a', 'b')",
+    "import scipy.signal\nimport pandas as pd\nb, a = scipy.signal.butter(3, 0.1)\npd.api.types.is_numeric_dtype(1)",
+    "import numpy as np\nimport matplotlib.pyplot as plt\nplt.plot(np.random.rand(3), color=plt.cm.viridis(0.5))",
+    "import matplotlib.pyplot as plt\nplt.title(r'$10^{-1.5}$ in {:.2f}s'.format(2.5))\nif __name__ == '__main__':\n    plt.show()",
+    "medieval_evaluation = [1, 2, 3]",
+    "class Model:\n    def __init__(self):\n        self.name = type(self).__name__",
+]
+
+UNSAFE = [
+    "eval('2 + 2')",
+    "import subprocess",
+    "import os\nos.system('ls')",
+    "import os as o\no.popen('ls')",
+    "from os import system",
+    "import os\nos.execv('/bin/sh', [])",
+    "import sys\nsys.modules['os']",
+    "().__class__.__base__.__subclasses__()",
+    "__builtins__['eval']('1')",
+    "f = getattr\nf(object, 'x')",
+    "import matplotlib.pyplot as plt\nplt.matplotlib.os.system('ls')",
+    "import ctypes",
+    "with open('/etc/passwd') as f:\n    pass",
+    # Modules reached through an allowed module
+    "import matplotlib\nmatplotlib.subprocess.run(['id'], capture_output=True)",
+    "import matplotlib\nmatplotlib.os.environ['HOME']",
+    "import os\nos.path.os.environ['HOME']",
+    "import numpy as np\nnp.ctypeslib.load_library('libc', '/lib')",
+    "from matplotlib import subprocess",
+    "import numpy.ctypeslib",
+    # Modules rebound, private attributes, frames and format strings
+    "import matplotlib\nm = matplotlib\nprint(m.os.environ['TELEGRAM_BOT_TOKEN'])",
+    "import matplotlib.pyplot as plt\nfigures = [plt]\nfigures[0].matplotlib",
+    "import matplotlib.pyplot as plt\ncolors = plt.cm\ncolors.os.environ",
+    "import random\nprint(random._os.environ['TELEGRAM_BOT_TOKEN'])",
+    "def g():\n    yield\ngen = g()\ngen.gi_frame.f_back.f_globals['original_import']('sub' + 'process')",
+    "def f():\n    pass\nf.__code__.co_consts",
+    "import matplotlib\nprint('{m.os.environ}'.format(m=matplotlib))",
+    "import numpy as np\nprint('{a.__class__}'.format(a=np.ones(1)))",
+    "template = '{' + 'x}'\nprint(template.format(x=1))",
+    "import matplotlib.ticker as ticker\nticker.StrMethodFormatter('{x.real}')",
+    "from operator import attrgetter",
+    "import operator\noperator.methodcaller('system', 'id')",
+]
+
+@pytest.mark.parametrize("code", LEGITIMATE)
+def test_legitimate_code_is_allowed(code):
+    assert check_code_safety(code) == (True, None)
+
+@pytest.mark.parametrize("code", UNSAFE)
+def test_unsafe_code_is_rejected(code):
+    is_safe, error = check_code_safety(code)
+    assert not is_safe
+    assert format_error_message(error)[0] == ErrorType.SECURITY_ERROR
+
+def test_syntax_errors_are_reported_with_line():
+    is_safe, error = check_code_safety("x = 1\ny = (")
+    assert not is_safe
+    assert format_error_message(error) == (ErrorType.SYNTAX_ERROR, "Syntax error on line 2: '(' was never closed")
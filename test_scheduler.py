@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+# Tests for the order in which waiting plot jobs get a worker
+
+import asyncio
+
+from scheduler import FairScheduler
+
+def run_in_order(scheduler, jobs):
+    """Queue (chat_id, cost) jobs behind a busy slot and return the order they start in."""
+    async def run():
+        order = []
+
+        async def job(index, chat_id, cost):
+            await scheduler.acquire(chat_id, cost)
+            order.append(index)
+            # Hold the slot until the next event loop pass, like a real job
+            await asyncio.sleep(0)
+            scheduler.release(chat_id)
+
+        # A job outside the fast lane occupies the only slot while the others queue
+        await scheduler.acquire(None, 100)
+        tasks = [asyncio.create_task(job(index, *spec)) for index, spec in enumerate(jobs)]
+        await asyncio.sleep(0)
+        scheduler.release()
+        await asyncio.gather(*tasks)
+        return order
+
+    return asyncio.run(run())
+
+def test_light_chat_overtakes_heavy_backlog():
+    scheduler = FairScheduler(slots=1, chat_limit=1, fast_lane_cost=0)
+    order = run_in_order(scheduler, [("heavy", 10), ("heavy", 10), ("heavy", 10), ("light", 1)])
+    assert order == [3, 0, 1, 2]
+
+def test_fast_lane_goes_first_but_not_forever():
+    scheduler = FairScheduler(slots=1, chat_limit=1, fast_lane_cost=2, fast_burst=2)
+    jobs = [("a", 5)] + [(f"chat{i}", 1) for i in range(4)]
+    assert run_in_order(scheduler, jobs) == [1, 2, 0, 3, 4]
+
+def test_chat_concurrency_limit():
+    async def run():
+        scheduler = FairScheduler(slots=2, chat_limit=1)
+        await scheduler.acquire("a")
+        second = asyncio.create_task(scheduler.acquire("a"))
+        await asyncio.sleep(0)
+        assert not second.done()
+        scheduler.release("a")
+        await asyncio.wait_for(second, 1)
+
+    asyncio.run(run())
+
+def test_batch_counts_once_against_chat_limit():
+    async def run():
+        scheduler = FairScheduler(slots=3, chat_limit=1)
+        batch = object()
+        for _ in range(3):
+            await asyncio.wait_for(scheduler.acquire("a", batch=batch), 1)
+        # Outside the batch, the chat is at its limit
+        other = asyncio.create_task(scheduler.acquire("a"))
+        await asyncio.sleep(0)
+        assert not other.done()
+        scheduler.release("a", batch)
+        scheduler.release("a", batch)
+        await asyncio.sleep(0)
+        assert not other.done()
+        scheduler.release("a", batch)
+        await asyncio.wait_for(other, 1)
+
+    asyncio.run(run())
+
+def test_tags_of_chats_that_left_are_forgotten():
+    async def run():
+        scheduler = FairScheduler(slots=2, chat_limit=1)
+        # One chat keeps a slot busy while many others come once
+        await scheduler.acquire("regular", 5)
+        for chat in range(1000):
+            await scheduler.acquire(chat, 3)
+            scheduler.release(chat)
+        # A backlog: chats queued behind a full pool are still remembered
+        await scheduler.acquire("busy")
+        waiting = [asyncio.create_task(scheduler.acquire(chat, 2)) for chat in ("x", "y")]
+        await asyncio.sleep(0)
+        remembered = set(scheduler._last_finish)
+        scheduler.release("busy")
+        await asyncio.wait_for(waiting[0], 1)
+        scheduler.release("x")
+        await asyncio.wait_for(waiting[1], 1)
+        scheduler.release("y")
+        scheduler.release("regular")
+        return remembered, len(scheduler._last_finish)
+
+    remembered, left = asyncio.run(run())
+    assert len(remembered) <= 4 and {"x", "y"} <= remembered
+    assert left == 0
@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+
+# Tests for running plotting code on the worker pool
+
+import asyncio
+import os
+import signal
+import time
+
+import pytest
+
+from compiler import SKIPPED_BLOCK_ERROR, compile_plot_code, compile_source
+from scheduler import FairScheduler
+from utils import ErrorType, format_error_message
+import worker_pool
+from worker_pool import JobLimits, WorkerPool, PoolBusyError, SessionManager
+
+PLOT_CODE = """
+import matplotlib.pyplot as plt
+plt.plot([1, 2, 3], [4, 5, 6])
+plt.show()
+"""
+
+def test_jobs_run_on_workers():
+    async def run():
+        pool = WorkerPool(workers=2, max_queue=4)
+        pool.start()
+        try:
+            results = await asyncio.gather(*(pool.submit(PLOT_CODE) for _ in range(3)))
+        finally:
+            pool.shutdown()
+        return results
+
+    for images, output, error in asyncio.run(run()):
+        assert error is None
+        assert len(images) == 1
+
+def test_show_inside_loop_renders_each_figure():
+    code = """
+import matplotlib.pyplot as plt
+for i in range(3):
+    plt.plot([0, i])
+    plt.show()
+"""
+
+    async def run():
+        pool = WorkerPool(workers=1)
+        pool.start()
+        try:
+            return await pool.submit(code)
+        finally:
+            pool.shutdown()
+
+    images, output, error = asyncio.run(run())
+    assert error is None
+    assert len(images) == 3
+    assert all(image.startswith(b"\x89PNG") for image in images)
+
+def test_preloaded_modules_are_importable():
+    code = """
+import numpy as np
+import pandas as pd
+import seaborn as sns
+import matplotlib.pyplot as plt
+df = pd.DataFrame({'x': np.arange(10), 'y': np.arange(10) ** 2})
+sns.lineplot(data=df, x='x', y='y')
+plt.show()
+"""
+
+    async def run():
+        pool = WorkerPool(workers=1)
+        pool.start()
+        try:
+            return await pool.submit(code)
+        finally:
+            pool.shutdown()
+
+    images, output, error = asyncio.run(run())
+    assert error is None
+    assert len(images) == 1
+
+def test_full_queue_is_rejected():
+    async def run():
+        pool = WorkerPool(workers=1, max_queue=1)
+        pool.start()
+        try:
+            first = pool.submit(PLOT_CODE)
+            second = pool.submit(PLOT_CODE)
+            await asyncio.sleep(0)
+            assert pool.queue_depth == 1
+            with pytest.raises(PoolBusyError):
+                pool.submit(PLOT_CODE)
+            await asyncio.gather(first, second)
+        finally:
+            pool.shutdown()
+
+    asyncio.run(run())
+
+def test_chat_share_of_queue_is_bounded():
+    async def run():
+        pool = WorkerPool(workers=1, max_queue=4, chat_queue=1)
+        pool.start()
+        try:
+            jobs = [pool.submit(PLOT_CODE, chat_id=1), pool.submit(PLOT_CODE, chat_id=1)]
+            with pytest.raises(PoolBusyError) as busy:
+                pool.submit(PLOT_CODE, chat_id=1)
+            assert busy.value.retry_after >= 1
+            jobs.append(pool.submit(PLOT_CODE, chat_id=2))
+            results = await asyncio.gather(*jobs)
+        finally:
+            pool.shutdown()
+        return results
+
+    assert all(error is None for _, _, error in asyncio.run(run()))
+
+def run_with_limits(code, limits):
+    async def run():
+        pool = WorkerPool(workers=1, limits=limits)
+        pool.start()
+        try:
+            first = await pool.submit(code)
+            # The worker must survive the runaway job and take the next one
+            second = await pool.submit(PLOT_CODE)
+        finally:
+            pool.shutdown()
+        return first, second
+
+    return asyncio.run(run())
+
+def test_wall_clock_limit():
+    (_, _, error), (images, _, next_error) = run_with_limits(
+        "import time\ntime.sleep(60)", JobLimits(wall_time=2, cpu_time=0, memory_mb=0))
+    assert format_error_message(error)[0] == ErrorType.TIMEOUT_ERROR
+    assert next_error is None and len(images) == 1
+
+def test_cpu_time_limit():
+    (_, _, error), _ = run_with_limits(
+        "while True:\n    pass", JobLimits(wall_time=30, cpu_time=1, memory_mb=0))
+    assert format_error_message(error)[0] == ErrorType.TIMEOUT_ERROR
+
+def test_memory_limit():
+    (_, _, error), (images, _, next_error) = run_with_limits(
+        "import numpy as np\nx = np.ones((1024, 1024, 512))", JobLimits(wall_time=30, cpu_time=0, memory_mb=256))
+    assert format_error_message(error)[0] == ErrorType.MEMORY_ERROR
+    assert next_error is None and len(images) == 1
+
+def test_figures_share_the_memory_limit():
+    # Each of three figures holds on to 100 MB once it renders, 300 MB in all
+    code = (
+        "import matplotlib.pyplot as plt\n"
+        "from matplotlib.ticker import FuncFormatter\n"
+        "held = []\n"
+        "def labeller():\n"
+        "    block = []\n"
+        "    def label(value, position):\n"
+        "        if not block:\n"
+        "            block.append(bytearray(100 * 1024 * 1024))\n"
+        "            held.append(block)\n"
+        "        return str(value)\n"
+        "    return FuncFormatter(label)\n"
+        "for _ in range(3):\n"
+        "    plt.figure().gca().xaxis.set_major_formatter(labeller())\n"
+        "plt.show()"
+    )
+    (_, _, error), _ = run_with_limits(code, JobLimits(wall_time=30, cpu_time=0, memory_mb=256))
+    assert format_error_message(error)[0] == ErrorType.MEMORY_ERROR
+
+@pytest.mark.parametrize("signum, error_type", [
+    (signal.SIGXCPU, ErrorType.TIMEOUT_ERROR),
+    # Not out of CPU time, so the OOM killer
+    (signal.SIGKILL, ErrorType.MEMORY_ERROR),
+])
+def test_killed_job_is_reported_by_signal(monkeypatch, signum, error_type):
+    monkeypatch.setattr(worker_pool, "_execute", lambda job, channel: os.kill(os.getpid(), signum))
+    (_, _, error), _, _ = worker_pool._run_forked(None, JobLimits(wall_time=10, cpu_time=5, memory_mb=0), None)
+    assert format_error_message(error)[0] == error_type
+
+def test_killed_session_is_reported_by_signal():
+    async def run():
+        sessions = SessionManager(limits=JobLimits(wall_time=30, cpu_time=1, memory_mb=0))
+        sessions.chats.update({1, 2})
+        try:
+            spinning = await sessions.run(1, ("while True:\n    pass", None, False, False))
+            # Killed the way the OOM killer does it
+            job = asyncio.ensure_future(sessions.run(2, ("import time\ntime.sleep(20)", None, False, False)))
+            while 2 not in sessions._sessions or sessions._sessions[2].process is None:
+                await asyncio.sleep(0.05)
+            await asyncio.sleep(1)
+            os.kill(sessions._sessions[2].process.pid, signal.SIGKILL)
+            killed = await job
+        finally:
+            sessions.shutdown()
+        return spinning[0][2], killed[0][2]
+
+    spinning, killed = asyncio.run(run())
+    assert format_error_message(spinning)[0] == ErrorType.TIMEOUT_ERROR
+    assert format_error_message(killed)[0] == ErrorType.MEMORY_ERROR
+
+def test_compiled_code_runs_on_workers():
+    async def run():
+        pool = WorkerPool(workers=1)
+        pool.start()
+        try:
+            return await pool.submit(compile_plot_code(PLOT_CODE).code)
+        finally:
+            pool.shutdown()
+
+    images, output, error = asyncio.run(run())
+    assert error is None
+    assert len(images) == 1
+
+def test_workers_and_sessions_draw_in_serif_fonts():
+    code = "import matplotlib.pyplot as plt\nprint(plt.rcParams['font.family'], plt.rcParams['font.serif'][:2])"
+
+    async def run():
+        pool = WorkerPool(workers=1)
+        pool.start()
+        try:
+            return await pool.submit(code), await pool.submit(code, chat_id=1, session=True)
+        finally:
+            pool.shutdown()
+
+    for images, output, error in asyncio.run(run()):
+        assert error is None
+        assert output == "['serif'] ['Times New Roman', 'Liberation Serif']\n"
+
+def test_workers_do_not_inherit_the_bot_secrets(monkeypatch):
+    monkeypatch.setenv("TELEGRAM_BOT_TOKEN", "123:secret")
+    leak = compile_source("import os\nprint(os.environ.get('TELEGRAM_BOT_TOKEN'))")
+
+    async def run():
+        pool = WorkerPool(workers=1)
+        pool.start()
+        try:
+            return await pool.submit(leak), await pool.submit(leak, chat_id=1, session=True)
+        finally:
+            pool.shutdown()
+
+    for images, output, error in asyncio.run(run()):
+        assert error is None and output == "None\n"
+
+def test_code_cannot_pass_itself_off_as_a_trusted_package():
+    spoofed = compile_source("__package__ = 'matplotlib'\nimport subprocess")
+
+    async def run():
+        pool = WorkerPool(workers=1)
+        pool.start()
+        try:
+            return await pool.submit(spoofed)
+        finally:
+            pool.shutdown()
+
+    images, output, error = asyncio.run(run())
+    assert "Import of module 'subprocess' is not allowed" in error
+
+def test_computed_tick_template_cannot_look_up_attributes():
+    code = """
+import matplotlib.pyplot as plt
+fig, ax = plt.subplots()
+ax.plot([1, 2])
+ax.xaxis.set_major_formatter('{x.' + 'real}')
+plt.show()
+"""
+    async def run():
+        pool = WorkerPool(workers=1)
+        pool.start()
+        try:
+            return await pool.submit(code)
+        finally:
+            pool.shutdown()
+
+    images, output, error = asyncio.run(run())
+    assert images == [] and "Attribute lookup in tick format" in error
+
+def test_session_keeps_variables_between_jobs():
+    async def run():
+        pool = WorkerPool(workers=1)
+        pool.start()
+        try:
+            await pool.submit("import numpy as np\ndata = np.arange(10)", chat_id=5, session=True)
+            kept = await pool.submit(PLOT_CODE + "print(data.sum())", chat_id=5, session=True)
+            fresh = await pool.submit("print(data.sum())", chat_id=5)
+            pool.sessions.close(5)
+            reset = await pool.submit("print(data.sum())", chat_id=5, session=True)
+        finally:
+            pool.shutdown()
+        return kept, fresh, reset
+
+    kept, fresh, reset = asyncio.run(run())
+    assert kept[2] is None and kept[1].strip() == "45" and len(kept[0]) == 1
+    assert "NameError" in fresh[2]
+    assert "NameError" in reset[2]
+
+def test_session_runs_one_job_of_a_chat_at_a_time():
+    async def run():
+        pool = WorkerPool(workers=2, scheduler=FairScheduler(2, chat_limit=2))
+        pool.start()
+        try:
+            return await asyncio.gather(
+                pool.submit("import time\ntime.sleep(0.5)\ncount = 1", chat_id=5, session=True),
+                pool.submit("print(count)", chat_id=5, session=True))
+        finally:
+            pool.shutdown()
+
+    first, second = asyncio.run(run())
+    assert first[2] is None
+    assert second[2] is None and second[1] == "1\n"
+
+def test_least_recently_used_session_makes_room():
+    async def run():
+        sessions = SessionManager(max_sessions=1)
+        sessions.chats.update({1, 2})
+        try:
+            await sessions.run(1, ("x = 1", None, False, False))
+            await sessions.run(2, ("x = 2", None, False, False))
+            return len(sessions), sessions.take_notice(1), sessions.take_notice(2)
+        finally:
+            sessions.shutdown()
+
+    count, evicted, kept = asyncio.run(run())
+    assert count == 1
+    assert "room" in evicted
+    assert kept is None
+
+def test_images_stream_before_the_job_ends():
+    code = """
+import matplotlib.pyplot as plt
+plt.plot([1, 2])
+plt.show()
+total = 0
+for i in range(3_000_000):
+    total += i
+plt.plot([2, 1])
+plt.show()
+"""
+    async def run():
+        pool = WorkerPool(workers=1)
+        pool.start()
+        loop = asyncio.get_running_loop()
+        batches = []
+        try:
+            result = await pool.submit(code, on_images=lambda images: batches.append((loop.time(), images)))
+            return result, batches
+        finally:
+            pool.shutdown()
+
+    (images, output, error), batches = asyncio.run(run())
+    assert error is None
+    assert [len(batch) for _, batch in batches] == [1, 1]
+    assert images == batches[0][1] + batches[1][1]
+    # The first plot arrived while the loop was still running
+    assert batches[0][0] < batches[1][0] - 0.1
+
+def test_dependent_blocks_share_a_namespace():
+    blocks = ["import numpy as np\ndata = np.arange(10)", PLOT_CODE + "print(data.sum())",
+              "print(missing)", "print(data.max())"]
+
+    async def run():
+        pool = WorkerPool(workers=1)
+        pool.start()
+        try:
+            return await pool.submit([compile_plot_code(block).code for block in blocks])
+        finally:
+            pool.shutdown()
+
+    loaded, plotted, failed, skipped = asyncio.run(run())
+    assert loaded == ([], "", None)
+    assert plotted[1].strip() == "45" and len(plotted[0]) == 1
+    assert "NameError" in failed[2]
+    assert skipped == ([], "", SKIPPED_BLOCK_ERROR)
+
+def test_jobs_of_a_batch_share_the_chat_slot():
+    async def run():
+        pool = WorkerPool(workers=2, scheduler=FairScheduler(2, chat_limit=1))
+        pool.start()
+        try:
+            # Let both workers warm up
+            await asyncio.gather(pool.submit("pass"), pool.submit("pass"))
+            batch = object()
+            started = time.monotonic()
+            await asyncio.gather(*(pool.submit("import time\ntime.sleep(1)", chat_id=5, batch=batch)
+                                   for _ in range(2)))
+            return time.monotonic() - started
+        finally:
+            pool.shutdown()
+
+    assert asyncio.run(run()) < 1.8
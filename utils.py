@@ -15,6 +15,8 @@ class ErrorType:
     ATTRIBUTE_ERROR = "Attribute Error"
     RUNTIME_ERROR = "Runtime Error"
     SECURITY_ERROR = "Security Error"
+    TIMEOUT_ERROR = "Timeout Error"
+    MEMORY_ERROR = "Memory Error"
     UNKNOWN_ERROR = "Unknown Error"
 
 # Format error messages for user-friendly display
@@ -30,7 +32,21 @@ def format_error_message(error_message: str) -> Tuple[str, str]:
     # Extract the error type
     error_type = ErrorType.UNKNOWN_ERROR
     
-    if "SyntaxError" in error_message:
+    # Resource limit failures are checked first since their tracebacks can
+    # mention any other exception type along the way
+    if "TimeoutError" in error_message:
+        error_type = ErrorType.TIMEOUT_ERROR
+        match = re.search(r"TimeoutError: (.+)$", error_message, re.MULTILINE)
+        if match:
+            return error_type, f"Timed out: {match.group(1)}"
+    
+    elif "MemoryError" in error_message:
+        error_type = ErrorType.MEMORY_ERROR
+        match = re.search(r"MemoryError: (.+)$", error_message, re.MULTILINE)
+        detail = match.group(1) if match else "the plot code used too much memory"
+        return error_type, f"Out of memory: {detail}"
+    
+    elif "SyntaxError" in error_message:
         error_type = ErrorType.SYNTAX_ERROR
         # Extract line number and error description
         match = re.search(r"SyntaxError: (.+?)(?:\s+\(line (\d+)\))?$", error_message, re.MULTILINE)
@@ -69,7 +85,7 @@ def format_error_message(error_message: str) -> Tuple[str, str]:
         if match:
             return error_type, f"Attribute error: {match.group(1)}"
     
-    elif "forbidden function" in error_message or "suspicious pattern" in error_message:
+    elif any(marker in error_message for marker in ("forbidden function", "forbidden import", "suspicious pattern")):
         error_type = ErrorType.SECURITY_ERROR
         return error_type, f"Security error: {error_message}"
     
@@ -77,27 +93,41 @@ def format_error_message(error_message: str) -> Tuple[str, str]:
     return error_type, f"Error: {error_message}"
 
 # Extract Python code from message text
-def extract_code(message_text: str) -> Optional[str]:
-    """Extract Python code from a message.
+def extract_code_blocks(message_text: str) -> List[str]:
+    """Extract every Python code block from a message.
     
     Args:
         message_text: The message text that may contain code
         
     Returns:
-        The extracted code or None if no code is found
+        The code of each block marked with triple backticks, in order, or the
+        whole message if it is plotting code without backticks (empty if no
+        code is found)
     """
     # Look for code blocks marked with triple backticks
     code_pattern = r'```(?:python)?\s*([\s\S]*?)```'
-    match = re.search(code_pattern, message_text)
-    
-    if match:
-        return match.group(1).strip()
+    blocks = [block.strip() for block in re.findall(code_pattern, message_text)]
+    blocks = [block for block in blocks if block]
+    if blocks:
+        return blocks
     
     # If no code block is found, check if the entire message is code
     if 'import matplotlib' in message_text or 'import plt' in message_text:
-        return message_text.strip()
+        return [message_text.strip()]
     
-    return None
+    return []
+
+def extract_code(message_text: str) -> Optional[str]:
+    """Extract the first Python code block from a message.
+    
+    Args:
+        message_text: The message text that may contain code
+        
+    Returns:
+        The extracted code or None if no code is found
+    """
+    blocks = extract_code_blocks(message_text)
+    return blocks[0] if blocks else None
 
 # Format help messages
 def get_help_message() -> str:
@@ -110,8 +140,17 @@ def get_help_message() -> str:
         "How to use the Plotting Bot:\n\n"
         "1. Send Python code that creates matplotlib plots\n"
         "2. Make sure your code includes 'plt.show()' to display the plots\n"
-        "3. The bot will execute your code and send back the generated images\n\n"
+        "3. The bot will execute your code and send back the generated images\n"
+        "4. Several code blocks in one message run together; a block may use what earlier blocks define\n\n"
         "All plots will automatically use Times New Roman font.\n\n"
+        "Output settings:\n"
+        "/dpi 150 - render at up to 150 DPI (/dpi alone resets)\n"
+        "/format jpeg - use png, jpeg or webp (/format alone resets)\n"
+        "/document - toggle full-quality files instead of photos\n"
+        "/session - keep variables between messages, so data is loaded only once\n"
+        "/reset - clear the variables kept by /session\n"
+        "A '# plot: dpi=150 format=jpeg document' comment in the code applies to that message only; "
+        "add 'exact' to draw every point of huge line and scatter plots.\n\n"
         "Example:\n"
         "```python\n"
         "import matplotlib.pyplot as plt\n"
@@ -0,0 +1,124 @@
+import asyncio
+import hmac
+import json
+import logging
+import secrets
+from typing import Optional
+from urllib.parse import urlsplit
+
+from telegram import Update
+from telegram.ext import Application
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Largest update body accepted; Telegram's updates are far smaller
+MAX_BODY_BYTES = 1024 * 1024
+
+# Seconds an idle keep-alive connection from Telegram is kept open
+IDLE_TIMEOUT = 60
+
+# Header Telegram sends the secret_token given to setWebhook in
+SECRET_HEADER = "x-telegram-bot-api-secret-token"
+
+class WebhookServer:
+    """Minimal asyncio HTTP/1.1 server receiving updates from Telegram.
+
+    Each POST to ``path`` with the right secret is answered at once and its
+    update is put on the application's update queue, where it is handled
+    concurrently with the others. Connections are kept alive, so Telegram
+    can deliver many updates over a few connections.
+    """
+
+    def __init__(self, application: Application, path: str, secret: str):
+        self.application = application
+        self.path = path
+        self.secret = secret
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    @property
+    def port(self) -> int:
+        return self._server.sockets[0].getsockname()[1]
+
+    async def start(self, host, port):
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        logger.info(f"Listening for webhook updates on {host}:{self.port}{self.path}")
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await asyncio.wait_for(reader.readline(), IDLE_TIMEOUT)
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = (await reader.readline()).decode("latin-1").strip()
+                    if not line:
+                        break
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get("content-length") or 0)
+                if length > MAX_BODY_BYTES:
+                    await self._respond(writer, "413 Payload Too Large", close=True)
+                    break
+                body = await reader.readexactly(length)
+                status = await self._receive(request_line.split(), headers, body)
+                close = headers.get("connection", "").lower() == "close"
+                await self._respond(writer, status, close)
+                if close:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _receive(self, request, headers, body) -> str:
+        """Queue the update in a request and return the HTTP status to answer with."""
+        if len(request) < 2 or request[0] != b"POST" or request[1].decode() != self.path:
+            return "404 Not Found"
+        if not hmac.compare_digest(headers.get(SECRET_HEADER, ""), self.secret):
+            logger.warning("Rejected a webhook request without the secret token")
+            return "403 Forbidden"
+        try:
+            update = Update.de_json(json.loads(body), self.application.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            logger.warning(f"Could not parse webhook update: {e}")
+            return "400 Bad Request"
+        await self.application.update_queue.put(update)
+        return "200 OK"
+
+    @staticmethod
+    async def _respond(writer, status, close=False):
+        connection = "close" if close else "keep-alive"
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Length: 0\r\nConnection: {connection}\r\n\r\n".encode("ascii"))
+        await writer.drain()
+
+async def start_webhook(application: Application, url=None, listen=None, port=None,
+                        secret=None) -> WebhookServer:
+    """Start receiving updates on a webhook and register it with Telegram.
+
+    The application must already be initialized. Without ``url`` the
+    webhook is registered at the local address it listens on, which is only
+    useful against a local Bot API server such as fake_telegram's.
+
+    Returns:
+        The running WebhookServer
+    """
+    url = url or config.WEBHOOK_URL
+    listen = config.WEBHOOK_LISTEN if listen is None else listen
+    port = config.WEBHOOK_PORT if port is None else port
+    secret = secret or config.WEBHOOK_SECRET or secrets.token_urlsafe(32)
+
+    server = WebhookServer(application, urlsplit(url).path or "/" if url else "/webhook", secret)
+    await server.start(listen, port)
+    url = url or f"http://{listen}:{server.port}{server.path}"
+    await application.bot.set_webhook(url, max_connections=config.WEBHOOK_MAX_CONNECTIONS,
+                                      secret_token=secret)
+    return server
@@ -0,0 +1,761 @@
+import asyncio
+import itertools
+import logging
+import marshal
+import math
+import multiprocessing
+import os
+import signal
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from types import CodeType
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+import config
+import metrics
+import profiling
+from logging_setup import truncate
+from render import DEFAULT_PROFILE
+from scheduler import FairScheduler
+from utils import format_error_message
+
+logger = logging.getLogger(__name__)
+
+class PoolBusyError(Exception):
+    """Raised when a job is submitted while the job queue is full.
+
+    ``retry_after`` estimates in how many seconds a retry could be accepted.
+    """
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+@dataclass(frozen=True)
+class JobLimits:
+    """Resource budget of a single plot job. A value of 0 disables that limit."""
+    wall_time: int = config.PLOT_TIMEOUT
+    cpu_time: int = config.PLOT_CPU_LIMIT
+    memory_mb: int = config.PLOT_MEMORY_LIMIT_MB
+
+# Assumed job duration (seconds) until real jobs have been timed
+_INITIAL_JOB_SECONDS = 2.0
+
+# Extra seconds the parent waits for a worker before assuming it is wedged
+_PARENT_GRACE = 10
+
+# Environment variables of the bot that sandbox processes must not inherit
+_SECRET_VARIABLES = ("TELEGRAM_BOT_TOKEN", "WEBHOOK_SECRET")
+
+def _scrub_environment():
+    """Drop the bot's secrets from a sandbox process's environment."""
+    for name in _SECRET_VARIABLES:
+        os.environ.pop(name, None)
+
+def _timeout_result(message):
+    return [], "", f"Error executing plot code: TimeoutError: {message}"
+
+def _crash_result(exit_code, limits, cpu_seconds=None):
+    """Result of a job whose process died without sending one, judged by how it died.
+
+    SIGXCPU is the CPU limit, and so is SIGKILL once the process has used up
+    its CPU time (the hard limit). Any other SIGKILL comes from the kernel's
+    OOM killer, and under a memory limit native code that fails to allocate
+    crashes with SIGSEGV, SIGBUS or SIGABRT instead of raising MemoryError.
+
+    Args:
+        exit_code: The process's exit code, negative for a signal
+        limits: The JobLimits the job ran under
+        cpu_seconds: CPU time the process used, when known
+    """
+    signum = -exit_code if exit_code is not None and exit_code < 0 else None
+    out_of_cpu = cpu_seconds is not None and limits.cpu_time and cpu_seconds >= limits.cpu_time
+    if signum == signal.SIGXCPU or (signum == signal.SIGKILL and out_of_cpu):
+        return _timeout_result(f"Plot code used more than {limits.cpu_time} seconds of CPU time")
+    if signum == signal.SIGKILL or (limits.memory_mb and signum in (signal.SIGSEGV, signal.SIGBUS, signal.SIGABRT)):
+        budget = f"more than {limits.memory_mb} MB of memory" if limits.memory_mb else "too much memory"
+        return [], "", f"Error executing plot code: MemoryError: Plot code used {budget}"
+    return [], "", f"Error executing plot code: the sandbox process exited unexpectedly (status {exit_code})"
+
+def _address_space():
+    """Current virtual memory size of this process in bytes (0 if unknown)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+def _apply_limits(limits):
+    """Cap the CPU time and address space of the current job process."""
+    if resource is None:
+        return
+    if limits.cpu_time:
+        resource.setrlimit(resource.RLIMIT_CPU, (limits.cpu_time, limits.cpu_time + 1))
+    if limits.memory_mb:
+        # The budget is on top of what the warm worker has already mapped
+        limit = _address_space() + limits.memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+def _raise_soft_limit(kind, soft):
+    _, hard = resource.getrlimit(kind)
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    resource.setrlimit(kind, (soft, hard))
+
+def _renew_limits(limits):
+    """Give the next job of a long-lived session process a fresh CPU and memory budget.
+
+    Only the soft limits move, so they can be raised again for the next job.
+    """
+    if resource is None:
+        return
+    if limits.cpu_time:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        _raise_soft_limit(resource.RLIMIT_CPU, int(usage.ru_utime + usage.ru_stime) + limits.cpu_time)
+    if limits.memory_mb:
+        _raise_soft_limit(resource.RLIMIT_AS, _address_space() + limits.memory_mb * 1024 * 1024)
+
+def _resident_memory(pid):
+    """Resident memory of a process in bytes (0 if unknown)."""
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+def _set_process_group(pid):
+    # Also done by the child itself; whichever runs first wins the race
+    try:
+        os.setpgid(pid, pid)
+    except OSError:
+        pass
+
+# Jobs answer with ("images", [...]) for every show() of a streaming job,
+# then with ("result", (result, timings, report)) once they are done
+_IMAGES = "images"
+_RESULT = "result"
+
+def _marshal(code):
+    # Code objects cannot be pickled, so they cross the pipe marshalled
+    return marshal.dumps(code) if isinstance(code, CodeType) else code
+
+def _unmarshal(code):
+    return marshal.loads(code) if isinstance(code, bytes) else code
+
+def _load(job):
+    """Unmarshal the code of a job received by a worker or session process."""
+    code, *options = job
+    if isinstance(code, list):
+        return ([_unmarshal(block) for block in code], *options)
+    return (_unmarshal(code), *options)
+
+def _execute(job, channel=None, namespace=None):
+    """Run a job here, in a session's namespace when one is given.
+
+    Args:
+        job: Tuple of (code, profile, profiled, stream); code is a list
+            for a batch of dependent blocks, which is never streamed
+        channel: Connection the images of a streaming job are sent to as
+            each show() renders them
+        namespace: Globals kept by a session
+
+    Returns:
+        Tuple of the job's result (a list of them for a batch), the phase
+        timings it recorded and, for profiled jobs, the profile report (None
+        otherwise)
+    """
+    from sandbox import execute_plot_blocks, execute_plot_code
+
+    code, profile, profiled, stream = job
+    on_images = (lambda images: channel.send((_IMAGES, images))) if stream and channel else None
+    metrics.reset()
+    report = None
+    if isinstance(code, list):
+        if profiled:
+            results, report = profiling.run_profiled(execute_plot_blocks, code, profile, namespace)
+        else:
+            results = execute_plot_blocks(code, profile, namespace)
+        return results, metrics.snapshot(), report
+    if profiled:
+        result, report = profiling.run_profiled(execute_plot_code, code, profile, namespace, on_images)
+    else:
+        result = execute_plot_code(code, profile, namespace, on_images)
+    return result, metrics.snapshot(), report
+
+def _receive_result(conn, timeout, on_images=None):
+    """Wait for a job's result, passing the images it streams before that to on_images.
+
+    Returns:
+        The same as _execute(), or None if the result did not arrive in time
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+        if not conn.poll(remaining):
+            return None
+        kind, payload = conn.recv()
+        if kind == _RESULT:
+            return payload
+        if on_images:
+            on_images(payload)
+
+def _run_forked(job, limits, channel):
+    """Execute a job in a forked copy of the warm worker.
+
+    Images the job streams are passed on to ``channel`` as they arrive.
+
+    Returns:
+        The same as _execute()
+
+    The child shares the already imported modules and initialised matplotlib
+    state copy-on-write, and anything the job changes dies with the child. The
+    child runs under the CPU and memory limits and is killed when it overruns
+    the wall-clock budget, leaving the worker itself ready for the next job.
+    """
+    timings, report = {}, None
+    reader, writer = multiprocessing.Pipe(duplex=False)
+    pid = os.fork()
+    if pid == 0:
+        try:
+            reader.close()
+            # Own process group, so processes the job forks die with it
+            os.setpgid(0, 0)
+            _apply_limits(limits)
+            writer.send((_RESULT, _execute(job, writer)))
+        finally:
+            os._exit(0)
+
+    writer.close()
+    _set_process_group(pid)
+    result = None
+    try:
+        received = _receive_result(reader, limits.wall_time or None,
+                                   lambda images: channel.send((_IMAGES, images)))
+        if received:
+            result, timings, report = received
+        else:
+            os.killpg(pid, signal.SIGKILL)
+            result = _timeout_result(f"Plot code took longer than {limits.wall_time} seconds")
+    except EOFError:
+        pass
+    finally:
+        reader.close()
+
+    _, status, usage = os.wait4(pid, 0)
+    if result is None:
+        result = _crash_result(os.waitstatus_to_exitcode(status), limits, usage.ru_utime + usage.ru_stime)
+    return result, timings, report
+
+# Entry point of each worker process
+def _worker_main(conn, limits):
+    """Warm up, then run plot jobs received on the connection until stopped."""
+    # Shutdown is driven by the parent, not by a terminal Ctrl+C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _scrub_environment()
+    # The sandbox, and with it the plotting libraries, is only imported in
+    # the worker processes, which keeps the bot's own startup fast
+    from sandbox import warm_up
+    warm_up()
+
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+        job = _load(job)
+        if hasattr(os, "fork"):
+            conn.send((_RESULT, _run_forked(job, limits, conn)))
+        else:
+            conn.send((_RESULT, _execute(job, conn)))
+
+class _Worker:
+    """A worker process together with the parent's end of its pipe."""
+
+    def __init__(self, ctx, limits):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(child_conn, limits), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.timeout = limits.wall_time + _PARENT_GRACE if limits.wall_time else None
+
+    def run(self, job, on_images=None):
+        """Send a job to the worker and block until its result, timings and report come back.
+
+        Raises:
+            TimeoutError: If the worker does not answer within its time budget
+        """
+        self.conn.send(job)
+        received = _receive_result(self.conn, self.timeout, on_images)
+        if received is None:
+            raise TimeoutError(f"Worker {self.process.pid} did not answer within {self.timeout} seconds")
+        return received
+
+    def kill(self):
+        """Terminate the process immediately, e.g. when its job was abandoned."""
+        self.process.kill()
+        self.process.join()
+
+    def stop(self, timeout=5):
+        """Ask the worker to exit, killing it if it does not do so in time."""
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.kill()
+        self.conn.close()
+
+def _session_main(conn, limits):
+    """Run one chat's jobs in a namespace that lives as long as this process."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Own process group, so the processes a job forks die with the session
+    os.setpgid(0, 0)
+    _scrub_environment()
+    from sandbox import warm_up
+    warm_up()
+
+    namespace = {}
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+        _renew_limits(limits)
+        conn.send((_RESULT, _execute(_load(job), conn, namespace)))
+
+class _Session:
+    """A chat's long-lived sandbox process, started on its first job.
+
+    Unlike workers, the process runs the jobs itself rather than forking a
+    child for each, so variables defined by one job are there for the next.
+    """
+
+    def __init__(self, ctx, limits):
+        self._ctx = ctx
+        self.limits = limits
+        self.conn = None
+        self.process = None
+        self.busy = False
+        self.last_used = time.monotonic()
+
+    def _start(self):
+        self.conn, child_conn = self._ctx.Pipe()
+        self.process = self._ctx.Process(target=_session_main, args=(child_conn, self.limits), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def run(self, job, on_images=None):
+        """Send a job to the session, starting it first if needed, and block until it is done.
+
+        Raises:
+            TimeoutError: If the job overruns its wall-clock budget
+        """
+        if self.process is None:
+            self._start()
+        self.conn.send(job)
+        received = _receive_result(self.conn, self.limits.wall_time or None, on_images)
+        if received is None:
+            raise TimeoutError(f"Session {self.process.pid} did not answer within {self.limits.wall_time} seconds")
+        return received
+
+    @property
+    def memory(self) -> int:
+        """Resident memory of the session process in bytes."""
+        return _resident_memory(self.process.pid) if self.process else 0
+
+    def kill(self):
+        """Stop the session and everything it started. Its variables are lost."""
+        if self.process is None:
+            return
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except OSError:
+            self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+class SessionManager:
+    """Opt-in per-chat sessions that keep the user's variables between messages.
+
+    Chats in ``chats`` have their jobs run by their own long-lived sandbox
+    process, so a snippet can reuse data loaded by an earlier one and only
+    pays for re-plotting. At most ``max_sessions`` processes are resident;
+    the least recently used idle session makes room for a new one. Sessions
+    idle for ``idle_ttl`` seconds are closed, as are the least recently used
+    ones while all sessions together use more than ``memory_mb``. A chat
+    whose session was closed this way is told so with its next result.
+    """
+
+    def __init__(self, limits=None, max_sessions=None, idle_ttl=None, memory_mb=None,
+                 start_method="forkserver"):
+        self.limits = limits or JobLimits()
+        self.max_sessions = config.SESSION_MAX if max_sessions is None else max_sessions
+        self.idle_ttl = config.SESSION_IDLE_TTL if idle_ttl is None else idle_ttl
+        self.memory_mb = config.SESSION_MEMORY_MB if memory_mb is None else memory_mb
+        self.chats = set()
+        self._ctx = multiprocessing.get_context(start_method)
+        if start_method == "forkserver":
+            # Sessions then start from a process with the plotting stack imported
+            self._ctx.set_forkserver_preload(["sandbox"])
+        self._sessions: 'OrderedDict[object, _Session]' = OrderedDict()
+        self._notices = {}
+        # A session runs one job at a time; a chat's further jobs wait here,
+        # whatever the scheduler's chat limit allows
+        self._locks = {}
+        self._queued = Counter()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    @property
+    def memory(self) -> int:
+        """Resident memory of all sessions in bytes."""
+        return sum(session.memory for session in self._sessions.values())
+
+    def close(self, chat_id, reason=None) -> bool:
+        """Stop a chat's session; the chat keeps session mode and gets a new one next time.
+
+        Args:
+            chat_id: The chat whose session is closed
+            reason: Told to the chat with its next result (nothing when None)
+
+        Returns:
+            Whether the chat had a running session
+        """
+        session = self._sessions.pop(chat_id, None)
+        if session is None:
+            return False
+        session.kill()
+        if reason and chat_id in self.chats:
+            self._notices[chat_id] = reason
+            logger.info(f"Closed the session of chat {chat_id}: {reason}")
+        return True
+
+    def take_notice(self, chat_id):
+        """Why the chat's previous session was closed, if it was closed for it."""
+        return self._notices.pop(chat_id, None)
+
+    def expire_idle(self):
+        """Close sessions that have been idle for longer than the idle TTL."""
+        now = time.monotonic()
+        for chat_id, session in list(self._sessions.items()):
+            if not session.busy and now - session.last_used > self.idle_ttl:
+                self.close(chat_id, f"it was idle for more than {self.idle_ttl // 60} minutes")
+
+    def _session_for(self, chat_id):
+        session = self._sessions.get(chat_id)
+        if session is None:
+            while len(self._sessions) >= self.max_sessions:
+                idle = next((chat for chat, other in self._sessions.items() if not other.busy), None)
+                if idle is None:
+                    raise PoolBusyError("All sessions are busy", math.ceil(_INITIAL_JOB_SECONDS))
+                self.close(idle, "the bot needed room for other sessions")
+            session = self._sessions[chat_id] = _Session(self._ctx, self.limits)
+        self._sessions.move_to_end(chat_id)
+        return session
+
+    def _enforce_memory(self):
+        budget = self.memory_mb * 1024 * 1024
+        usage = {chat_id: session.memory for chat_id, session in self._sessions.items()}
+        # Least recently used first, so the session that just ran goes last
+        for chat_id, session in list(self._sessions.items()):
+            if sum(usage.values()) <= budget:
+                break
+            if not session.busy:
+                self.close(chat_id, f"the bot's sessions were using more than {self.memory_mb} MB of memory")
+                del usage[chat_id]
+
+    async def run(self, chat_id, job, executor=None, on_images=None):
+        """Run a job in the chat's session, after the chat's earlier jobs.
+
+        ``on_images`` is called from the executor thread with each batch of
+        images a streaming job sends.
+
+        Returns:
+            The same as _execute()
+
+        Raises:
+            PoolBusyError: If a new session is needed but all are busy
+        """
+        lock = self._locks.setdefault(chat_id, asyncio.Lock())
+        self._queued[chat_id] += 1
+        try:
+            async with lock:
+                return await self._run(chat_id, job, executor, on_images)
+        finally:
+            self._queued[chat_id] -= 1
+            if not self._queued[chat_id]:
+                del self._queued[chat_id]
+                del self._locks[chat_id]
+
+    async def _run(self, chat_id, job, executor, on_images):
+        self.expire_idle()
+        session = self._session_for(chat_id)
+        session.busy = True
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(executor, session.run, job, on_images)
+        except asyncio.CancelledError:
+            # The session is still busy with the abandoned job
+            self.close(chat_id, "its last job was cancelled")
+            raise
+        except TimeoutError as e:
+            logger.error(str(e))
+            self.close(chat_id, "its last job ran out of time")
+            return _timeout_result(f"Plot code took longer than {self.limits.wall_time} seconds"), {}, None
+        except (EOFError, OSError) as e:
+            session.process.join(1)
+            exit_code = session.process.exitcode
+            logger.error(f"Session of chat {chat_id} died with exit code {exit_code}: {e!r}")
+            self.close(chat_id, "its process crashed, probably by running out of memory or CPU time")
+            return _crash_result(exit_code, self.limits), {}, None
+        finally:
+            session.busy = False
+            session.last_used = time.monotonic()
+            self._enforce_memory()
+
+    def shutdown(self):
+        """Stop all sessions."""
+        for chat_id in list(self._sessions):
+            self.close(chat_id)
+
+class WorkerPool:
+    """Bounded pool of worker processes that execute plotting code.
+
+    Jobs are submitted from the event loop and run in separate processes, so a
+    slow exec or savefig never blocks other chats. Each worker imports the heavy
+    plotting modules once and then forks a fresh child for every job, which runs
+    under the pool's JobLimits. Each submission returns a future resolving to
+    the result of execute_plot_code.
+
+    Jobs submitted with ``session=True`` run in the chat's session from the
+    pool's SessionManager instead, still taking one of the scheduler's slots.
+
+    Waiting jobs are handed to workers by a FairScheduler, so one chat cannot
+    crowd out the others. At most ``max_queue`` jobs may wait for a free
+    worker and each chat may have at most ``chat_queue`` jobs waiting; further
+    submissions raise PoolBusyError.
+    """
+
+    def __init__(self, workers=None, max_queue=None, limits=None, start_method="spawn",
+                 chat_queue=None, scheduler=None, sessions=None):
+        self.workers = workers or config.PLOT_WORKERS
+        self.max_queue = config.PLOT_QUEUE_SIZE if max_queue is None else max_queue
+        self.limits = limits or JobLimits()
+        self.scheduler = scheduler or FairScheduler(self.workers)
+        self.chat_queue = config.PLOT_CHAT_QUEUE if chat_queue is None else chat_queue
+        self.sessions = sessions or SessionManager(self.limits)
+        self._ctx = multiprocessing.get_context(start_method)
+        self._all = []
+        self._idle = asyncio.Queue()
+        self._threads = None
+        self._pending = 0
+        self._running = 0
+        self._chat_pending = {}
+        self._batch_pending = {}
+        self._job_seconds = _INITIAL_JOB_SECONDS
+        self._job_ids = itertools.count(1)
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of jobs waiting for a free worker."""
+        return self._pending - self._running
+
+    @property
+    def busy_workers(self) -> int:
+        """Number of workers currently executing a job."""
+        return self._running
+
+    def retry_after(self) -> int:
+        """Estimated seconds until a job submitted now could start."""
+        return max(1, math.ceil((self.queue_depth + 1) * self._job_seconds / self.workers))
+
+    def start(self):
+        """Start the worker processes."""
+        self._threads = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="plot-worker")
+        for _ in range(self.workers):
+            self._idle.put_nowait(self._spawn())
+        logger.info(f"Started {self.workers} plot workers (queue size {self.max_queue})")
+
+    def shutdown(self):
+        """Stop all worker processes."""
+        for worker in self._all:
+            worker.stop()
+        self._all.clear()
+        self.sessions.shutdown()
+        if self._threads:
+            self._threads.shutdown(wait=False)
+
+    def submit(self, code, profile=DEFAULT_PROFILE, chat_id=None, cost=1.0, profiled=False,
+               session=False, on_images=None, batch=None) -> asyncio.Future:
+        """Queue a job and return a future for its (images, output, error) result.
+
+        Args:
+            code: The plotting code to execute, as text or a compiled code
+                object, or a list of dependent blocks to run in order in one
+                namespace; the future then resolves to a list with the result
+                of each block
+            profile: RenderProfile the figures are encoded with
+            chat_id: Chat the job belongs to, for fair scheduling (None for none)
+            cost: Estimated relative cost of the job
+            profiled: Run the job under cProfile; the report is logged and
+                kept for profiling.take_report(chat_id)
+            session: Run the job in the chat's session, with the variables
+                left by its earlier session jobs
+            on_images: Called on the event loop with the images of each
+                show() as soon as the job has rendered them. The result
+                still contains all images.
+            batch: Identifies jobs submitted together, e.g. the independent
+                blocks of one message; they count as one job against the
+                chat's share of the workers and of the queue
+
+        Raises:
+            PoolBusyError: If the job queue, or the chat's share of it, is full
+        """
+        if self._pending >= self.workers + self.max_queue:
+            raise PoolBusyError(f"Job queue is full ({self.queue_depth} jobs waiting)", self.retry_after())
+        chat_pending = self._chat_pending.get(chat_id, 0)
+        counted = batch is not None and batch in self._batch_pending
+        if chat_id is not None and not counted and chat_pending >= self.scheduler.chat_limit + self.chat_queue:
+            raise PoolBusyError(f"Chat {chat_id} already has {chat_pending} jobs queued",
+                                math.ceil(chat_pending * self._job_seconds))
+        code = [_marshal(block) for block in code] if isinstance(code, list) else _marshal(code)
+        self._pending += 1
+        if batch is not None:
+            self._batch_pending[batch] = self._batch_pending.get(batch, 0) + 1
+        if not counted:
+            self._chat_pending[chat_id] = chat_pending + 1
+        job = (code, profile, profiled, on_images is not None)
+        return asyncio.ensure_future(self._run(job, chat_id, cost, session, on_images, batch))
+
+    def _spawn(self):
+        worker = _Worker(self._ctx, self.limits)
+        self._all.append(worker)
+        return worker
+
+    def _replace(self, worker):
+        self._all.remove(worker)
+        return self._spawn()
+
+    def _finish(self, chat_id, batch=None):
+        self._pending -= 1
+        if batch is not None:
+            self._batch_pending[batch] -= 1
+            if self._batch_pending[batch]:
+                return
+            del self._batch_pending[batch]
+        self._chat_pending[chat_id] -= 1
+        if not self._chat_pending[chat_id]:
+            del self._chat_pending[chat_id]
+
+    async def _run(self, job, chat_id, cost, session=False, on_images=None, batch=None):
+        job_id = next(self._job_ids)
+        queued = time.monotonic()
+        try:
+            with metrics.timed("queue_wait"):
+                await self.scheduler.acquire(chat_id, cost, batch)
+        except BaseException:
+            self._finish(chat_id, batch)
+            raise
+
+        self._running += 1
+        started = time.monotonic()
+        streamed = []
+        loop = asyncio.get_running_loop()
+
+        def receive(images):
+            # Called on the worker's thread; the images are handed over in order
+            streamed.extend(images)
+            loop.call_soon_threadsafe(on_images, images)
+
+        try:
+            relay = receive if on_images else None
+            if session:
+                result, timings, report = await self.sessions.run(chat_id, job, self._threads, relay)
+            else:
+                result, timings, report = await self._run_on_worker(job, relay)
+            if isinstance(job[0], list) and isinstance(result, tuple):
+                # The batch as a whole failed, e.g. by running out of time
+                result = [result] * len(job[0])
+            if streamed:
+                images, output, error = result
+                result = streamed + images, output, error
+            elapsed = time.monotonic() - started
+            metrics.merge(timings)
+            if report:
+                logger.info(f"Profile of job {job_id} for chat {chat_id}:\n{report}",
+                            extra={"job_id": job_id, "chat_id": chat_id})
+                profiling.store_report(chat_id, report)
+            metrics.PHASE_SECONDS.observe(elapsed, "job")
+            self._log_job(job_id, chat_id, elapsed, started - queued, timings, result)
+            # Moving average of job durations, for retry estimates
+            self._job_seconds += 0.2 * (elapsed - self._job_seconds)
+            return result
+        finally:
+            self._running -= 1
+            self._finish(chat_id, batch)
+            self.scheduler.release(chat_id, batch)
+
+    def _log_job(self, job_id, chat_id, elapsed, waited, timings, result):
+        """Log one structured record of a finished job, with its phase timings,
+        output and error. The records of successful jobs are sampled.
+        """
+        results = result if isinstance(result, list) else [result]
+        output = "\n".join(text for _, text, _ in results if text)
+        errors = [error for _, _, error in results if error]
+        fields = {
+            "job_id": job_id,
+            "chat_id": chat_id,
+            "seconds": round(elapsed, 4),
+            "timings": {"queue_wait": round(waited, 4),
+                        **{phase: round(total, 4) for phase, (_, total) in timings.items()}},
+            "images": sum(len(images) for images, _, _ in results),
+            # Cut short here already, so a queued record holds no more than is written
+            "output": truncate(output, config.LOG_FIELD_CHARS) or None,
+        }
+        if errors:
+            fields["error_type"] = format_error_message(errors[0])[0]
+            fields["error"] = truncate("\n".join(errors), config.LOG_FIELD_CHARS)
+            logger.error(f"Job {job_id} for chat {chat_id} failed after {elapsed:.2f}s", extra=fields)
+        else:
+            logger.info(f"Job {job_id} for chat {chat_id} finished in {elapsed:.2f}s", extra={"sampled": True, **fields})
+
+    async def _run_on_worker(self, job, on_images=None):
+        """Run a job on an idle worker, replacing the worker if it fails.
+
+        Returns:
+            The same as _execute()
+        """
+        # The scheduler hands out no more slots than there are workers
+        worker = self._idle.get_nowait()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._threads, worker.run, job, on_images)
+        except asyncio.CancelledError:
+            # The worker is still busy with the abandoned job, so it cannot be reused
+            worker.kill()
+            worker = self._replace(worker)
+            raise
+        except TimeoutError as e:
+            logger.error(str(e))
+            worker.kill()
+            worker = self._replace(worker)
+            return _timeout_result(f"Plot code took longer than {self.limits.wall_time} seconds"), {}, None
+        except (EOFError, OSError) as e:
+            logger.error(f"Plot worker {worker.process.pid} died: {e!r}")
+            worker.kill()
+            worker = self._replace(worker)
+            return ([], "", "Error executing plot code: the worker process crashed"), {}, None
+        finally:
+            self._idle.put_nowait(worker)